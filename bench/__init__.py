@@ -0,0 +1,8 @@
+"""Loopback benchmarks of Sigmal's crypto, chat and file transfers, without Qt or a display.
+
+Run from the repository root:
+
+    python -m bench                            # full run, results in bench-results.json
+    python -m bench --quick --out new.json     # fewer sizes and repetitions
+    python -m bench --compare baseline.json    # flag metrics that got worse than a saved run
+"""
@@ -0,0 +1,50 @@
+import os
+import time
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from src.cipher import (
+    decode_hello, decrypt_message, derive_session_key, encode_hello, encrypt_message,
+    generate_ephemeral_key, session_cipher,
+)
+
+
+def per_second(func, min_time):
+    """Call func repeatedly for about min_time seconds and return the calls per second."""
+    calls = 0
+    batch = 1
+    started = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            func()
+        calls += batch
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            return calls / elapsed
+        batch *= 2
+
+
+def crypto(sizes, min_time):
+    """Chat message encryption at several sizes, and the public key work of a handshake."""
+    results = {}
+    cipher = session_cipher(os.urandom(32))
+    for size in sizes:
+        message = ("hello there " * (size // 12 + 1))[:size]
+        sealed = encrypt_message(message, cipher, b"seq", compress=True)
+        results[f"encrypt_message_{size}B"] = (
+            per_second(lambda: encrypt_message(message, cipher, b"seq", compress=True), min_time), "ops/s", "higher")
+        results[f"decrypt_message_{size}B"] = (
+            per_second(lambda: decrypt_message(sealed, cipher, b"seq"), min_time), "ops/s", "higher")
+
+    identity = Ed25519PrivateKey.generate()
+    ephemeral = generate_ephemeral_key()
+    remote = generate_ephemeral_key()
+    hello = encode_hello(identity, remote)
+    _, remote_public = decode_hello(hello)
+    results["identity_keygen"] = (1000 / per_second(Ed25519PrivateKey.generate, min_time), "ms", "lower")
+    results["ephemeral_keygen"] = (1000 / per_second(generate_ephemeral_key, min_time), "ms", "lower")
+    results["hello_sign"] = (1000 / per_second(lambda: encode_hello(identity, ephemeral), min_time), "ms", "lower")
+    results["hello_verify"] = (1000 / per_second(lambda: decode_hello(hello), min_time), "ms", "lower")
+    results["session_key"] = (
+        1000 / per_second(lambda: derive_session_key(ephemeral, remote_public, True), min_time), "ms", "lower")
+    return results
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from src.engine import ChatEngine
+
+# Chat messages of the benchmarks start with this, then the time they were sent
+BENCH_PREFIX = "bench "
+TIMEOUT = 60  # seconds before a benchmark step is given up
+
+
+def max_rss_kb():
+    """Peak resident memory in KB of this process; None where unknown."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    import sys
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+
+
+class EngineThread:
+    """A ChatEngine on its own event loop thread, the way ChatThread runs it, but without Qt."""
+
+    def __init__(self, **kwargs):
+        self.ready = threading.Event()  # session established, or listening for a host
+        self.files = queue.Queue()  # (arrival time, path) of received files
+        self.on_chat = None  # called with every benchmark message received
+        self.errors = []
+        self.engine = ChatEngine(
+            on_message=self.on_message,
+            on_file=lambda file_path, filename: self.files.put((time.perf_counter(), file_path)),
+            **kwargs,
+        )
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.engine.run()), name="engine", daemon=True)
+
+    def on_message(self, message):
+        if message.startswith(BENCH_PREFIX):
+            if self.on_chat:
+                self.on_chat(message)
+        elif message.startswith(("Secure session", "Resumed session", "Listening on")):
+            self.ready.set()
+        elif message.startswith(("Error", "Failed", "Port", "Connection lost")):
+            self.errors.append(message)
+
+    def start(self):
+        self.thread.start()
+        if not self.ready.wait(TIMEOUT):
+            raise RuntimeError(f"Engine did not start: {self.errors}")
+        return self
+
+    def wait_file(self):
+        try:
+            return self.files.get(timeout=TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError(f"File did not arrive: {self.errors}")
+
+    def stop(self):
+        self.engine.stop()
+        self.thread.join(5)
+
+
+def serve(conn, port, folder):
+    """Child process: host a session, time the benchmark messages that arrive and send files on request.
+
+    Runs in its own process so the host and the client do not share a GIL.
+    perf_counter is the system-wide monotonic clock, so the send times in the
+    messages can be compared with arrival times here.
+    """
+    os.chdir(folder)
+    arrivals = []  # (sent, arrived) per benchmark message
+    host = EngineThread(host_mode=True, port=port)
+    host.on_chat = lambda message: arrivals.append((float(message.split()[1]), time.perf_counter()))
+    host.start()
+    conn.send("ready")
+    while True:
+        command, argument = conn.recv()
+        if command == "arrivals":
+            # Wait for a number of messages and hand over their times
+            deadline = time.monotonic() + TIMEOUT
+            while len(arrivals) < argument and time.monotonic() < deadline:
+                time.sleep(0.001)
+            taken = arrivals[:argument]
+            del arrivals[:argument]
+            conn.send(taken)
+        elif command == "send_file":
+            host.engine.send_file(argument)
+            conn.send(True)
+        elif command == "stop":
+            host.stop()
+            conn.send(max_rss_kb())
+            return
@@ -0,0 +1,212 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+
+from bench import micro
+from bench.peer import BENCH_PREFIX, EngineThread, max_rss_kb, serve
+
+MESSAGE_SIZES = (64, 1024, 16 * 1024)
+FILE_SIZES_MB = (1, 16, 64)
+REGRESSION_THRESHOLD = 0.15  # a metric this much worse than the baseline is flagged
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark Sigmal over loopback.")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and repetitions, for a rough number")
+    parser.add_argument("--out", default="bench-results.json", help="where to write the results")
+    parser.add_argument("--compare", metavar="BASELINE", help="results of an earlier run to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative change that counts as a regression (default %(default)s)")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def bench_message(size, sent=None):
+    """A benchmark chat message of about size bytes, carrying the time it was sent."""
+    head = f"{BENCH_PREFIX}{time.perf_counter() if sent is None else sent:.9f} "
+    return head + "x" * max(size - len(head), 0)
+
+
+class Session:
+    """A host in a child process and a client in this one, connected over loopback."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.port = free_port()
+        host_folder = os.path.join(folder, "host")
+        os.makedirs(host_folder)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=serve, args=(child_conn, self.port, host_folder), daemon=True,
+        )
+        self.process.start()
+        if not self.conn.poll(60) or self.conn.recv() != "ready":
+            raise RuntimeError("The host process did not start.")
+        self.client = self.connect()
+
+    def connect(self, resumption=None):
+        return EngineThread(ip="127.0.0.1", port=self.port, resumption=resumption).start()
+
+    def ask(self, command, argument=None):
+        self.conn.send((command, argument))
+        return self.conn.recv()
+
+    def close(self):
+        self.client.stop()
+        rss = self.ask("stop")
+        self.process.join(5)
+        return rss
+
+
+def handshakes(session, count):
+    """Time full handshakes, and resumptions with the ticket of the first one."""
+    full = []
+    resumed = []
+    ticket = None
+    for _ in range(count):
+        started = time.perf_counter()
+        client = session.connect()
+        full.append(time.perf_counter() - started)
+        deadline = time.monotonic() + 5
+        while client.engine.resumption is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+        ticket = ticket or client.engine.resumption_state()
+        client.stop()
+    for _ in range(count):
+        started = time.perf_counter()
+        client = session.connect(resumption=dict(ticket))
+        resumed.append(time.perf_counter() - started)
+        client.stop()
+    return {
+        "handshake_full_p50": (percentile(full, 0.5) * 1000, "ms", "lower"),
+        "handshake_resumed_p50": (percentile(resumed, 0.5) * 1000, "ms", "lower"),
+    }
+
+
+def message_rates(session, sizes, count):
+    """Send bursts of messages and time until the last one arrives."""
+    results = {}
+    for size in sizes:
+        started = time.perf_counter()
+        for _ in range(count):
+            session.client.engine.send_message(bench_message(size))
+        arrivals = session.ask("arrivals", count)
+        if len(arrivals) < count:
+            raise RuntimeError(f"Only {len(arrivals)} of {count} messages of {size} bytes arrived.")
+        results[f"message_rate_{size}B"] = (count / (arrivals[-1][1] - started), "msgs/s", "higher")
+    return results
+
+
+def message_latency(session, count, interval=0.002):
+    """Send messages one at a time and measure how long each took to arrive."""
+    for _ in range(count):
+        session.client.engine.send_message(bench_message(256))
+        time.sleep(interval)
+    arrivals = session.ask("arrivals", count)
+    latencies = [arrived - sent for sent, arrived in arrivals]
+    return {
+        "message_latency_p50": (percentile(latencies, 0.5) * 1000, "ms", "lower"),
+        "message_latency_p99": (percentile(latencies, 0.99) * 1000, "ms", "lower"),
+    }
+
+
+def file_throughput(session, sizes_mb):
+    """Send files of random data from the host and time them until they are received and verified."""
+    results = {}
+    for size_mb in sizes_mb:
+        path = os.path.join(session.folder, f"bench-{size_mb}mb.bin")
+        with open(path, "wb") as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        started = time.perf_counter()
+        session.ask("send_file", path)
+        arrived, _ = session.client.wait_file()
+        results[f"file_{size_mb}MB"] = (size_mb / (arrived - started), "MB/s", "higher")
+        os.remove(path)
+    return results
+
+
+def run(quick):
+    results = {}
+    print("crypto...", flush=True)
+    results.update(micro.crypto(MESSAGE_SIZES, 0.1 if quick else 0.5))
+    with tempfile.TemporaryDirectory(prefix="sigmal-bench-") as folder:
+        client_folder = os.path.join(folder, "client")
+        os.makedirs(client_folder)
+        cwd = os.getcwd()
+        os.chdir(client_folder)  # keys and received files stay in the temporary folder
+        session = Session(folder)
+        try:
+            print("handshakes...", flush=True)
+            results.update(handshakes(session, 5 if quick else 20))
+            print("messages...", flush=True)
+            results.update(message_rates(session, MESSAGE_SIZES, 1000 if quick else 10000))
+            results.update(message_latency(session, 200 if quick else 1000))
+            print("files...", flush=True)
+            results.update(file_throughput(session, FILE_SIZES_MB[:2] if quick else FILE_SIZES_MB))
+        finally:
+            host_rss = session.close()
+            os.chdir(cwd)
+    if host_rss is not None:
+        results["peak_rss_host"] = (host_rss / 1024, "MB", "lower")
+        results["peak_rss_client"] = (max_rss_kb() / 1024, "MB", "lower")
+    return {name: {"value": value, "unit": unit, "better": better} for name, (value, unit, better) in results.items()}
+
+
+def compare(results, baseline, threshold):
+    """Print how every metric changed since the baseline and return the names of those that got worse."""
+    regressions = []
+    print(f"\n{'metric':<28}{'baseline':>14}{'now':>14}{'change':>9}")
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if not base or not base["value"]:
+            continue
+        change = (result["value"] - base["value"]) / base["value"]
+        worse = -change if result["better"] == "higher" else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<28}{base['value']:>14.2f}{result['value']:>14.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args.quick)
+    report = {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "quick": args.quick,
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, result in results.items():
+        print(f"{name:<28}{result['value']:>14.2f} {result['unit']}")
+    print(f"Results written to {args.out}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions.")
@@ -0,0 +1,219 @@
+"""Sigmal without a display: host, join or relay a chat session from a terminal.
+
+Nothing here imports Qt, so it runs on headless boxes and starts quickly:
+
+    python cli.py host --port 2137
+    python cli.py join 192.168.1.10 --port 2137
+    python cli.py relay --port 2137 --log
+
+A relay only routes: clients /join rooms on it, and their end-to-end
+encrypted room messages are fanned out without the relay opening them.
+"""
+import argparse
+import asyncio
+import html
+import json
+import sys
+import threading
+import time
+
+from src.engine import ChatEngine
+from src.metrics import METRICS, SamplingProfiler, dump_periodically
+from src.spool import OutboundSpool
+from src.store import MessageStore, plain_text
+from src.transfer import format_size
+
+HELP = (
+    "/send <path> - Offer a file\n"
+    "/transfers - List offered and running transfers\n"
+    "/accept <id>, /pause <id>, /resume <id>, /cancel <id> - Manage a transfer\n"
+    "/join <room> [passphrase] - Join an end-to-end encrypted room on the host, typed chat goes there\n"
+    "/leave <room> - Leave a room\n"
+    "/queue - Show how much is waiting to be sent to each peer\n"
+    "/fingerprint - Show your identity fingerprint\n"
+    "/stats - Show counters and latencies of the hot paths, /stats reset to start over\n"
+    "/profile - Start sampling where time goes, or stop and show it\n"
+    "/quit - Leave the session"
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Host, join or relay a Sigmal chat session without a display.")
+    modes = parser.add_subparsers(dest="mode", required=True)
+    host = modes.add_parser("host", help="host a session and chat from the terminal")
+    join = modes.add_parser("join", help="join a session and chat from the terminal")
+    join.add_argument("ip", help="address of the host")
+    relay = modes.add_parser("relay", help="host rooms for many clients, only relaying their chat")
+    for mode in (host, join, relay):
+        mode.add_argument("--port", type=int, default=2137)
+        mode.add_argument("--log", action="store_true", help="keep the chat in logs/ and index it for /search, and what peers did not get for the next run")
+    for mode in (host, join):
+        mode.add_argument("--nick", help="nickname, defaults to the one in config.json")
+    return parser.parse_args(argv)
+
+
+def load_config():
+    try:
+        with open("config.json", "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def raise_file_limit():
+    """Let a relay keep as many connections open as the system allows."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class Console:
+    """Prints the engine's events and sends what is typed on stdin."""
+
+    def __init__(self, args, config):
+        self.args = args
+        host_mode = args.mode != "join"
+        role = "host" if host_mode else "client"
+        self.nickname = getattr(args, "nick", None) or config.get("nicknames", {}).get(role, f"[{role[0].upper()}]")
+        self.color = config.get("colors", {}).get(f"{role}_color", "white")
+        self.journal = None
+        self.store = None
+        self.spool = None
+        if args.log:
+            from src.journal import ChatJournal
+
+            journal = config.get("journal", {})
+            self.journal = ChatJournal(folder=journal.get("folder", "logs"))
+            self.store = MessageStore(f"{self.journal.folder}/messages.db")
+            if args.mode != "relay":
+                self.spool = OutboundSpool(f"{self.journal.folder}/spool.db")
+        self.profiler = None  # SamplingProfiler while /profile is on
+        metrics = config.get("metrics", {})
+        if metrics.get("prometheus_file"):
+            dump_periodically(metrics["prometheus_file"], metrics.get("dump_interval_seconds", 15), self.show)
+        network = config.get("network", {})
+        relay = config.get("relay", {})
+        self.engine = ChatEngine(
+            host_mode=host_mode,
+            ip=getattr(args, "ip", None),
+            port=args.port,
+            on_message=self.show,
+            on_offer=self.show_offer,
+            on_connection_lost=lambda: self.show("Connection lost."),
+            store=self.store,
+            spool=self.spool,
+            send_high_water=network.get("send_high_water_kb", 1024) * 1024,
+            compression=network.get("compression", "auto"),
+            encrypt_files=network.get("encrypt_files", True),
+            relay=args.mode == "relay",
+            relay_queue=relay.get("queue_kb", 256) * 1024,
+            slow_consumers=relay.get("slow_consumers", "skip"),
+            relay_stall_time=relay.get("stall_seconds", 30),
+            heartbeat_interval=network.get("heartbeat_seconds", 5),
+            dead_peer_timeout=network.get("dead_peer_seconds", 20),
+            reconnect_max_delay=network.get("reconnect_max_seconds", 60),
+        )
+
+    def show(self, message):
+        if self.journal:
+            self.journal.append(message)
+        # Messages are HTML for the GUI; the terminal only gets their text
+        print(plain_text(message.partition("|COLOR=")[0]), flush=True)
+
+    def show_offer(self, tid, filename, size):
+        if self.args.mode == "relay":
+            return  # a relay never downloads
+        self.show(f"File offered: {filename} ({format_size(size)}), /accept {tid[:8]} to download it")
+
+    def read_input(self):
+        """Send each line typed on stdin. Runs on its own thread."""
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("/"):
+                if not self.command(line):
+                    break
+            else:
+                self.engine.send_message(f"{self.nickname}: {html.escape(line)}|COLOR={self.color}")
+        self.engine.stop()
+
+    def command(self, line):
+        """Run a command typed on stdin, returning False to quit."""
+        command, _, argument = line.partition(" ")
+        argument = argument.strip()
+        if command in ("/quit", "/exit"):
+            return False
+        if command == "/send" and argument:
+            self.engine.send_file(argument)
+        elif command == "/transfers":
+            self.engine.transfer_command("list")
+        elif command in ("/accept", "/pause", "/resume", "/cancel"):
+            self.engine.transfer_command(command[1:], argument)
+        elif command == "/join" and argument:
+            name, _, passphrase = argument.partition(" ")
+            self.engine.join_room(name, passphrase.strip())
+        elif command == "/leave" and argument:
+            self.engine.leave_room(argument)
+        elif command == "/queue":
+            self.engine.queue_report()
+        elif command == "/fingerprint":
+            self.show(f"Your fingerprint: {self.engine.fingerprint()}")
+        elif command == "/stats":
+            if argument == "reset":
+                METRICS.reset()
+                self.show("Stats reset.")
+            else:
+                self.show(METRICS.report())
+        elif command == "/profile":
+            self.toggle_profiler()
+        elif command == "/help":
+            self.show(HELP)
+        else:
+            self.show(f"Unknown command: {line}")
+        return True
+
+    def toggle_profiler(self):
+        """Start the sampling profiler, or stop it and print the busiest functions."""
+        if self.profiler is None:
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+            self.show("Profiler started, /profile again to see the results.")
+            return
+        profiler, self.profiler = self.profiler, None
+        elapsed = profiler.stop()
+        folder = self.journal.folder if self.journal else "."
+        path = f"{folder}/profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        print(profiler.report(), flush=True)
+        try:
+            profiler.write_collapsed(path)
+            self.show(f"Collapsed stacks of {elapsed:.1f} s saved to {path}.")
+        except OSError as e:
+            self.show(f"Could not save the stacks: {e}")
+
+    def run(self):
+        if self.args.mode == "relay":
+            raise_file_limit()
+        else:
+            threading.Thread(target=self.read_input, name="stdin", daemon=True).start()
+        try:
+            asyncio.run(self.engine.run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.journal:
+                self.journal.close()
+                self.store.close()
+            if self.spool:
+                self.spool.close()
+
+
+if __name__ == "__main__":
+    Console(parse_args(), load_config()).run()
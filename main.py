@@ -1,26 +1,42 @@
 import sys
+import time
+
+STARTED = time.perf_counter()  # start of the --profile-startup timeline
+
 import json
+import html
 import os
 import re
+import threading
 import webbrowser
-from urllib.parse import urlparse, unquote
-from datetime import datetime
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTextBrowser, QLineEdit, QPushButton, QMessageBox, QInputDialog, QFileDialog
-from PyQt5.QtCore import QUrl
-from PyQt5.QtMultimedia import QSoundEffect
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QLabel, QMessageBox, QInputDialog, QFileDialog
+from PyQt5.QtCore import Qt, QTimer, QUrl
 
-from src.core import ChatThread
+from src.chatlog import ChatLog
 from src.commands import handle_command  # Import the modular commands
+from src.journal import ChatJournal
+from src.metrics import METRICS, dump_periodically
+from src.startup import StartupProfile
+from src.spool import OutboundSpool
+from src.store import MessageStore
+from src.transfer import format_size
+
+FRAME_INTERVAL = 16  # ms between renders of incoming messages
+INGEST_BATCH = 1000  # messages rendered per frame at most, the rest wait for the next one
+SOUND_INTERVAL = 0.5  # seconds between message sounds
+WINDOW_TITLE = "Sigmal P2P Chat"
 
 
 class Sigmal(QWidget):
-    def __init__(self):
+    def __init__(self, profile=None):
         super().__init__()
+        self.profile = profile or StartupProfile(STARTED)
 
         # Load configurations
         self.config = self.load_config()
+        self.profile.mark("config")
 
-        self.setWindowTitle("Sigmal P2P Chat")
+        self.setWindowTitle(WINDOW_TITLE)
         self.setGeometry(
             300,
             300,
@@ -28,26 +44,43 @@ class Sigmal(QWidget):
             self.config["window"]["height"],
         )
         self.chat_thread = None
-        self.chat_history = []
+        self.journal = self.open_journal()
+        self.store = None  # opened after the window is shown
+        self.spool = None  # outbound spool, shared by every chat thread so /reconnect replays it
+        self.last_search = None  # query and page shown by the last /search, for /more
+        self.transfers = {}  # progress key -> latest progress snapshot
         self.is_host = False
+        self.last_sound = 0.0
         self.sound_enabled = self.config["sound"]["enabled"]
+        self.message_sound = self.error_sound = self.connection_lost_sound = None  # loaded after the window is shown
+        self.profiler = None  # SamplingProfiler while /toggle profiler is on
+        self.metrics_dump = self.start_metrics_dump()
+        self.profile.mark("journal")
 
-        # Initialize sounds
-        self.init_sounds()
+        # Incoming messages are rendered in batches, once per frame
+        self.ingest_timer = QTimer(self)
+        self.ingest_timer.setSingleShot(True)
+        self.ingest_timer.setInterval(FRAME_INTERVAL)
+        self.ingest_timer.timeout.connect(self.drain_messages)
 
         # Main layout
         self.layout = QVBoxLayout()
 
         # Chat display
-        self.chat_display = QTextBrowser()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setOpenExternalLinks(False)
+        self.chat_display = ChatLog(self.config.get("chat", {}).get("scrollback", 10000))
         self.chat_display.anchorClicked.connect(self.handle_link_click)
         self.chat_display.setStyleSheet(
             f"background-color: {self.config['colors']['background']}; color: {self.config['colors']['text']};"
         )
         self.layout.addWidget(self.chat_display)
 
+        # Running transfers, one line each
+        self.transfer_status = QLabel()
+        self.transfer_status.setTextFormat(Qt.PlainText)
+        self.transfer_status.setStyleSheet(f"color: {self.config['colors']['system_message_color']};")
+        self.transfer_status.hide()
+        self.layout.addWidget(self.transfer_status)
+
         # Message input field
         self.input_layout = QHBoxLayout()
         self.message_input = QLineEdit()
@@ -63,10 +96,27 @@ class Sigmal(QWidget):
 
         # Set layout
         self.setLayout(self.layout)
+        self.profile.mark("widgets")
 
-        # Startup dialog
+    def finish_startup(self):
+        """Load what the first paint does not need, then ask how to start the session."""
+        self.store = MessageStore(os.path.join(self.journal.folder, "messages.db"))
+        self.spool = OutboundSpool(os.path.join(self.journal.folder, "spool.db"))
+        self.profile.mark("message store")
+        self.init_sounds()
+        self.profile.mark("sounds")
+        # The networking and crypto modules are only needed once a session
+        # starts, import them while the user answers the startup dialog
+        threading.Thread(target=self.preload_modules, name="preload", daemon=True).start()
         self.show_startup_dialog()
 
+    def preload_modules(self):
+        started = time.perf_counter()
+        import src.core
+        import src.cipher
+        self.profile.mark("network and crypto modules", since=started)
+        self.profile.report()
+
     def load_config(self):
         """Load configuration from config.json or use defaults if not found or invalid."""
         default_config = {
@@ -81,6 +131,17 @@ class Sigmal(QWidget):
                 "system_message_color": "lightgreen",
             },
             "nicknames": {"host": "[H] Host", "client": "[C] Client"},
+            "chat": {"scrollback": 10000},  # lines you can scroll back to, kept on disk
+            "journal": {"folder": "logs", "max_mb": 8, "max_age_hours": 24, "keep": 30},
+            # send_high_water_kb: queued per peer before senders are slowed down;
+            # compression: "auto", "off", or the codec to prefer: "zstd", "zlib" or "lzma"
+            # encrypt_files: files are sent unencrypted only if both sides set this to false
+            "network": {"send_high_water_kb": 1024, "compression": "auto", "encrypt_files": True},
+            # relay: how a host treats room members that fall behind: queue_kb queued
+            # before their messages are skipped, "drop" or "skip" them, and for how long
+            "relay": {"queue_kb": 256, "slow_consumers": "skip", "stall_seconds": 30},
+            # prometheus_file: where to write the /stats metrics every dump_interval_seconds, empty for nowhere
+            "metrics": {"prometheus_file": "", "dump_interval_seconds": 15},
             "sound": {
                 "enabled": True,
                 "volume": {"message": 0.5, "error": 0.8, "connection_lost": 0.8},
@@ -109,6 +170,8 @@ class Sigmal(QWidget):
 
     def init_sounds(self):
         """Initialize sound effects."""
+        from PyQt5.QtMultimedia import QSoundEffect
+
         self.message_sound = QSoundEffect()
         self.error_sound = QSoundEffect()
         self.connection_lost_sound = QSoundEffect()
@@ -155,11 +218,8 @@ class Sigmal(QWidget):
             self.message_color = self.config["colors"]["host_color"]
             port, ok = QInputDialog.getInt(self, "Sigmal Host", "Enter port to host on:", 2137, 1024, 65535)
             if ok:
-                self.chat_thread = ChatThread(host_mode=True, port=port)
-                self.chat_thread.new_message.connect(self.display_message)
-                self.chat_thread.connection_lost.connect(self.handle_connection_lost)
-                self.chat_thread.file_received.connect(self.handle_file_received)
-                self.chat_thread.start()
+                self.chat_thread = self.new_chat_thread(host_mode=True, port=port)
+                self.start_chat_thread()
                 self.display_message(f"Hosting chat on port {port}...", self.config['colors']['system_message_color'])
             else:
                 self.close()
@@ -171,11 +231,8 @@ class Sigmal(QWidget):
             if ok:
                 port, ok = QInputDialog.getInt(self, "Sigmal Join", "Enter host port:", 2137, 1024, 65535)
                 if ok:
-                    self.chat_thread = ChatThread(host_mode=False, ip=ip, port=port)
-                    self.chat_thread.new_message.connect(self.display_message)
-                    self.chat_thread.connection_lost.connect(self.handle_connection_lost)
-                    self.chat_thread.file_received.connect(self.handle_file_received)
-                    self.chat_thread.start()
+                    self.chat_thread = self.new_chat_thread(host_mode=False, ip=ip, port=port)
+                    self.start_chat_thread()
                     self.display_message(f"Attempting to join chat at {ip}:{port}...", self.config['colors']['system_message_color'])
                 else:
                     self.close()
@@ -184,6 +241,37 @@ class Sigmal(QWidget):
         else:
             self.close()
 
+    def new_chat_thread(self, **kwargs):
+        """Create a chat thread with the settings from the config."""
+        from src.core import ChatThread
+
+        network = self.config.get("network", {})
+        relay = self.config.get("relay", {})
+        return ChatThread(
+            store=self.store,
+            spool=self.spool,
+            send_high_water=network.get("send_high_water_kb", 1024) * 1024,
+            compression=network.get("compression", "auto"),
+            encrypt_files=network.get("encrypt_files", True),
+            relay_queue=relay.get("queue_kb", 256) * 1024,
+            slow_consumers=relay.get("slow_consumers", "skip"),
+            relay_stall_time=relay.get("stall_seconds", 30),
+            heartbeat_interval=network.get("heartbeat_seconds", 5),
+            dead_peer_timeout=network.get("dead_peer_seconds", 20),
+            reconnect_max_delay=network.get("reconnect_max_seconds", 60),
+            **kwargs,
+        )
+
+    def start_chat_thread(self):
+        """Connect the chat thread's signals and start it."""
+        self.chat_thread.messages_ready.connect(self.schedule_ingest)
+        self.chat_thread.connection_lost.connect(self.handle_connection_lost)
+        self.chat_thread.file_received.connect(self.handle_file_received)
+        self.chat_thread.file_offered.connect(self.handle_file_offered)
+        self.chat_thread.transfer_progress.connect(self.handle_transfer_progress)
+        self.chat_thread.rtt_measured.connect(self.handle_rtt)
+        self.chat_thread.start()
+
     def send_message(self):
         message = self.message_input.text().strip()
         if message:
@@ -195,24 +283,30 @@ class Sigmal(QWidget):
                 message_with_color = f"{self.nickname}: {formatted_message}|COLOR={self.message_color}"
                 self.chat_thread.send_message(message_with_color)
                 self.display_message(f"{self.nickname}: {formatted_message}", self.message_color, is_html=True)
-                self.chat_history.append(f"{self.nickname}: {formatted_message}")
             self.message_input.clear()
 
+    def start_metrics_dump(self):
+        """Write the metrics in Prometheus format to the configured file, if there is one."""
+        metrics = self.config.get("metrics", {})
+        if not metrics.get("prometheus_file"):
+            return None
+        return dump_periodically(metrics["prometheus_file"], metrics.get("dump_interval_seconds", 15))
+
+    def open_journal(self):
+        """Start the chat journal, which writes every displayed message to the logs folder."""
+        journal = self.config.get("journal", {})
+        return ChatJournal(
+            folder=journal.get("folder", "logs"),
+            max_bytes=int(journal.get("max_mb", 8) * 1024 * 1024),
+            max_age=journal.get("max_age_hours", 24) * 3600,
+            keep=journal.get("keep", 30),
+        )
+
     def save_chat_history(self):
-        """Save the chat history to a log file."""
+        """Make sure the chat journal is on disk and show where it is."""
         try:
-            # Ensure the 'logs' directory exists
-            os.makedirs('logs', exist_ok=True)
-
-            # Generate a unique log file name based on the current date and time
-            timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
-            log_filename = f'logs/log-{timestamp}.txt'
-
-            # Save chat history to the log file
-            with open(log_filename, 'w') as log_file:
-                log_file.write("\n".join(self.chat_history))
-
-            self.display_message(f"Chat history saved to {log_filename}.", self.config['colors']['system_message_color'])
+            log_filename = self.journal.sync()
+            self.display_message(f"Chat history is saved to {log_filename}.", self.config['colors']['system_message_color'])
         except Exception as e:
             self.display_message(f"Error saving chat history: {e}", "red")
 
@@ -229,35 +323,105 @@ class Sigmal(QWidget):
             f"background-color: {self.config['colors']['background']}; color: {self.config['colors']['text']};"
         )
 
-    def display_message(self, message, color="white", is_html=False):
-        if "|COLOR=" in message:
-            parts = message.split("|COLOR=")
-            message = parts[0]
-            color = parts[1].strip() if len(parts) > 1 else color
+    def schedule_ingest(self):
+        if not self.ingest_timer.isActive():
+            self.ingest_timer.start()
 
-        # Apply color and format for display
-        colored_message = f'<span style="color:{color}">{message}</span>'
-        self.chat_display.insertHtml(colored_message + "<br>")
-        self.chat_history.append(message)
+    def drain_messages(self, limit=INGEST_BATCH):
+        """Render the messages the chat thread received since the last frame."""
+        if not self.chat_thread:
+            return
+        messages = self.chat_thread.take_messages(limit)
+        if messages:
+            self.display_messages(messages)
+        if self.chat_thread.inbox:
+            self.schedule_ingest()
+
+    def display_message(self, message, color="white", is_html=False):
+        # Behind what already arrived, so lines keep their order and the
+        # drain still renders at most INGEST_BATCH of them per frame
+        if self.chat_thread and self.chat_thread.inbox:
+            if "|COLOR=" not in message:
+                message = f"{message}|COLOR={color}"
+            self.chat_thread.inbox.append(message)
+            self.schedule_ingest()
+            return
+        self.display_messages([message], color)
+
+    def display_messages(self, messages, color="white"):
+        """Render a batch of messages with one chat log update and at most one sound."""
+        started = time.perf_counter()
+        lines = []
+        play_sound = False
+        for message in messages:
+            message_color = color
+            if "|COLOR=" in message:
+                parts = message.split("|COLOR=")
+                message = parts[0]
+                message_color = parts[1].strip() if len(parts) > 1 else color
+
+            # Apply color and format for display
+            lines.append(f'<span style="color:{message_color}">{message}</span>')
+            self.journal.append(message)
+            if "Connected" not in message:
+                play_sound = True
+        self.chat_display.append_rows(lines)
+        METRICS.since("render", started)
+        METRICS.count("messages_rendered", len(messages))
 
         # Play sound if a new message is received and sound is enabled
-        if "Connected" not in message and self.sound_enabled:
+        now = time.monotonic()
+        # The sounds are only loaded once the window is shown
+        if play_sound and self.sound_enabled and self.message_sound is not None and now - self.last_sound >= SOUND_INTERVAL:
+            self.last_sound = now
+            started = time.perf_counter()
             self.message_sound.play()
+            METRICS.since("sound", started)
 
     def handle_file_received(self, file_path, filename):
         """Handle a received file and display a download link."""
-        download_link = f'<a href="download://{filename}|{file_path}" download="{filename}">Download {filename}</a>'
+        file_url = QUrl.fromLocalFile(os.path.abspath(file_path)).toString()
+        download_link = f'<a href="{file_url}">Open {filename}</a>'
         self.display_message(f"File received: {download_link}", self.config['colors']['system_message_color'])
 
+    def handle_file_offered(self, tid, filename, size):
+        """Show an offered file with a link that downloads it in the background."""
+        download_link = f'<a href="transfer://accept/{tid}">Download {html.escape(filename)}</a>'
+        self.display_message(
+            f"File offered: {download_link} ({format_size(size)}, id {tid[:8]})",
+            self.config['colors']['system_message_color'],
+        )
+
+    def handle_transfer_progress(self, snapshots):
+        """Update the transfer status line from a batch of progress snapshots."""
+        from src.transfer_manager import FINAL_STATES
+
+        for snapshot in snapshots:
+            if snapshot["state"] in FINAL_STATES:
+                self.transfers.pop(snapshot["key"], None)
+            else:
+                self.transfers[snapshot["key"]] = snapshot
+        lines = []
+        for snapshot in self.transfers.values():
+            arrow = "\u2193" if snapshot["direction"] == "down" else "\u2191"
+            percent = snapshot["done"] * 100 // snapshot["total"] if snapshot["total"] else 100
+            line = f"{arrow} {snapshot['id'][:8]} {snapshot['name']} {percent}%"
+            if snapshot["state"] != "active":
+                line += f" ({snapshot['state']})"
+            else:
+                line += f" {format_size(snapshot['rate'])}/s"
+                if snapshot["eta"] is not None:
+                    minutes, seconds = divmod(int(snapshot["eta"]), 60)
+                    line += f" ETA {minutes}:{seconds:02d}"
+            lines.append(line)
+        self.transfer_status.setText("\n".join(lines))
+        self.transfer_status.setVisible(bool(lines))
+
     def handle_link_click(self, url):
         """Handle link clicks manually to prevent chat clearing."""
-        if url.scheme() == "download":
-            # Extract filename and size from URL
-            parsed_url = urlparse(url.toString())
-            filename, filesize = parsed_url.path.split('|')
-            filename = unquote(filename)
-            filesize = int(filesize)
-            self.chat_thread.receive_file(filename, filesize)
+        if url.scheme() == "transfer":
+            # Downloads run on the chat thread, the click only starts them
+            self.chat_thread.transfer_command(url.host(), url.path().strip("/"))
         elif url.isValid():
             webbrowser.open(url.toString())
         return
@@ -266,11 +430,27 @@ class Sigmal(QWidget):
         url_regex = r'(https?://\S+)'
         return re.sub(url_regex, r'<a href="\1" title="\1">\1</a>', text)
 
+    def handle_rtt(self, peer, srtt, jitter):
+        """Show the latest round trip time in the title bar, and which client it is to on a host."""
+        to = f" to {peer}" if self.is_host else ""
+        self.setWindowTitle(f"{WINDOW_TITLE} - round trip{to} {srtt * 1000:.1f} ± {jitter * 1000:.1f} ms")
+
     def handle_connection_lost(self):
+        self.setWindowTitle(WINDOW_TITLE)
         self.display_message("Connection lost.", self.config['colors']['system_message_color'])
-        if self.sound_enabled:
+        if self.sound_enabled and self.connection_lost_sound is not None:
             self.connection_lost_sound.play()
 
+    def closeEvent(self, event):
+        if self.metrics_dump:
+            self.metrics_dump.set()
+        self.journal.close()
+        if self.store:
+            self.store.close()
+        if self.spool:
+            self.spool.close()
+        super().closeEvent(event)
+
     def toggle_fullscreen(self):
         """Toggle fullscreen mode on and off."""
         if self.isFullScreen():
@@ -283,9 +463,15 @@ class Sigmal(QWidget):
 
 if __name__ == "__main__":
     try:
+        profile = StartupProfile(STARTED, enabled="--profile-startup" in sys.argv)
+        profile.mark("imports")
         app = QApplication(sys.argv)
-        window = Sigmal()
+        profile.mark("QApplication")
+        window = Sigmal(profile)
         window.show()
+        app.processEvents()
+        profile.mark("first paint")
+        QTimer.singleShot(0, window.finish_startup)
         sys.exit(app.exec_())
     except Exception as e:
         print(f"An error occurred: {e}")
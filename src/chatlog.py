@@ -0,0 +1,272 @@
+import json
+import tempfile
+from array import array
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QPointF, QSize, QTimer, QUrl, pyqtSignal
+from PyQt5.QtGui import QAbstractTextDocumentLayout, QKeySequence, QPalette, QTextDocument
+from PyQt5.QtWidgets import QAbstractItemView, QApplication, QListView, QStyle, QStyledItemDelegate
+
+# The view lays out every row of the model on each change, so the model only
+# holds a fixed window of lines; the rest are paged in from the spill file.
+WINDOW_SIZE = 400
+PAGE_SIZE = 100  # lines paged in per scroll step
+
+
+class ChatSpill:
+    """Every line of the chat log, appended to a temporary file.
+
+    Only a file offset per line stays in memory, so the model can drop lines
+    and read them back when the user scrolls to them.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array("Q")
+        self.end = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, lines):
+        self.file.seek(self.end)
+        for line in lines:
+            data = json.dumps(line).encode("utf-8") + b"\n"
+            self.offsets.append(self.end)
+            self.file.write(data)
+            self.end += len(data)
+
+    def read(self, start, count):
+        self.file.seek(self.offsets[start])
+        return [json.loads(self.file.readline()) for _ in range(count)]
+
+    def compact(self, keep):
+        """Forget all but the last `keep` lines, returning how many were dropped."""
+        dropped = len(self.offsets) - keep
+        start = self.offsets[dropped]
+        self.file.seek(start)
+        data = self.file.read(self.end - start)
+        self.file.close()
+        self.file = tempfile.TemporaryFile()
+        self.file.write(data)
+        self.offsets = array("Q", (offset - start for offset in self.offsets[dropped:]))
+        self.end -= start
+        return dropped
+
+    def close(self):
+        self.file.close()
+
+
+class ChatModel(QAbstractListModel):
+    """A window of at most WINDOW_SIZE lines over the last `scrollback` lines of the chat log."""
+
+    def __init__(self, scrollback):
+        super().__init__()
+        self.scrollback = max(scrollback, WINDOW_SIZE)
+        self.spill = ChatSpill()
+        self.rows = []  # HTML of the lines in the window
+        self.sizes = []  # measured size of each row, None until needed
+        self.first = 0  # spill index of rows[0]
+        self.measure = None  # html -> QSize, set by the view
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.SizeHintRole:
+            # Asked for every row on each layout, so sizes are measured once and kept
+            row = index.row()
+            size = self.sizes[row]
+            if size is None:
+                size = self.sizes[row] = self.measure(self.rows[row])
+            return size
+        if role == Qt.DisplayRole and index.isValid():
+            return self.rows[index.row()]
+        return None
+
+    def forget_sizes(self):
+        self.sizes = [None] * len(self.rows)
+
+    def at_end(self):
+        return self.first + len(self.rows) == len(self.spill)
+
+    def append_rows(self, lines, follow):
+        """Store new lines, and show them if the window is at the end of the log."""
+        at_end = self.at_end()
+        self.spill.append(lines)
+        if len(self.spill) > 2 * self.scrollback and self.first >= len(self.spill) - self.scrollback:
+            self.first -= self.spill.compact(self.scrollback)
+        if not at_end or (not follow and len(self.rows) >= WINDOW_SIZE):
+            return  # the user is reading older lines, they load on scroll
+        lines = lines[-WINDOW_SIZE:]
+        skipped = len(self.spill) - len(lines) - (self.first + len(self.rows))
+        if skipped:
+            self.drop_front(len(self.rows))
+            self.first += skipped
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(lines) - 1)
+        self.rows.extend(lines)
+        self.sizes.extend([None] * len(lines))
+        self.endInsertRows()
+        if len(self.rows) > WINDOW_SIZE:
+            self.drop_front(len(self.rows) - WINDOW_SIZE)
+
+    def drop_front(self, count):
+        if count:
+            self.beginRemoveRows(QModelIndex(), 0, count - 1)
+            del self.rows[:count]
+            del self.sizes[:count]
+            self.first += count
+            self.endRemoveRows()
+
+    def drop_back(self, count):
+        if count:
+            self.beginRemoveRows(QModelIndex(), len(self.rows) - count, len(self.rows) - 1)
+            del self.rows[-count:]
+            del self.sizes[-count:]
+            self.endRemoveRows()
+
+    def load_older(self):
+        """Read a page of lines before the window back from the spill file."""
+        count = min(PAGE_SIZE, self.first - max(len(self.spill) - self.scrollback, 0))
+        if count:
+            lines = self.spill.read(self.first - count, count)
+            self.beginInsertRows(QModelIndex(), 0, count - 1)
+            self.rows[:0] = lines
+            self.sizes[:0] = [None] * count
+            self.first -= count
+            self.endInsertRows()
+            self.drop_back(max(len(self.rows) - WINDOW_SIZE, 0))
+        return count
+
+    def load_newer(self):
+        """Read a page of lines after the window back from the spill file."""
+        end = self.first + len(self.rows)
+        count = min(PAGE_SIZE, len(self.spill) - end)
+        if count:
+            lines = self.spill.read(end, count)
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + count - 1)
+            self.rows.extend(lines)
+            self.sizes.extend([None] * count)
+            self.endInsertRows()
+            self.drop_front(max(len(self.rows) - WINDOW_SIZE, 0))
+        return count
+
+    def clear(self):
+        self.beginResetModel()
+        self.spill.close()
+        self.spill = ChatSpill()
+        self.rows = []
+        self.sizes = []
+        self.first = 0
+        self.endResetModel()
+
+
+class ChatDelegate(QStyledItemDelegate):
+    """Draws a line of chat HTML with one shared QTextDocument."""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self.document = QTextDocument()
+        self.document.setDocumentMargin(2)
+
+    def prepare(self, html, width):
+        self.document.setHtml(html)
+        self.document.setTextWidth(width)
+        return self.document
+
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        painter.translate(option.rect.topLeft())
+        document = self.prepare(index.data(), option.rect.width())
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.Text, option.palette.color(QPalette.Text))
+        document.documentLayout().draw(painter, context)
+        painter.restore()
+
+    def measure(self, html, width):
+        return QSize(width, int(self.prepare(html, width).size().height()))
+
+    def anchor_at(self, html, width, pos):
+        return self.prepare(html, width).documentLayout().anchorAt(QPointF(pos))
+
+    def plain_text(self, html):
+        self.document.setHtml(html)
+        return self.document.toPlainText()
+
+
+class ChatLog(QListView):
+    """Chat display that only lays out and paints the lines in view.
+
+    Memory and the cost of a new line stay the same however long the session
+    runs: the model holds at most WINDOW_SIZE lines, and the rest of the last
+    `scrollback` lines are read back from the spill file on scroll.
+    """
+
+    anchorClicked = pyqtSignal(QUrl)
+
+    def __init__(self, scrollback=10000):
+        super().__init__()
+        self.chat_model = ChatModel(scrollback)
+        self.setModel(self.chat_model)
+        self.delegate = ChatDelegate(self)
+        self.setItemDelegate(self.delegate)
+        self.chat_model.measure = lambda html: self.delegate.measure(html, self.viewport().width())
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        # A fixed scroll bar keeps the text width, and so the measured row sizes, stable
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.setResizeMode(QListView.Adjust)
+        self.setWordWrap(True)
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
+        # Scrolling to the bottom lays out every row, so do it once per event loop pass
+        self.follow_timer = QTimer(self)
+        self.follow_timer.setSingleShot(True)
+        self.follow_timer.setInterval(0)
+        self.follow_timer.timeout.connect(self.scrollToBottom)
+
+    def append_rows(self, lines):
+        bar = self.verticalScrollBar()
+        follow = self.follow_timer.isActive() or bar.value() >= bar.maximum()
+        self.chat_model.append_rows(lines, follow)
+        if follow:
+            self.follow_timer.start()
+
+    def clear(self):
+        self.chat_model.clear()
+
+    def resizeEvent(self, event):
+        self.chat_model.forget_sizes()
+        super().resizeEvent(event)
+
+    def scrolled(self, value):
+        """Page lines in from the spill file when the view reaches either end of the window."""
+        bar = self.verticalScrollBar()
+        model = self.chat_model
+        if value == bar.minimum() and model.first > max(len(model.spill) - model.scrollback, 0):
+            top = model.first
+            model.load_older()
+            self.scrollTo(model.index(top - model.first), QAbstractItemView.PositionAtTop)
+        elif value == bar.maximum() and not model.at_end():
+            bottom = model.first + len(model.rows) - 1
+            model.load_newer()
+            self.scrollTo(model.index(bottom - model.first), QAbstractItemView.PositionAtBottom)
+
+    def mouseReleaseEvent(self, event):
+        index = self.indexAt(event.pos())
+        if index.isValid() and event.button() == Qt.LeftButton:
+            rect = self.visualRect(index)
+            anchor = self.delegate.anchor_at(index.data(), rect.width(), event.pos() - rect.topLeft())
+            if anchor:
+                self.anchorClicked.emit(QUrl(anchor))
+        super().mouseReleaseEvent(event)
+
+    def keyPressEvent(self, event):
+        if event.matches(QKeySequence.Copy):
+            rows = sorted(index.row() for index in self.selectedIndexes())
+            text = "\n".join(self.delegate.plain_text(self.chat_model.rows[row]) for row in rows)
+            QApplication.clipboard().setText(text)
+            return
+        super().keyPressEvent(event)
@@ -1,120 +1,278 @@
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization, hashes
+import hashlib
 import json
+import os
 import re
-import base64
+import struct
+import threading
+import time
 
+from src.compression import pack_message, unpack_message
+from src.metrics import timed
+from src.protocol import BATCH_ENTRY, MAX_FRAME_SIZE, ProtocolError
 
-def generate_key_pair():
-    """Generate RSA key pair."""
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-    public_key = private_key.public_key()
-    return private_key, public_key
+NONCE_SIZE = 12  # AES-GCM nonce, freshly generated for every message
+KEY_SIZE = 32  # raw Ed25519 and X25519 public keys
+SIGNATURE_SIZE = 64
+# Sealed file data is never sent twice under a nonce: it is the channel and the
+# frame's sequence number on that channel, under a key for each direction
+FILE_NONCE = struct.Struct("!IQ")
+TICKET_TIME = struct.Struct("!Q")  # when a resumption ticket was issued
+# Room messages are end to end: the relay only sees the room id in front
+ROOM_ID_SIZE = 32
+ROOM_COUNTER = struct.Struct("!Q")  # per sender, only goes up, so the relay cannot replay messages
+ROOM_SCRYPT_N = 2 ** 14  # cost of guessing a room's passphrase
+IDENTITY_FILE = os.path.join("keys", "identity.pem")
+_identity_lock = threading.Lock()
 
 
-def serialize_key(key, private=False):
-    """Serialize the public or private key to send over the network."""
-    if private:
-        return key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
+def load_identity(path=IDENTITY_FILE):
+    """Load the long-term Ed25519 identity key, creating it on first use."""
+    with _identity_lock:
+        try:
+            with open(path, "rb") as f:
+                return serialization.load_pem_private_key(f.read(), password=None)
+        except FileNotFoundError:
+            pass
+        identity = Ed25519PrivateKey.generate()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(identity.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption(),
+            ))
+        return identity
+
+
+def raw_public_key(key):
+    """Raw 32 byte public key of an Ed25519 or X25519 private key."""
+    return key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw,
+    )
+
+
+def fingerprint(identity_public):
+    """Short, human comparable fingerprint of a raw identity public key."""
+    digest = hashlib.sha256(identity_public).hexdigest()[:32]
+    return " ".join(digest[i:i + 4] for i in range(0, len(digest), 4))
+
+
+@timed("keygen")
+def generate_ephemeral_key():
+    """Generate a one-off X25519 key for a single session."""
+    return X25519PrivateKey.generate()
+
+
+def encode_hello(identity, ephemeral):
+    """Handshake message: identity key, ephemeral key, and the identity's signature over the latter."""
+    ephemeral_public = raw_public_key(ephemeral)
+    return raw_public_key(identity) + ephemeral_public + identity.sign(ephemeral_public)
+
+
+def decode_hello(data):
+    """Check a handshake message and return (identity public key, ephemeral public key)."""
+    if len(data) != 2 * KEY_SIZE + SIGNATURE_SIZE:
+        raise ValueError("Handshake message has the wrong size.")
+    identity_public, ephemeral_public = data[:KEY_SIZE], data[KEY_SIZE:2 * KEY_SIZE]
+    try:
+        Ed25519PublicKey.from_public_bytes(identity_public).verify(data[2 * KEY_SIZE:], ephemeral_public)
+    except InvalidSignature:
+        raise ValueError("Handshake signature is invalid.")
+    return identity_public, ephemeral_public
+
+
+@timed("key_agreement")
+def derive_session_key(ephemeral, remote_ephemeral_public, host_side):
+    """Agree on the 256-bit session key from both ephemeral keys with X25519 and HKDF."""
+    shared = ephemeral.exchange(X25519PublicKey.from_public_bytes(remote_ephemeral_public))
+    own_public = raw_public_key(ephemeral)
+    if host_side:
+        transcript = own_public + remote_ephemeral_public
     else:
-        return key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        )
+        transcript = remote_ephemeral_public + own_public
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"sigmal session key" + transcript,
+    ).derive(shared)
 
 
-def deserialize_key(key_data):
-    """Deserialize a public key received over the network."""
-    return serialization.load_pem_public_key(key_data)
+def session_cipher(session_key):
+    """Create the AEAD cipher used for every message of a session."""
+    return AESGCM(session_key)
 
 
-def is_url(text):
-    """Check if the given text is a URL."""
-    url_regex = re.compile(
-        r'(https?://\S+|www\.\S+)',
-        re.IGNORECASE
-    )
-    return re.match(url_regex, text) is not None
-
-
-def split_message(message):
-    """Split the message into URLs and non-URLs while preserving spaces."""
-    parts = re.split(r'(\s+)', message)
-    encrypted_parts = []
-    non_encrypted_parts = []
-    
-    for part in parts:
-        if is_url(part):
-            non_encrypted_parts.append(part)
-        else:
-            encrypted_parts.append(part)
-
-    return encrypted_parts, non_encrypted_parts
-
-
-def encrypt_message(message, public_key):
-    """Encrypt a message using the remote's public key, skipping URLs."""
-    encrypted_parts, non_encrypted_parts = split_message(message)
-    encrypted_message = []
-
-    for part in encrypted_parts:
-        if part.strip() != '':  # Encrypt non-space parts only
-            encrypted = public_key.encrypt(
-                part.encode('utf-8'),
-                padding.OAEP(
-                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                    algorithm=hashes.SHA256(),
-                    label=None,
-                ),
-            )
-            encrypted_message.append(base64.b64encode(encrypted).decode('utf-8'))
-        else:
-            # Preserve spaces in the encrypted message list
-            encrypted_message.append(' ')  
-
-    # Use JSON to structure the message
-    return json.dumps({
-        'encrypted': encrypted_message,
-        'plaintext': non_encrypted_parts
-    })
-
-
-def decrypt_message(encrypted_message, private_key):
-    """Decrypt a message using the private key, keeping URLs intact."""
+def file_ciphers(session_key, host_side):
+    """Derive the ciphers file data is sealed with, one per direction, as (sending, receiving)."""
+    ciphers = {}
+    for direction in (b"host", b"client"):
+        ciphers[direction] = AESGCM(HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b"sigmal file data from " + direction,
+        ).derive(session_key))
+    if host_side:
+        return ciphers[b"host"], ciphers[b"client"]
+    return ciphers[b"client"], ciphers[b"host"]
+
+
+@timed("chunk_seal")
+def seal_chunk(data, cipher, channel, seq, associated_data):
+    """Encrypt one frame of file data under the nonce of its channel and sequence number."""
+    return cipher.encrypt(FILE_NONCE.pack(channel, seq), data, associated_data)
+
+
+@timed("chunk_unseal")
+def unseal_chunk(data, cipher, channel, seq, associated_data):
+    """Decrypt and authenticate one frame of file data sealed with seal_chunk."""
+    try:
+        return cipher.decrypt(FILE_NONCE.pack(channel, seq), data, associated_data)
+    except InvalidTag:
+        raise ValueError("file data failed authentication.")
+
+
+def seal(data, cipher, associated_data=None):
+    """Encrypt bytes with an AEAD cipher under a fresh nonce."""
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + cipher.encrypt(nonce, data, associated_data)
+
+
+def unseal(data, cipher, associated_data=None):
+    """Decrypt and authenticate bytes encrypted with seal. Raises ValueError if they were tampered with."""
+    try:
+        return cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], associated_data)
+    except InvalidTag:
+        raise ValueError("message failed authentication.")
+
+
+@timed("encrypt")
+def encrypt_message(message, cipher, associated_data=None, compress=False):
+    """Encrypt a message with the session cipher under a fresh nonce, deflating it first if compress is set."""
+    return seal(pack_message(message, compress), cipher, associated_data)
+
+
+@timed("decrypt")
+def decrypt_message(data, cipher, associated_data=None):
+    """Decrypt and authenticate a message encrypted with encrypt_message."""
+    return unpack_message(unseal(data, cipher, associated_data))
+
+
+def encrypt_batch(messages, cipher, compress=False):
+    """Encrypt (sequence number, message) pairs together, for replaying many at once."""
+    entries = []
+    for seq, message in messages:
+        packed = pack_message(message, compress)
+        entries += [BATCH_ENTRY.pack(seq, len(packed)), packed]
+    return seal(b"".join(entries), cipher, b"sigmal chat batch")
+
+
+def decrypt_batch(data, cipher):
+    """Return the (sequence number, message) pairs of a batch encrypted with encrypt_batch."""
+    data = unseal(data, cipher, b"sigmal chat batch")
+    messages = []
+    offset = 0
+    while offset < len(data):
+        seq, length = BATCH_ENTRY.unpack_from(data, offset)
+        offset += BATCH_ENTRY.size
+        messages.append((seq, unpack_message(data[offset:offset + length])))
+        offset += length
+    return messages
+
+
+def generate_ticket_key():
+    """Random key the host encrypts its resumption tickets with."""
+    return AESGCM(AESGCM.generate_key(bit_length=256))
+
+
+def issue_ticket(ticket_key, secret, identity_public):
+    """Pack a resumption secret and the client's identity into a ticket only the host can open."""
+    plaintext = secret + identity_public + TICKET_TIME.pack(int(time.time()))
+    return seal(plaintext, ticket_key, b"sigmal ticket")
+
+
+def open_ticket(ticket_key, ticket, lifetime):
+    """Return (secret, identity public key) of a valid ticket, or None if it is forged or expired."""
+    try:
+        plaintext = unseal(ticket, ticket_key, b"sigmal ticket")
+    except ValueError:
+        return None
+    if len(plaintext) != 2 * KEY_SIZE + TICKET_TIME.size:
+        return None
+    (issued,) = TICKET_TIME.unpack_from(plaintext, 2 * KEY_SIZE)
+    if not 0 <= time.time() - issued <= lifetime:
+        return None
+    return plaintext[:KEY_SIZE], plaintext[KEY_SIZE:2 * KEY_SIZE]
+
+
+def derive_resumed_key(secret, client_nonce, host_nonce):
+    """Session key of a resumed session, fresh for every resumption."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"sigmal resumed session key" + client_nonce + host_nonce,
+    ).derive(secret)
+
+
+def room_keys(name, passphrase=""):
+    """Derive the id and the cipher of a relay room from its name and passphrase.
+
+    Everyone who joins with the same name and passphrase ends up in the same
+    room; the relay only learns the id, which reveals neither.
+    """
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    secret = Scrypt(
+        salt=b"sigmal room " + name.encode("utf-8"), length=32, n=ROOM_SCRYPT_N, r=8, p=1,
+    ).derive(passphrase.encode("utf-8"))
+    keys = [HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(secret)
+            for info in (b"sigmal room id", b"sigmal room messages")]
+    return keys[0], AESGCM(keys[1])
+
+
+@timed("room_seal")
+def seal_room_message(message, room_id, cipher, identity, counter):
+    """Sign a chat message with the identity key and encrypt it for a room, with the room id in front."""
+    packed = pack_message(message, True)
+    counter = ROOM_COUNTER.pack(counter)
+    signature = identity.sign(room_id + counter + packed)
+    return room_id + seal(raw_public_key(identity) + counter + signature + packed, cipher, room_id)
+
+
+@timed("room_open")
+def open_room_message(payload, cipher):
+    """Decrypt a room message and check its signature, returning (sender identity key, counter, message)."""
+    room_id = bytes(payload[:ROOM_ID_SIZE])
+    plaintext = unseal(payload[ROOM_ID_SIZE:], cipher, room_id)
+    header_size = KEY_SIZE + ROOM_COUNTER.size + SIGNATURE_SIZE
+    if len(plaintext) <= header_size:
+        raise ValueError("room message is too short.")
+    if len(plaintext) > MAX_FRAME_SIZE:
+        raise ValueError("room message is too large.")
+    identity_public = plaintext[:KEY_SIZE]
+    counter = plaintext[KEY_SIZE:KEY_SIZE + ROOM_COUNTER.size]
+    packed = plaintext[header_size:]
+    try:
+        Ed25519PublicKey.from_public_bytes(identity_public).verify(
+            plaintext[KEY_SIZE + ROOM_COUNTER.size:header_size], room_id + counter + packed)
+    except InvalidSignature:
+        raise ValueError("room message signature is invalid.")
     try:
-        # Parse the JSON structure
-        message_structure = json.loads(encrypted_message)
-        encrypted_parts = message_structure['encrypted']
-        non_encrypted_parts = message_structure['plaintext']
-
-        decrypted_message = []
-
-        for encrypted_part in encrypted_parts:
-            if encrypted_part == ' ':
-                decrypted_message.append(' ')  # Add space back
-            else:
-                decrypted = private_key.decrypt(
-                    base64.b64decode(encrypted_part),
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None,
-                    ),
-                )
-                decrypted_message.append(decrypted.decode('utf-8'))
-
-        # Combine decrypted parts and keep plaintext URLs intact
-        combined_message = ''.join(decrypted_message)
-        formatted_plaintext = ''.join(non_encrypted_parts)
-        
-        return combined_message + formatted_plaintext
-
-    except Exception as e:
-        return f"Decryption error: {e}"
+        message = unpack_message(packed)  # inflates to a frame's worth at most
+    except ProtocolError as e:
+        # Only this member's message is bad, the connection to the relay is fine
+        raise ValueError(f"room message is corrupt: {e}")
+    return identity_public, ROOM_COUNTER.unpack(counter)[0], message
 
 
 def make_urls_clickable(text):
@@ -2,7 +2,11 @@
 
 from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtWidgets import QFileDialog  # Ensure QFileDialog is imported
-from src.core import ChatThread  # Ensure QFileDialog is imported
+import html
+import os
+from datetime import datetime
+from src.metrics import METRICS, SamplingProfiler
+from src.store import SEARCH_PAGE
 # Other necessary imports if there are any
 
 def handle_command(app, command):
@@ -18,15 +22,28 @@ def handle_command(app, command):
             "Available commands:\n"
             "/clear - Clear the chat screen\n"
             "/exit - Exit the application\n"
-            "/save - Save chat history to a log file\n"
+            "/save - Flush the chat journal to disk and show where it is\n"
             "/help - Display this help message\n"
             "/reload config - Reload configuration from config.json\n"
             "/reconnect - Reconnect to the current session\n"
             "/nick <new_nickname> - Change your nickname\n"
             "/color <#HEX> - Change your text color\n"
             "/toggle sound - Toggle sound on/off\n"
+            "/toggle profiler - Start sampling where time goes, or stop and show it\n"
+            "/stats - Show counters and latencies of the hot paths, /stats reset to start over\n"
             "/transfer - Open file selection to send a file\n"
+            "/transfers - List offered and running transfers\n"
+            "/accept <id> - Download an offered file\n"
+            "/pause <id> - Pause a transfer\n"
+            "/resume <id> - Resume a paused transfer\n"
+            "/cancel <id> - Cancel a transfer or decline an offer\n"
             "/fullscreen - Toggle fullscreen mode on/off\n"  # Added fullscreen command
+            "/fingerprint - Show your identity fingerprint to compare with your peers\n"
+            "/queue - Show how much is waiting to be sent to each peer\n"
+            "/search <query> - Search all past messages, word* matches a prefix\n"
+            "/join <room> [passphrase] - Join an end-to-end encrypted room on the host, typed chat goes there\n"
+            "/leave <room> - Leave a room\n"
+            "/more - Show the next page of search results\n"
         )
         app.display_message(help_message, app.config['colors']['system_message_color'])
     elif command == "/reload config":
@@ -44,8 +61,35 @@ def handle_command(app, command):
         toggle_option(app, option)
     elif command == "/fullscreen":  # Handle fullscreen command
         app.toggle_fullscreen()
+    elif command == "/fingerprint":
+        app.display_message(f"Your fingerprint: {app.chat_thread.fingerprint()}", app.config['colors']['system_message_color'])
+    elif command == "/queue":
+        app.chat_thread.queue_report()
+    elif command == "/stats":
+        app.display_message(METRICS.report(), app.config['colors']['system_message_color'])
+    elif command == "/stats reset":
+        METRICS.reset()
+        app.display_message("Stats reset.", app.config['colors']['system_message_color'])
+    elif command.startswith("/search "):
+        search_messages(app, command.split(" ", 1)[1].strip())
+    elif command == "/more":
+        if app.last_search:
+            query, page = app.last_search
+            search_messages(app, query, page + 1)
+        else:
+            app.display_message("Nothing to show, /search first.", "red")
+    elif command.startswith("/join "):
+        name, _, passphrase = command.split(" ", 1)[1].strip().partition(" ")
+        app.chat_thread.join_room(name, passphrase.strip())
+    elif command.startswith("/leave "):
+        app.chat_thread.leave_room(command.split(" ", 1)[1].strip())
     elif command == "/transfer":
         open_file_dialog(app)
+    elif command == "/transfers":
+        app.chat_thread.transfer_command("list")
+    elif command.split(" ", 1)[0] in ("/accept", "/pause", "/resume", "/cancel"):
+        action, _, tid = command.partition(" ")
+        app.chat_thread.transfer_command(action[1:], tid.strip())
     else:
         app.display_message(f"Unknown command: {command}", "red")
 
@@ -62,17 +106,37 @@ def reconnect_session(app):
     app.display_message("Reconnecting...", app.config['colors']['system_message_color'])
     if app.chat_thread:
         app.chat_thread.stop()
+        app.drain_messages(limit=len(app.chat_thread.inbox))
     if app.is_host:
         port = app.chat_thread.port
-        app.chat_thread = ChatThread(host_mode=True, port=port)
+        app.chat_thread = app.new_chat_thread(host_mode=True, port=port)
     else:
         ip = app.chat_thread.ip
         port = app.chat_thread.port
-        app.chat_thread = ChatThread(host_mode=False, ip=ip, port=port)
-    app.chat_thread.new_message.connect(app.display_message)
-    app.chat_thread.connection_lost.connect(app.handle_connection_lost)
-    app.chat_thread.file_received.connect(app.handle_file_received)
-    app.chat_thread.start()
+        resumption = app.chat_thread.resumption()
+        app.chat_thread = app.new_chat_thread(host_mode=False, ip=ip, port=port, resumption=resumption)
+    app.start_chat_thread()
+
+
+def search_messages(app, query, page=0):
+    """Show a page of past messages matching query, best match first."""
+    try:
+        hits = app.store.search(query, page)
+    except Exception as e:
+        app.display_message(f"Search failed: {e}", "red")
+        return
+    app.last_search = (query, page) if len(hits) > SEARCH_PAGE else None
+    if not hits:
+        app.display_message(f"No {'more ' if page else ''}messages match {html.escape(query)}.", app.config['colors']['system_message_color'])
+        return
+    app.display_message(f"Messages matching {html.escape(query)}, page {page + 1}:", app.config['colors']['system_message_color'])
+    lines = []
+    for timestamp, peer, direction, body, color in hits[:SEARCH_PAGE]:
+        when = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+        lines.append(f'<span style="color:{color or app.config["colors"]["text"]}">[{when}] {body}</span>')
+    if app.last_search:
+        lines.append(f'<span style="color:{app.config["colors"]["system_message_color"]}">More with /more.</span>')
+    app.chat_display.append_rows(lines)
 
 
 def change_nickname(app, new_nick):
@@ -93,10 +157,30 @@ def toggle_option(app, option):
         app.sound_enabled = not app.sound_enabled
         state = "enabled" if app.sound_enabled else "disabled"
         app.display_message(f"Sound {state}.", app.config['colors']['system_message_color'])
+    elif option == "profiler":
+        toggle_profiler(app)
     else:
         app.display_message(f"Unknown toggle option: {option}", "red")
 
 
+def toggle_profiler(app):
+    """Start the sampling profiler, or stop it and show the busiest functions."""
+    if app.profiler is None:
+        app.profiler = SamplingProfiler()
+        app.profiler.start()
+        app.display_message("Profiler started, /toggle profiler again to see the results.", app.config['colors']['system_message_color'])
+        return
+    profiler, app.profiler = app.profiler, None
+    elapsed = profiler.stop()
+    path = os.path.join(app.journal.folder, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt")
+    try:
+        profiler.write_collapsed(path)
+        saved = f"Collapsed stacks of {elapsed:.1f} s saved to {path}."
+    except OSError as e:
+        saved = f"Could not save the stacks: {e}"
+    app.display_message(f"{html.escape(profiler.report())}\n{saved}", app.config['colors']['system_message_color'])
+
+
 def open_file_dialog(app):
     """Open a file dialog to select a file for transfer."""
     options = QFileDialog.Options()
@@ -0,0 +1,125 @@
+import lzma
+import zlib
+
+from src.protocol import MAX_FRAME_SIZE, ProtocolError
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib and lzma always work
+    zstandard = None
+
+# Codec ids as sent in compressed file frames
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODEC_IDS = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA, "zstd": CODEC_ZSTD}
+# Preferred first when both sides have them: zstd is fast and compresses well,
+# lzma compresses best but is too slow to keep up with most links
+CODEC_PREFERENCE = ("zstd", "zlib", "lzma")
+
+# A frame is sent compressed only if that saves at least this share of it
+MIN_SAVING = 0.1
+# After a file frame that did not compress, this many frames are sent as they are
+SKIP_FRAMES = 16
+
+# Chat message flags, the first byte of every chat plaintext
+MESSAGE_RAW = 0
+MESSAGE_DEFLATE = 1  # raw deflate with CHAT_DICTIONARY as preset dictionary
+
+# Chat messages are too short to compress on their own, so they start from a
+# dictionary of what they are typically made of. Both sides must use the same
+# bytes: changing them needs a new protocol version.
+CHAT_DICTIONARY = (
+    b'<a href="https://www.youtube.com/watch?v=" title="https://github.com/ <URL></a> '
+    b"File offered: Download File received: Open Offered Downloaded to transfer "
+    b"the and you that this for with have what not but are was just can will "
+    b"yes no ok lol thanks please hello hi how about when where there here "
+    b"[H] [C] [H] Host: [C] Client: |COLOR=red|COLOR=yellow|COLOR=cyan|COLOR=#"
+)
+
+
+def available_codecs(preference="auto"):
+    """Codecs this side offers, best first. preference is "auto", "off" or a codec name to put first."""
+    if preference == "off":
+        return []
+    codecs = [name for name in CODEC_PREFERENCE if name != "zstd" or zstandard]
+    if preference in codecs:
+        codecs.remove(preference)
+        codecs.insert(0, preference)
+    return codecs
+
+
+def choose_codec(host_codecs, client_codecs):
+    """The host's most preferred codec that the client also offers, or None."""
+    for name in host_codecs:
+        if name in client_codecs and name in CODEC_IDS and (name != "zstd" or zstandard):
+            return name
+    return None
+
+
+def pack_message(message, compress):
+    """Encode a chat message, deflated against the dictionary when that makes it smaller."""
+    data = message.encode("utf-8")
+    if compress and len(data) > 16:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=CHAT_DICTIONARY)
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) < len(data):
+            return bytes([MESSAGE_DEFLATE]) + packed
+    return bytes([MESSAGE_RAW]) + data
+
+
+def unpack_message(data):
+    """Decode a chat message, which may not inflate to more than a frame's worth."""
+    flag = data[0]
+    if flag == MESSAGE_RAW:
+        return bytes(data[1:]).decode("utf-8")
+    if flag == MESSAGE_DEFLATE:
+        decompressor = zlib.decompressobj(-15, zdict=CHAT_DICTIONARY)
+        try:
+            result = decompressor.decompress(data[1:], MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"Corrupt compressed message: {e}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ProtocolError("Compressed message is too large or truncated.")
+        return result.decode("utf-8")
+    raise ProtocolError(f"Unknown message encoding {flag}.")
+
+
+def compress_chunk(codec, data):
+    """Compress one frame of file data. Runs in the transfer worker pool."""
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == "lzma":
+        return lzma.compress(data, preset=1)
+    return zlib.compress(data, 1)
+
+
+def decompress_chunk(codec_id, data, size):
+    """Decompress one frame of file data, which must come out at exactly size bytes."""
+    if not 0 < size <= MAX_FRAME_SIZE:
+        raise ProtocolError(f"Compressed file data of {size} bytes is out of bounds.")
+    try:
+        if codec_id == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, size)
+            complete = decompressor.eof and not decompressor.unconsumed_tail
+        elif codec_id == CODEC_LZMA:
+            decompressor = lzma.LZMADecompressor()
+            result = decompressor.decompress(data, size)
+            complete = decompressor.eof
+        elif codec_id == CODEC_ZSTD and zstandard:
+            # Read one byte more than expected, so a frame that claims more comes out too long
+            with zstandard.ZstdDecompressor().stream_reader(bytes(data)) as reader:
+                result = reader.read(size + 1)
+            complete = True
+        else:
+            raise ProtocolError(f"Unknown compression codec {codec_id}.")
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ProtocolError(f"Corrupt compressed file data: {e}")
+    except Exception as e:
+        if zstandard and isinstance(e, zstandard.ZstdError):
+            raise ProtocolError(f"Corrupt compressed file data: {e}")
+        raise
+    if not complete or len(result) != size:
+        raise ProtocolError("Compressed file data does not match its size.")
+    return result
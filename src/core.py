@@ -1,169 +1,102 @@
-import socket
-import os
+import asyncio
+from collections import deque
 from PyQt5.QtCore import QThread, pyqtSignal
 
+from src.engine import (
+    DEAD_PEER_TIMEOUT, HEARTBEAT_INTERVAL, RECONNECT_MAX_DELAY, RELAY_QUEUE, RELAY_STALL_TIME, ChatEngine,
+)
+from src.mux import SEND_HIGH_WATER
+
 
 class ChatThread(QThread):
-    new_message = pyqtSignal(str)
+    """Runs the asyncio ChatEngine on its own thread and bridges its events to Qt signals."""
+
+    messages_ready = pyqtSignal()  # the inbox went from empty to non-empty
     connection_lost = pyqtSignal()
     file_received = pyqtSignal(str, str)  # Signal for file reception with file path and name
-
-    def __init__(self, host_mode=False, ip=None, port=2137):
+    file_offered = pyqtSignal(str, str, object)  # transfer id, file name, size
+    transfer_progress = pyqtSignal(object)  # list of progress snapshots, a few times per second
+    rtt_measured = pyqtSignal(str, float, float)  # peer address, smoothed round trip time and jitter (seconds)
+
+    def __init__(self, host_mode=False, ip=None, port=2137, resumption=None, store=None, spool=None,
+                 send_high_water=SEND_HIGH_WATER, compression="auto", encrypt_files=True,
+                 relay_queue=RELAY_QUEUE, slow_consumers="skip", relay_stall_time=RELAY_STALL_TIME,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, dead_peer_timeout=DEAD_PEER_TIMEOUT,
+                 reconnect_max_delay=RECONNECT_MAX_DELAY):
         super().__init__()
         self.host_mode = host_mode
         self.ip = ip
         self.port = port
-        self.sock = None
-        self.conn = None
-        self.running = True
-        self.private_key = None
-        self.public_key = None
-        self.remote_public_key = None
-        self.generate_keys()
-
-    def generate_keys(self):
-        """Generate RSA key pair."""
-        from src.cipher import generate_key_pair
-
-        self.private_key, self.public_key = generate_key_pair()
+        self.inbox = deque()  # messages from the engine, drained by the GUI once per frame
+        self.notified = False
+        self.engine = ChatEngine(
+            host_mode=host_mode,
+            ip=ip,
+            port=port,
+            on_message=self.queue_message,
+            on_file=self.file_received.emit,
+            on_connection_lost=self.connection_lost.emit,
+            on_offer=self.file_offered.emit,
+            on_progress=self.transfer_progress.emit,
+            on_rtt=self.rtt_measured.emit,
+            resumption=resumption,
+            store=store,
+            spool=spool,
+            send_high_water=send_high_water,
+            compression=compression,
+            encrypt_files=encrypt_files,
+            relay_queue=relay_queue,
+            slow_consumers=slow_consumers,
+            relay_stall_time=relay_stall_time,
+            heartbeat_interval=heartbeat_interval,
+            dead_peer_timeout=dead_peer_timeout,
+            reconnect_max_delay=reconnect_max_delay,
+        )
 
     def run(self):
-        from src.cipher import serialize_key, deserialize_key
-
-        if self.host_mode:
-            try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.bind(("", self.port))
-                self.sock.listen(1)
-                self.new_message.emit(f"Listening on port {self.port}...")
-                self.conn, addr = self.sock.accept()
-                self.new_message.emit(f"Connected by {addr}")
-
-                # Exchange keys
-                self.conn.sendall(serialize_key(self.public_key))
-                remote_key_data = self.conn.recv(1024)
-                self.remote_public_key = deserialize_key(remote_key_data)
-
-                while self.running:
-                    if self.conn is None:
-                        self.connection_lost.emit()
-                        break
-                    data = self.conn.recv(4096)
-                    if not data:
-                        self.connection_lost.emit()
-                        break
-                    self.process_received_data(data)
-            except OSError as e:
-                if e.errno == 98:
-                    self.new_message.emit(f"Port {self.port} already in use. Please restart and try a different port.")
-                else:
-                    self.new_message.emit(f"Error: {e}")
-            except Exception as e:
-                self.new_message.emit(f"Error: {e}")
-                self.connection_lost.emit()
-        else:
-            try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((self.ip, self.port))
-                self.new_message.emit(f"Connected to {self.ip}:{self.port}")
-
-                # Exchange keys
-                remote_key_data = self.sock.recv(1024)
-                self.remote_public_key = deserialize_key(remote_key_data)
-                self.sock.sendall(serialize_key(self.public_key))
-
-                while self.running:
-                    if self.sock is None:
-                        self.connection_lost.emit()
-                        break
-                    data = self.sock.recv(4096)
-                    if not data:
-                        self.connection_lost.emit()
-                        break
-                    self.process_received_data(data)
-            except ConnectionRefusedError:
-                self.new_message.emit("Failed to connect. Server might be down.")
-            except Exception as e:
-                self.new_message.emit(f"Error: {e}")
-                self.connection_lost.emit()
-
-    def process_received_data(self, data):
-        """Process incoming data for message or file."""
-        from src.cipher import decrypt_message
-
-        try:
-            if data.startswith(b"<File>"):
-                # Handle file reception
-                metadata, file_size = data.decode("utf-8").split()[1:3]
-                self.receive_file(metadata, int(file_size))
-            else:
-                # Decode the JSON structure
-                decrypted_message = decrypt_message(data.decode('utf-8'), self.private_key)
-                self.new_message.emit(decrypted_message)
-        except ValueError as ve:
-            self.new_message.emit(f"Decryption error: Incorrect padding or corrupted data. {ve}")
-        except Exception as e:
-            self.new_message.emit(f"Error processing data: {e}")
-
-    def receive_file(self, filename, filesize):
-        """Receive a file from the socket and save it to the transfer folder."""
-        transfer_folder = "transfer"
-        os.makedirs(transfer_folder, exist_ok=True)  # Ensure the transfer folder exists
-        file_path = os.path.join(transfer_folder, filename)
-
-        with open(file_path, "wb") as f:
-            remaining = filesize
-            while remaining > 0:
-                if self.conn:
-                    chunk = self.conn.recv(min(remaining, 4096))
-                else:
-                    chunk = self.sock.recv(min(remaining, 4096))
-                if not chunk:
-                    break
-                f.write(chunk)
-                remaining -= len(chunk)
-
-        self.file_received.emit(file_path, filename)  # Signal that the file has been received
-        self.new_message.emit(f"Downloaded {filename} ({filesize} bytes) to {transfer_folder}")
+        asyncio.run(self.engine.run())
+
+    def queue_message(self, message):
+        """Queue a message for the GUI, signalling it once per batch rather than per message."""
+        self.inbox.append(message)
+        if not self.notified:
+            self.notified = True
+            self.messages_ready.emit()
+
+    def take_messages(self, limit):
+        """Take up to limit queued messages. Called from the GUI thread."""
+        self.notified = False
+        messages = []
+        while self.inbox and len(messages) < limit:
+            messages.append(self.inbox.popleft())
+        return messages
 
     def send_message(self, message):
-        from src.cipher import encrypt_message
-
-        try:
-            full_message = encrypt_message(message, self.remote_public_key).encode('utf-8')
-            
-            if self.host_mode and self.conn:
-                self.conn.sendall(full_message)
-            elif self.sock:
-                self.sock.sendall(full_message)
-        except BrokenPipeError:
-            self.new_message.emit("Connection lost. Unable to send message.")
-        except Exception as e:
-            self.new_message.emit(f"Error sending message: {e}")
+        self.engine.send_message(message)
 
     def send_file(self, filepath):
-        """Send a file over the socket without encryption."""
-        filename = os.path.basename(filepath)
-        filesize = os.path.getsize(filepath)
-        file_header = f"<File> {filename} {filesize}".encode("utf-8")
-        try:
-            if self.host_mode and self.conn:
-                self.conn.sendall(file_header)
-                with open(filepath, "rb") as f:
-                    while chunk := f.read(4096):
-                        self.conn.sendall(chunk)
-            elif self.sock:
-                self.sock.sendall(file_header)
-                with open(filepath, "rb") as f:
-                    while chunk := f.read(4096):
-                        self.sock.sendall(chunk)
-        except Exception as e:
-            self.new_message.emit(f"Error sending file: {e}")
+        self.engine.send_file(filepath)
+
+    def resumption(self):
+        """Ticket state to hand to the next ChatThread, so /reconnect can skip the key exchange."""
+        return self.engine.resumption_state()
+
+    def fingerprint(self):
+        return self.engine.fingerprint()
+
+    def transfer_command(self, action, tid=""):
+        self.engine.transfer_command(action, tid)
+
+    def join_room(self, name, passphrase=""):
+        self.engine.join_room(name, passphrase)
+
+    def leave_room(self, name):
+        self.engine.leave_room(name)
+
+    def queue_report(self):
+        self.engine.queue_report()
 
     def stop(self):
-        self.running = False
-        if self.sock:
-            self.sock.close()
-        if self.conn:
-            self.conn.close()
+        self.engine.stop()
         self.quit()
+        self.wait(2000)
@@ -0,0 +1,208 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+from src.protocol import ProtocolError
+from src.transfer import write_at
+
+# Files smaller than this are sent whole: their signatures would not save much
+DELTA_MIN_SIZE = 1024 * 1024
+DELTA_BLOCK_MIN = 2 * 1024
+DELTA_BLOCK_MAX = 64 * 1024
+DELTA_MAX_BLOCKS = 256 * 1024  # keeps the signatures of huge files within one frame
+# A delta frame carries at most this much literal data, and covers at most this much of the file
+DELTA_LITERAL_MAX = 1024 * 1024
+DELTA_SPAN_MAX = 64 * 1024 * 1024
+# Searching byte by byte for a moved block is slow in Python, so after a search
+# finds nothing the encoder only compares whole blocks for a while, twice as
+# long after every failed search, up to this many blocks
+DELTA_BACKOFF_MAX = 256
+
+ADLER_MOD = 65521
+# Weak rolling checksum (adler32) and strong checksum of a block of the old copy
+SIGNATURE = struct.Struct("!I16s")
+
+# Delta ops rebuild the new file from start to end
+OP_COPY = 1     # old offset, length: copy bytes from the old copy
+OP_LITERAL = 2  # length, then the bytes
+OP_END = 3      # the new file is complete
+COPY = struct.Struct("!BQI")
+LITERAL = struct.Struct("!BI")
+
+
+def block_size_for(filesize):
+    """Pick the block size for an old copy: about the square root of its size, like rsync."""
+    block_size = max(min(math.isqrt(filesize) // 1024 * 1024, DELTA_BLOCK_MAX), DELTA_BLOCK_MIN)
+    return max(block_size, -(-filesize // DELTA_MAX_BLOCKS))
+
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signatures(path, block_size):
+    """Checksums of every block of a file, packed with SIGNATURE.
+
+    This reads the whole file, so run it off the event loop.
+    """
+    signatures = bytearray()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            signatures += SIGNATURE.pack(zlib.adler32(block), strong_checksum(block))
+    return bytes(signatures)
+
+
+class DeltaEncoder:
+    """Describes a file as copies of the receiver's old blocks and literal data, one frame at a time.
+
+    Blocks that did not move are found by comparing block by block. After a
+    block that does not match, the weak checksum is rolled one byte at a time
+    for one block, which finds old blocks shifted by an insertion or deletion.
+    Calls must not overlap; each continues where the previous one stopped.
+    """
+
+    def __init__(self, path, block_size, signatures):
+        self.block_size = block_size
+        self.blocks = {}  # weak checksum -> {strong checksum: block index}
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+            self.blocks.setdefault(weak, {}).setdefault(strong, index)
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.offset = 0  # how far the file has been encoded
+        self.skip = 0  # blocks left to compare before searching byte by byte again
+        self.backoff = 1
+        self.copied = 0  # bytes the receiver copies from its old copy
+
+    def match(self, start, end, weak=None):
+        """Index of the old block holding the bytes from start to end, or None."""
+        candidates = self.blocks.get(zlib.adler32(self.map[start:end]) if weak is None else weak)
+        if candidates:
+            return candidates.get(strong_checksum(self.map[start:end]))
+        return None
+
+    def search(self, start):
+        """Roll the weak checksum over the block after start, returning where an old block begins, or None."""
+        data = self.map
+        block_size = self.block_size
+        if start + block_size >= self.size:
+            return None
+        weak = zlib.adler32(data[start:start + block_size])
+        a, b = weak & 0xFFFF, weak >> 16
+        for position in range(start, min(start + block_size, self.size - block_size)):
+            out, new = data[position], data[position + block_size]
+            a = (a - out + new) % ADLER_MOD
+            b = (b - block_size * out - 1 + a) % ADLER_MOD
+            weak = (b << 16) | a
+            if weak in self.blocks and self.match(position + 1, position + 1 + block_size, weak) is not None:
+                return position + 1
+        return None
+
+    def next_ops(self):
+        """Encode the next stretch of the file.
+
+        Returns (ops, bytes of the file they cover, whether the file is done).
+        """
+        block_size = self.block_size
+        start = self.offset
+        ops = bytearray()
+        literal = start  # where literal data not encoded yet begins
+        copy = None  # [old offset, length] of the copy being extended
+        while self.offset < self.size and self.offset - literal < DELTA_LITERAL_MAX and self.offset - start < DELTA_SPAN_MAX:
+            end = min(self.offset + block_size, self.size)
+            index = self.match(self.offset, end)
+            if index is not None:
+                if literal < self.offset:
+                    ops += LITERAL.pack(OP_LITERAL, self.offset - literal) + self.map[literal:self.offset]
+                if copy and copy[0] + copy[1] == index * block_size:
+                    copy[1] += end - self.offset
+                else:
+                    if copy:
+                        ops += COPY.pack(OP_COPY, *copy)
+                    copy = [index * block_size, end - self.offset]
+                self.copied += end - self.offset
+                self.offset = literal = end
+                self.skip, self.backoff = 0, 1
+                continue
+            if copy:
+                ops += COPY.pack(OP_COPY, *copy)
+                copy = None
+            found = None
+            if self.skip:
+                self.skip -= 1
+            else:
+                found = self.search(self.offset)
+                if found is None:
+                    self.skip = self.backoff
+                    self.backoff = min(self.backoff * 2, DELTA_BACKOFF_MAX)
+            self.offset = found if found is not None else end
+        if copy:
+            ops += COPY.pack(OP_COPY, *copy)
+        if literal < self.offset:
+            ops += LITERAL.pack(OP_LITERAL, self.offset - literal) + self.map[literal:self.offset]
+        done = self.offset >= self.size
+        if done:
+            ops.append(OP_END)
+        return bytes(ops), self.offset - start, done
+
+    def close(self):
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+
+class Patcher:
+    """Rebuilds the new version of a file into its .part file from delta ops.
+
+    Copies come out of the old copy through a memory map, so only the blocks
+    the delta refers to are read.
+    """
+
+    def __init__(self, old_path, file, size):
+        self.old = open(old_path, "rb")
+        self.map = mmap.mmap(self.old.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file = file
+        self.size = size
+        self.offset = 0  # how far the new file has been rebuilt
+        self.copied = 0
+        self.finished = False
+
+    def apply(self, ops):
+        """Apply one frame of ops, returning how many bytes of the new file they wrote."""
+        ops = memoryview(ops)
+        start = self.offset
+        position = 0
+        while position < len(ops):
+            op = ops[position]
+            if op == OP_COPY:
+                _, old_offset, length = COPY.unpack_from(ops, position)
+                position += COPY.size
+                if old_offset + length > len(self.map):
+                    raise ProtocolError("Delta copies past the end of the old file.")
+                data = self.map[old_offset:old_offset + length]
+                self.copied += length
+            elif op == OP_LITERAL:
+                _, length = LITERAL.unpack_from(ops, position)
+                position += LITERAL.size
+                data = ops[position:position + length]
+                position += length
+            elif op == OP_END and position == len(ops) - 1:
+                self.finished = True
+                break
+            else:
+                raise ProtocolError(f"Invalid delta op {op}.")
+            if len(data) != length or self.offset + length > self.size:
+                raise ProtocolError("Delta runs past the end of the file.")
+            data = memoryview(data)
+            while data:
+                written = write_at(self.file, data, self.offset)
+                data = data[written:]
+                self.offset += written
+        return self.offset - start
+
+    def close(self):
+        self.map.close()
+        self.old.close()
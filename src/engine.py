@@ -0,0 +1,1058 @@
+import asyncio
+import html
+import json
+import os
+import random
+import socket
+import time
+
+from src.mux import SEND_HIGH_WATER, Multiplexer
+from src.protocol import (
+    FrameDecoder, ProtocolError, encode_frame, encode_header,
+    CHANNEL_CONTROL, CHANNEL_CHAT, FIRST_TRANSFER_CHANNEL,
+    FRAME_HELLO, FRAME_TICKET, FRAME_CHAT, FRAME_FILE_OFFER, FRAME_FILE_REQUEST,
+    FRAME_FILE_DATA, FRAME_FILE_DONE, FRAME_FILE_CANCEL, FRAME_FILE_PAUSE,
+    FRAME_RESUME, FRAME_RESUMED, FRAME_CODECS, FRAME_FILE_COMPRESSED, FRAME_FILE_SEALED,
+    FRAME_FILE_DELTA, FRAME_FILE_DELTA_REQUEST, FRAME_ROOM_JOIN, FRAME_ROOM_LEAVE, FRAME_ROOM_MESSAGE,
+    FRAME_CHAT_BATCH, FRAME_CHAT_ACK, FRAME_PING, FRAME_PONG, MAX_FRAME_SIZE, PING, ROOM_MEMBERS, SEQUENCE,
+)
+from src.compression import available_codecs, choose_codec, decompress_chunk
+from src.metrics import METRICS
+from src.spool import OutboundSpool
+from src.transfer import COMPRESSED_PREFIX, DATA_PREFIX, DELTA_PREFIX, format_size
+from src.transfer_manager import TransferManager
+
+# Reusable receive buffer for file data, grown while the socket keeps filling it
+FILE_BUFFER_MIN = 256 * 1024
+FILE_BUFFER_MAX = 4 * 1024 * 1024
+# How long a client may resume its session with a ticket (seconds)
+TICKET_LIFETIME = 12 * 3600
+RESUME_NONCE_SIZE = 16
+# Sealed file data frames received ahead of the one being written, decrypting in the worker pool
+SEALED_AHEAD = 4
+# Small frames queued back to back go out in one sendmsg call, up to these limits
+SEND_BATCH_FRAMES = 64
+SEND_BATCH_BYTES = 256 * 1024
+# A relay's peers start with small receive buffers, so thousands of them fit in memory
+RELAY_BUFFER = 16 * 1024
+# Bytes queued for a room member before the messages relayed to it are skipped,
+# and how long it may stay that far behind before it is dropped (seconds)
+RELAY_QUEUE = 256 * 1024
+RELAY_STALL_TIME = 30
+ROOM_ID_SIZE = 32
+# Spooled chat replayed to a peer goes out in batches of about this size
+REPLAY_BATCH_BYTES = 256 * 1024
+# Peers are pinged this often, and given up on when nothing came from them for this long (seconds)
+HEARTBEAT_INTERVAL = 5
+DEAD_PEER_TIMEOUT = 20
+# A client whose session was lost connects again after a delay doubling from
+# the first to the longest, with jitter so the clients of a restarted host spread out (seconds)
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+CONNECT_TIMEOUT = 10
+
+
+async def wait_writable(loop, sock):
+    """Wait until a non-blocking socket can take more data."""
+    writable = loop.create_future()
+    loop.add_writer(sock.fileno(), lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+async def send_buffers(loop, sock, buffers):
+    """Send several buffers, gathered into as few sendmsg calls as the socket allows."""
+    if not hasattr(sock, "sendmsg"):
+        await loop.sock_sendall(sock, b"".join(buffers))
+        return
+    buffers = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    while first < len(buffers):
+        try:
+            sent = sock.sendmsg(buffers[first:])
+        except (BlockingIOError, InterruptedError):
+            await wait_writable(loop, sock)
+            continue
+        # Skip what went out; a partly sent buffer is trimmed to the rest
+        while sent:
+            if sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            else:
+                buffers[first] = buffers[first][sent:]
+                sent = 0
+
+
+class Peer:
+    """One connection: socket, per-peer key state, frame decoder and channel multiplexer."""
+
+    def __init__(self, engine, sock, addr):
+        self.engine = engine
+        self.sock = sock
+        self.addr = addr
+        self.decoder = FrameDecoder(RELAY_BUFFER) if engine.relay else FrameDecoder()
+        self.connected_at = time.perf_counter()  # the handshake is timed from here
+        self.ephemeral_key = None  # X25519 key of this session's handshake
+        self.identity_public = None  # the peer's raw identity key
+        self.fingerprint = None  # of the peer's identity key
+        self.session_cipher = None
+        self.resumption = None  # client: the ticket state this connection tries to resume
+        self.client_nonce = None
+        self.ack_due = False  # chat was received since the last acknowledgement
+        self.last_heard = time.monotonic()  # when anything last arrived from the peer
+        self.reading_paused = False  # host: not reading from it while the peers its chat goes to drain
+        self.srtt = None  # smoothed round trip time and its mean deviation (seconds), from pings
+        self.rttvar = 0.0
+        self.file_buffer = None  # reusable receive buffer for file data, allocated on first use
+        self.mux = Multiplexer(engine.send_high_water)
+        self.congested = False  # reported that the send queue is over its high-water mark
+        self.codec = None  # compression codec agreed with the peer, None until then or if there is none
+        # File data is sealed with a key per direction, unless both sides allow plain file data
+        self.file_sender = None
+        self.file_receiver = None
+        self.file_send_seq = {}  # channel -> sequence number of the last sealed frame sent
+        self.file_recv_seq = {}  # channel -> sequence number of the last sealed frame received
+        self.sealed = asyncio.Queue(SEALED_AHEAD)  # (future of a decrypted frame, what takes it) in arrival order
+        # Host: the rooms this peer joined, and how many room messages it missed while backed up
+        self.rooms = set()
+        self.skipped = 0
+        self.told_to_join = False  # relay: sent the notice that chat outside rooms goes nowhere
+        self.behind_since = None  # when it first fell too far behind
+        # Transfers this side receives from the peer, by the channel their data arrives on
+        self.channels = {}  # channel -> PartialTransfer
+        self.writers = {}  # channel -> ChunkWriter of the chunk being received
+        self.next_channel = FIRST_TRANSFER_CHANNEL
+
+    def send_frame(self, frame_type, payload=b"", channel=CHANNEL_CONTROL):
+        """Queue a frame for this peer without waiting for the network."""
+        self.mux.put(channel, encode_frame(frame_type, payload, channel))
+
+    def send_chat(self, message, seq=None):
+        """Encrypt and queue a chat message under its spool sequence number, or a new one if it is not spooled."""
+        from src.cipher import encrypt_message
+
+        seq = SEQUENCE.pack(seq or self.engine.spool.next_seq())
+        payload = seq + encrypt_message(message, self.session_cipher, seq, compress=self.codec is not None)
+        self.send_frame(FRAME_CHAT, payload, CHANNEL_CHAT)
+        METRICS.count("messages_sent")
+        self.check_congestion()
+
+    def send_chat_batch(self, messages):
+        """Encrypt and queue (sequence number, message) pairs replayed from the spool in one frame."""
+        from src.cipher import encrypt_batch
+
+        self.send_frame(FRAME_CHAT_BATCH, encrypt_batch(messages, self.session_cipher, self.codec is not None), CHANNEL_CHAT)
+        METRICS.count("messages_sent", len(messages))
+        self.check_congestion()
+
+    def send_ack(self):
+        """Tell the peer the highest sequence number received from it, so it can forget what it spooled."""
+        from src.cipher import seal
+
+        self.ack_due = False
+        self.send_frame(FRAME_CHAT_ACK, seal(SEQUENCE.pack(self.engine.spool.received(self.fingerprint)), self.session_cipher))
+
+    def receive_chat(self, seq, message):
+        """Show a chat message, unless it is a replay of one already received."""
+        engine = self.engine
+        self.ack_due = True
+        if not engine.spool.receive(self.fingerprint, seq):
+            return
+        if engine.relay:
+            # A relay only forwards room messages: chat sent to it is neither shown nor passed on
+            if not self.told_to_join:
+                self.told_to_join = True
+                self.send_chat("This is a relay, it only forwards rooms: /join a room to chat.")
+            return
+        METRICS.count("messages_received")
+        engine.record("in", message, self)
+        engine.on_message(message)
+        if engine.host_mode:
+            engine.broadcast_message(message, exclude=self)
+
+    def check_congestion(self):
+        if not self.mux.above_high_water():
+            self.congested = self.congested and self.mux.queued > 0  # reported again once it emptied
+        elif not self.congested:
+            self.congested = True
+            self.engine.on_message(f"Sending to {self.addr} is backed up, {format_size(self.mux.queued)} queued.")
+
+    def send_file_region(self, channel, prefix, f, offset, count):
+        """Queue a file data frame whose body is sent straight from the file with sendfile.
+
+        Returns a future that resolves to the time the region took to send.
+        """
+        done = asyncio.get_running_loop().create_future()
+        header = encode_header(FRAME_FILE_DATA, len(prefix) + count, channel) + prefix
+        self.mux.put(channel, (header, f, offset, count, done))
+        return done
+
+    def next_file_seq(self, channel):
+        seq = self.file_send_seq.get(channel, 0) + 1
+        self.file_send_seq[channel] = seq
+        return seq
+
+    def send_file_frame(self, channel, frame_type, prefix, data):
+        """Queue a file data frame whose body is already in memory, returning a future like send_file_region."""
+        done = asyncio.get_running_loop().create_future()
+        header = encode_header(frame_type, len(prefix) + len(data), channel) + prefix
+        self.mux.put(channel, (header, data, 0, len(data), done))
+        return done
+
+    async def write_loop(self):
+        """Write frames in multiplexer order, so slow peers only delay themselves."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.mux.get()
+            if isinstance(item, bytes):
+                batch = [item]
+                size = len(item)
+                while len(batch) < SEND_BATCH_FRAMES and size < SEND_BATCH_BYTES:
+                    item = self.mux.pop(frames_only=True)
+                    if item is None:
+                        break
+                    batch.append(item)
+                    size += len(item)
+                started = time.perf_counter()
+                await send_buffers(loop, self.sock, batch)
+                METRICS.since("send", started)
+                METRICS.count("frames_sent", len(batch))
+                METRICS.count("bytes_sent", size)
+                if self.skipped and self.mux.queued <= self.engine.relay_queue // 2:
+                    self.caught_up()
+                continue
+            header, body, offset, count, done = item
+            started = loop.time()
+            try:
+                await loop.sock_sendall(self.sock, header)
+                if isinstance(body, bytes):
+                    await loop.sock_sendall(self.sock, body)
+                else:
+                    sent = await loop.sock_sendfile(self.sock, body, offset, count)
+                    if sent != count:
+                        raise ConnectionError("File changed while it was being sent.")
+            except asyncio.CancelledError:
+                done.cancel()
+                raise
+            except Exception as e:
+                done.set_exception(e)
+                raise
+            elapsed = loop.time() - started
+            METRICS.observe("file_frame_send", elapsed)
+            METRICS.count("frames_sent")
+            METRICS.count("bytes_sent", len(header) + count)
+            done.set_result(elapsed)
+
+    async def read_loop(self):
+        """Receive data into the frame decoder and dispatch every complete frame."""
+        loop = asyncio.get_running_loop()
+        while True:
+            nbytes = await loop.sock_recv_into(self.sock, self.decoder.get_buffer())
+            if not nbytes:
+                break
+            self.last_heard = time.monotonic()
+            started = time.perf_counter()
+            METRICS.count("bytes_received", nbytes)
+            for frame_type, channel, payload in self.decoder.feed(nbytes):
+                if frame_type == FRAME_FILE_SEALED or (frame_type == FRAME_FILE_DELTA and self.file_receiver):
+                    # Waits while SEALED_AHEAD frames are being decrypted
+                    await self.sealed.put(self.engine.transfers.open_file_data(self, frame_type, channel, payload))
+                else:
+                    self.process_frame(frame_type, channel, payload)
+            if self.ack_due:
+                self.send_ack()  # one acknowledgement for everything this read brought
+            partial = self.decoder.take_partial(FRAME_FILE_DATA)
+            METRICS.since("recv", started)
+            if partial:
+                await self.receive_file_data(*partial)
+            if self.engine.host_mode and not self.engine.relay:
+                # Stop reading from this peer while the peers its chat is
+                # relayed to are backed up, so TCP slows the sender down
+                self.reading_paused = True
+                for peer in self.engine.ready_peers(exclude=self):
+                    await peer.mux.drained.wait()
+                self.reading_paused = False
+
+    async def heartbeat_loop(self):
+        """Ping the peer, and give up on it once nothing arrived from it for too long."""
+        engine = self.engine
+        while True:
+            await asyncio.sleep(engine.heartbeat_interval)
+            now = time.monotonic()
+            if self.reading_paused:
+                self.last_heard = now  # it is this side that is not listening
+            elif now - self.last_heard > engine.dead_peer_timeout:
+                raise ConnectionError(f"Nothing heard from {self.addr} for {now - self.last_heard:.0f} s, giving up on it.")
+            if self.session_cipher:
+                self.send_frame(FRAME_PING, PING.pack(time.monotonic_ns()))
+
+    def receive_pong(self, payload):
+        """Update the smoothed round trip time and its deviation, the way TCP does."""
+        (sent,) = PING.unpack(payload)
+        rtt = (time.monotonic_ns() - sent) / 1e9
+        if rtt < 0:
+            raise ProtocolError("Pong for a ping that was never sent.")
+        METRICS.observe("rtt", rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        METRICS.gauge("rtt_smoothed", self.srtt)
+        METRICS.gauge("rtt_jitter", self.rttvar)
+        self.engine.on_rtt(f"{self.addr[0]}:{self.addr[1]}", self.srtt, self.rttvar)
+
+    async def unseal_loop(self):
+        """Write sealed file data in the order it arrived, as the worker pool decrypts it."""
+        while True:
+            opened, apply = await self.sealed.get()
+            frame = await opened
+            try:
+                apply(frame)
+            except ProtocolError:
+                raise
+            except Exception as e:
+                self.engine.on_message(f"Error processing data: {e}")
+
+    def expect_plain_files(self):
+        if self.file_receiver:
+            raise ProtocolError("Unencrypted file data on a session that encrypts files.")
+
+    async def receive_file_data(self, channel, length, buffered):
+        """Receive the rest of a large file data frame through the reusable file buffer."""
+        loop = asyncio.get_running_loop()
+        self.expect_plain_files()
+        prefix = bytes(buffered[:DATA_PREFIX.size])
+        buffered = buffered[len(prefix):]
+        while len(prefix) < DATA_PREFIX.size:
+            data = await loop.sock_recv(self.sock, DATA_PREFIX.size - len(prefix))
+            if not data:
+                raise ConnectionError("Connection closed during file transfer.")
+            prefix += data
+        writer = self.engine.transfers.file_data_writer(self, channel, DATA_PREFIX.unpack(prefix)[0])
+        if writer:
+            writer.write(buffered)
+        remaining = length - DATA_PREFIX.size - len(buffered)
+        if self.file_buffer is None:
+            self.file_buffer = bytearray(FILE_BUFFER_MIN)
+        while remaining:
+            view = memoryview(self.file_buffer)[:remaining]
+            nbytes = await loop.sock_recv_into(self.sock, view)
+            if not nbytes:
+                raise ConnectionError("Connection closed during file transfer.")
+            self.last_heard = time.monotonic()
+            METRICS.count("bytes_received", nbytes)
+            if writer:
+                writer.write(view[:nbytes])
+            remaining -= nbytes
+            if nbytes == len(self.file_buffer) and nbytes < FILE_BUFFER_MAX:
+                # The socket keeps filling the buffer, read bigger pieces
+                self.file_buffer = bytearray(len(self.file_buffer) * 2)
+        if writer:
+            self.engine.transfers.file_data_done(self, writer, length - DATA_PREFIX.size)
+
+    def process_frame(self, frame_type, channel, payload):
+        """Process an incoming frame: key exchange, message or file transfer."""
+        from src.cipher import decrypt_batch, decrypt_message, unseal
+
+        engine = self.engine
+        transfers = engine.transfers
+        try:
+            if frame_type == FRAME_CHAT:
+                (seq,) = SEQUENCE.unpack_from(payload)
+                self.receive_chat(seq, decrypt_message(payload[SEQUENCE.size:], self.session_cipher, payload[:SEQUENCE.size]))
+            elif frame_type == FRAME_CHAT_BATCH:
+                for seq, message in decrypt_batch(payload, self.session_cipher):
+                    self.receive_chat(seq, message)
+            elif frame_type == FRAME_CHAT_ACK:
+                (seq,) = SEQUENCE.unpack(unseal(payload, self.session_cipher))
+                engine.spool.acked(self.fingerprint, seq)
+            elif frame_type == FRAME_FILE_DATA:
+                self.expect_plain_files()
+                (offset,) = DATA_PREFIX.unpack_from(payload)
+                transfers.write_file_data(self, channel, offset, payload[DATA_PREFIX.size:])
+            elif frame_type == FRAME_FILE_COMPRESSED:
+                self.expect_plain_files()
+                offset, codec_id, size = COMPRESSED_PREFIX.unpack_from(payload)
+                if not 0 < size <= MAX_FRAME_SIZE:
+                    raise ProtocolError(f"Compressed file data of {size} bytes is out of bounds.")
+                if transfers.file_data_writer(self, channel, offset):
+                    data = decompress_chunk(codec_id, payload[COMPRESSED_PREFIX.size:], size)
+                    transfers.write_file_data(self, channel, offset, data)
+            elif frame_type == FRAME_FILE_DELTA:
+                (seq,) = DELTA_PREFIX.unpack_from(payload)
+                transfers.check_sequence(self, channel, seq)
+                transfers.apply_delta(self, channel, payload[DELTA_PREFIX.size:])
+            elif frame_type == FRAME_FILE_DELTA_REQUEST:
+                transfers.serve_request(self, json.loads(bytes(payload)), delta=True)
+            elif frame_type == FRAME_ROOM_MESSAGE:
+                if engine.host_mode:
+                    engine.relay_room_message(self, payload)
+                else:
+                    engine.receive_room_message(payload)
+            elif frame_type == FRAME_ROOM_JOIN:
+                if engine.host_mode:
+                    engine.add_to_room(self, bytes(payload))
+                else:
+                    engine.room_joined(bytes(payload))
+            elif frame_type == FRAME_ROOM_LEAVE:
+                engine.remove_from_room(self, bytes(payload))
+            elif frame_type == FRAME_PING:
+                self.send_frame(FRAME_PONG, bytes(payload))
+            elif frame_type == FRAME_PONG:
+                self.receive_pong(payload)
+            elif frame_type == FRAME_CODECS:
+                self.receive_codecs(json.loads(bytes(payload)))
+            elif frame_type == FRAME_FILE_OFFER:
+                transfers.receive_offer(self, json.loads(bytes(payload)))
+            elif frame_type == FRAME_FILE_REQUEST:
+                transfers.serve_request(self, json.loads(bytes(payload)))
+            elif frame_type == FRAME_FILE_DONE:
+                transfers.transfer_delivered(self, json.loads(bytes(payload)))
+            elif frame_type == FRAME_FILE_CANCEL:
+                transfers.transfer_cancelled(self, json.loads(bytes(payload)))
+            elif frame_type == FRAME_FILE_PAUSE:
+                transfers.upload_paused(self, json.loads(bytes(payload)))
+            elif frame_type == FRAME_HELLO:
+                self.receive_hello(bytes(payload))
+            elif frame_type == FRAME_RESUME:
+                self.receive_resume(bytes(payload))
+            elif frame_type == FRAME_RESUMED:
+                self.receive_resumed(bytes(payload))
+            elif frame_type == FRAME_TICKET:
+                self.receive_ticket(payload)
+            else:
+                raise ProtocolError(f"Unknown frame type {frame_type}.")
+        except ValueError as ve:
+            engine.on_message(f"Decryption error: Incorrect padding or corrupted data. {ve}")
+        except ProtocolError:
+            raise
+        except Exception as e:
+            engine.on_message(f"Error processing data: {e}")
+
+    # Handshake: the client sends a hello, or a resume if it holds a ticket, and the host answers
+
+    def send_hello(self):
+        from src.cipher import encode_hello, generate_ephemeral_key
+
+        self.ephemeral_key = generate_ephemeral_key()
+        self.send_frame(FRAME_HELLO, encode_hello(self.engine.identity_key(), self.ephemeral_key))
+
+    def send_resume(self, resumption):
+        self.resumption = resumption
+        self.client_nonce = os.urandom(RESUME_NONCE_SIZE)
+        self.send_frame(FRAME_RESUME, self.client_nonce + resumption["ticket"])
+
+    def receive_hello(self, payload):
+        from src.cipher import decode_hello, derive_session_key, fingerprint
+
+        if self.session_cipher:
+            raise ProtocolError("Unexpected handshake.")
+        try:
+            identity_public, remote_ephemeral = decode_hello(payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        if not self.ephemeral_key:
+            self.send_hello()  # answering, or the host turned down our ticket
+        self.set_session_key(derive_session_key(self.ephemeral_key, remote_ephemeral, self.engine.host_mode))
+        self.ephemeral_key = None  # forget it, so the session key cannot be rebuilt later
+        self.identity_public = identity_public
+        self.fingerprint = fingerprint(identity_public)
+        self.resumption = None
+        self.engine.session_ready(self)
+
+    def receive_resume(self, payload):
+        """Host: resume a session from a ticket, or fall back to a full handshake."""
+        from src.cipher import derive_resumed_key, fingerprint, open_ticket
+
+        engine = self.engine
+        if not engine.host_mode or self.session_cipher or self.ephemeral_key:
+            raise ProtocolError("Unexpected resume.")
+        client_nonce = payload[:RESUME_NONCE_SIZE]
+        opened = open_ticket(engine.ticket_key(), payload[RESUME_NONCE_SIZE:], TICKET_LIFETIME)
+        if opened is None:
+            self.send_hello()
+            return
+        secret, identity_public = opened
+        host_nonce = os.urandom(RESUME_NONCE_SIZE)
+        self.send_frame(FRAME_RESUMED, host_nonce)
+        self.set_session_key(derive_resumed_key(secret, client_nonce, host_nonce))
+        self.identity_public = identity_public
+        self.fingerprint = fingerprint(identity_public)
+        engine.session_ready(self, resumed=True)
+
+    def receive_resumed(self, payload):
+        from src.cipher import derive_resumed_key
+
+        resumption = self.resumption
+        if self.engine.host_mode or self.session_cipher or not resumption:
+            raise ProtocolError("Unexpected resume.")
+        self.set_session_key(derive_resumed_key(resumption["secret"], self.client_nonce, payload))
+        self.fingerprint = resumption["fingerprint"]
+        self.engine.session_ready(self, resumed=True)
+
+    def set_session_key(self, session_key):
+        """Start encrypting with a new session key: chat with it, file data with keys derived from it."""
+        from src.cipher import file_ciphers, session_cipher
+
+        self.session_cipher = session_cipher(session_key)
+        self.file_sender, self.file_receiver = file_ciphers(session_key, self.engine.host_mode)
+
+    def send_ticket(self):
+        """Host: give the client a ticket to resume this session with."""
+        from src.cipher import issue_ticket, seal
+
+        secret = os.urandom(32)
+        ticket = issue_ticket(self.engine.ticket_key(), secret, self.identity_public)
+        self.send_frame(FRAME_TICKET, seal(secret + ticket, self.session_cipher))
+
+    def receive_ticket(self, payload):
+        from src.cipher import unseal
+
+        if self.engine.host_mode or not self.session_cipher:
+            raise ProtocolError("Unexpected ticket.")
+        data = unseal(payload, self.session_cipher)
+        self.engine.resumption = {
+            "host": self.addr,
+            "secret": data[:32],
+            "ticket": data[32:],
+            "fingerprint": self.fingerprint,
+        }
+
+    def relay_frame(self, frame):
+        """Host: queue a room frame for this member, unless it is too far behind."""
+        if self.keeping_up(len(frame)):
+            self.mux.put(CHANNEL_CHAT, frame)
+
+    def keeping_up(self, nbytes):
+        """Host: whether this member can take nbytes more.
+
+        One that cannot is skipped, and told how much it missed once it caught
+        up again; if it stays behind for too long, or the host drops slow
+        members right away, it is disconnected.
+        """
+        engine = self.engine
+        if self.mux.queued + nbytes <= engine.relay_queue:
+            if self.skipped:
+                self.caught_up()
+            return True
+        now = time.monotonic()
+        if engine.slow_consumers == "drop" or (self.behind_since and now - self.behind_since > engine.relay_stall_time):
+            engine.drop_peer(self, "it could not keep up")
+            return False
+        if self.behind_since is None:
+            self.behind_since = now
+        self.skipped += 1
+        METRICS.count("room_messages_skipped")
+        return False
+
+    def caught_up(self):
+        self.send_chat(f"Your connection could not keep up, {self.skipped} room message(s) were skipped.")
+        self.skipped = 0
+        self.behind_since = None
+
+    def send_codecs(self):
+        self.send_frame(FRAME_CODECS, json.dumps({
+            "codecs": self.engine.codecs, "plain_files": not self.engine.encrypt_files,
+        }).encode("utf-8"))
+
+    def receive_codecs(self, offer):
+        """Settle on the host's most preferred codec that both sides have, and on encrypting files."""
+        if offer.get("plain_files") and not self.engine.encrypt_files:
+            self.file_sender = self.file_receiver = None
+        codecs = offer["codecs"]
+        if self.engine.host_mode:
+            self.codec = choose_codec(self.engine.codecs, codecs)
+        else:
+            self.codec = choose_codec(codecs, self.engine.codecs)
+
+    def transfer_channel(self, transfer):
+        """Return the channel this peer sends the data of an incoming transfer on."""
+        for channel, known in self.channels.items():
+            if known is transfer:
+                return channel
+        if self.next_channel > 0xFFFF:
+            raise ProtocolError("Out of transfer channels.")
+        channel = self.next_channel
+        self.next_channel += 1
+        self.channels[channel] = transfer
+        return channel
+
+    def forget_transfer(self, transfer):
+        for channel in [channel for channel, known in self.channels.items() if known is transfer]:
+            del self.channels[channel]
+            self.writers.pop(channel, None)
+
+    def close(self):
+        for item in self.mux.clear():
+            if not isinstance(item, bytes):
+                item[-1].cancel()
+        self.sock.close()
+
+
+class ChatEngine:
+    """Asyncio networking engine for both host and client mode.
+
+    A host serves any number of peers on one event loop, each with its own
+    session key and send queue. Events are reported through plain callbacks,
+    which are called from the engine's event loop thread. Without an on_offer
+    callback, offered files are accepted right away. Chat and file offers
+    sent while no peer is connected wait in the outbound spool; without one
+    it only lives in memory. Peers are pinged every heartbeat_interval, and a
+    client whose session was lost connects again by itself, unless
+    reconnect_max_delay is 0.
+    """
+
+    def __init__(self, host_mode=False, ip=None, port=2137,
+                 on_message=None, on_file=None, on_connection_lost=None,
+                 on_offer=None, on_progress=None, on_rtt=None, resumption=None, store=None, spool=None,
+                 send_high_water=SEND_HIGH_WATER, compression="auto", encrypt_files=True,
+                 relay=False, relay_queue=RELAY_QUEUE, slow_consumers="skip", relay_stall_time=RELAY_STALL_TIME,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, dead_peer_timeout=DEAD_PEER_TIMEOUT,
+                 reconnect_max_delay=RECONNECT_MAX_DELAY):
+        self.host_mode = host_mode or relay
+        self.ip = ip
+        self.port = port
+        self.on_message = on_message or print
+        self.on_file = on_file or (lambda file_path, filename: None)
+        self.on_connection_lost = on_connection_lost or (lambda: None)
+        self.on_offer = on_offer or (lambda tid, name, size: self.transfers.accept(tid))
+        self.on_progress = on_progress or (lambda snapshots: None)
+        self.on_rtt = on_rtt or (lambda peer, srtt, jitter: None)
+        self.loop = None
+        self.main_task = None
+        self.sock = None
+        self.peers = {}  # Peer -> task handling it
+        self.tasks = set()  # background tasks such as file transfers
+        self.transfers = TransferManager(self)
+        self.identity = None  # long-term identity key, loaded on first use
+        self.tickets = None  # host: cipher of its resumption tickets
+        self.resumption = resumption  # client: ticket and secret of the last session
+        self.store = store  # optional MessageStore that chat and transfers are recorded in
+        self.spool = spool if spool is not None else OutboundSpool()  # chat kept until acknowledged
+        self.send_high_water = send_high_water  # bytes queued per peer before producers wait
+        self.codecs = available_codecs(compression)  # offered to peers, best first
+        self.encrypt_files = encrypt_files  # files go out in plain only if both sides turned this off
+        self.heartbeat_interval = heartbeat_interval  # 0 turns pings and dead peer detection off
+        self.dead_peer_timeout = dead_peer_timeout
+        self.reconnect_max_delay = reconnect_max_delay
+        self.sessions = 0  # that became ready, to tell a lost session from a failed connection
+        # Host: room id -> its members. A relay is a host that only routes, and
+        # never holds up a sender for a slow member
+        self.relay = relay
+        self.rooms = {}
+        self.relay_queue = relay_queue  # bytes queued for a room member before it is skipped
+        self.slow_consumers = slow_consumers  # "skip" members that fall behind for a while, or "drop" them
+        self.relay_stall_time = relay_stall_time
+        # Client: room id -> (name, cipher) of the rooms joined, and the room typed chat goes to
+        self.joined = {}
+        self.room = None
+        self.room_counter = 0  # of the last room message sent
+        self.room_seen = {}  # (room id, sender identity) -> counter of its last message
+
+    def identity_key(self):
+        """Return the identity key from the on-disk keystore."""
+        if self.identity is None:
+            from src.cipher import load_identity
+
+            self.identity = load_identity()
+        return self.identity
+
+    def ticket_key(self):
+        if self.tickets is None:
+            from src.cipher import generate_ticket_key
+
+            self.tickets = generate_ticket_key()
+        return self.tickets
+
+    def resumption_state(self):
+        """What a new engine needs to resume this client's session, or None."""
+        return self.resumption
+
+    def fingerprint(self):
+        from src.cipher import fingerprint, raw_public_key
+
+        return fingerprint(raw_public_key(self.identity_key()))
+
+    async def run(self):
+        """Run the engine until stop() is called or the connection ends."""
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        try:
+            if self.host_mode:
+                await self.serve()
+            else:
+                await self.connect()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            tasks = list(self.peers.values()) + list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.sock:
+                self.sock.close()
+            self.transfers.close()
+            self.loop = None  # what is sent from now on is spooled
+
+    async def serve(self):
+        """Accept peers until stopped."""
+        loop = asyncio.get_running_loop()
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(("", self.port))
+            self.sock.listen(socket.SOMAXCONN)
+            self.sock.setblocking(False)
+        except OSError as e:
+            if e.errno == 98:
+                self.on_message(f"Port {self.port} already in use. Please restart and try a different port.")
+            else:
+                self.on_message(f"Error: {e}")
+            return
+        self.on_message(f"Listening on port {self.port}...")
+        while True:
+            conn, addr = await loop.sock_accept(self.sock)
+            self.on_message(f"Connected by {addr}")
+            self.add_peer(conn, addr)
+
+    async def connect(self):
+        """Connect to the host and serve that connection, and once a session was lost, connect again with backoff."""
+        if not await self.connect_once() or not self.reconnect_max_delay:
+            return
+        failures = 0
+        while True:
+            delay = min(RECONNECT_DELAY * 2 ** failures, self.reconnect_max_delay) * random.uniform(0.5, 1)
+            self.on_message(f"Reconnecting in {delay:.0f} s...")
+            await asyncio.sleep(delay)
+            failures = 0 if await self.connect_once(CONNECT_TIMEOUT) else failures + 1
+
+    async def connect_once(self, timeout=None):
+        """Connect to the host and serve that single connection, returning whether a session started on it.
+
+        Without a timeout, connecting takes as long as the system lets it.
+        """
+        loop = asyncio.get_running_loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        try:
+            connecting = loop.sock_connect(self.sock, (self.ip, self.port))
+            await (asyncio.wait_for(connecting, timeout) if timeout else connecting)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.sock.close()
+            self.sock = None
+            if isinstance(e, ConnectionRefusedError):
+                self.on_message("Failed to connect. Server might be down.")
+            elif isinstance(e, asyncio.TimeoutError):
+                self.on_message(f"Timed out connecting to {self.ip}:{self.port}.")
+            else:
+                self.on_message(f"Error: {e}")
+            return False
+        self.on_message(f"Connected to {self.ip}:{self.port}")
+        sessions = self.sessions
+        peer_task = self.add_peer(self.sock, (self.ip, self.port))
+        self.sock = None  # owned by the peer now
+        await asyncio.wait([peer_task])
+        return self.sessions > sessions
+
+    def add_peer(self, sock, addr):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = Peer(self, sock, addr)
+        task = asyncio.create_task(self.handle_peer(peer))
+        self.peers[peer] = task
+        return task
+
+    async def handle_peer(self, peer):
+        """Run the key exchange and the read/write loops of one peer."""
+        if not self.host_mode:
+            # The client speaks first; the session is ready after one round trip
+            if self.resumption and self.resumption["host"] == peer.addr:
+                peer.send_resume(self.resumption)
+            else:
+                peer.send_hello()
+        tasks = [
+            asyncio.create_task(peer.read_loop()),
+            asyncio.create_task(peer.write_loop()),
+            asyncio.create_task(peer.unseal_loop()),
+        ]
+        if self.heartbeat_interval:
+            tasks.append(asyncio.create_task(peer.heartbeat_loop()))
+        lost = True
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except asyncio.CancelledError:
+            lost = False
+        except Exception as e:
+            self.on_message(f"Error: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            peer.close()
+            self.peers.pop(peer, None)
+            self.leave_rooms(peer)
+            self.transfers.peer_lost(peer)
+        if lost:
+            if self.host_mode:
+                self.on_message(f"Peer {peer.addr} disconnected.")
+            else:
+                self.on_connection_lost()
+
+    def session_ready(self, peer, resumed=False):
+        """Called once a peer has a session key."""
+        self.sessions += 1
+        METRICS.since("resume" if resumed else "handshake", peer.connected_at)
+        if resumed:
+            self.on_message(f"Resumed session with {peer.addr}, fingerprint {peer.fingerprint}")
+        else:
+            self.on_message(f"Secure session with {peer.addr}, fingerprint {peer.fingerprint}")
+        peer.send_codecs()
+        if self.host_mode:
+            peer.send_ticket()
+        self.transfers.session_ready(peer)
+        self.replay(peer)
+
+    def replay(self, peer):
+        """Send a peer what it has not acknowledged from the spool, chat in batches, then file offers."""
+        pending = self.spool.pending(peer.fingerprint)
+        if not pending:
+            return
+        batch = []
+        size = 0
+        for seq, kind, body in pending:
+            if kind == "file":
+                self.transfers.send_file(body)
+                self.spool.remove(seq)
+                continue
+            batch.append((seq, body))
+            size += len(body)
+            if size >= REPLAY_BATCH_BYTES:
+                peer.send_chat_batch(batch)
+                batch = []
+                size = 0
+        if batch:
+            peer.send_chat_batch(batch)
+        self.on_message(f"Replayed {len(pending)} spooled message(s) and file offer(s) to {peer.addr}.")
+
+    def record(self, direction, message, peer=None, transfer=None, fingerprint=None):
+        """Add a chat message or transfer event to the message store, if there is one."""
+        if self.store:
+            self.store.add(direction, message, fingerprint or (peer.fingerprint if peer else None), transfer)
+
+    def ready_peers(self, exclude=None):
+        return [peer for peer in self.peers if peer.session_cipher and peer is not exclude]
+
+    def broadcast_message(self, message, exclude=None):
+        """Spool a message, then encrypt it for every connected peer and queue it."""
+        seq = self.spool.add("chat", message, exclude.fingerprint if exclude else None)
+        for peer in self.ready_peers(exclude):
+            if not self.relay or peer.keeping_up(0):
+                peer.send_chat(message, seq)
+
+    def drop_peer(self, peer, reason):
+        """Disconnect a peer, e.g. a room member that cannot keep up."""
+        task = self.peers.pop(peer, None)
+        if task is None:
+            return
+        self.leave_rooms(peer)
+        self.on_message(f"Dropped {peer.addr}: {reason}.")
+        METRICS.count("peers_dropped")
+        task.cancel()
+        self.tasks.add(task)  # still awaited when the engine stops
+        task.add_done_callback(self.tasks.discard)
+
+    # Rooms: clients join them on a host or relay, which forwards their
+    # end-to-end encrypted messages to the other members without opening them
+
+    def add_to_room(self, peer, room_id):
+        if len(room_id) != ROOM_ID_SIZE or not peer.session_cipher:
+            raise ProtocolError("Invalid room join.")
+        members = self.rooms.setdefault(room_id, set())
+        members.add(peer)
+        peer.rooms.add(room_id)
+        peer.send_frame(FRAME_ROOM_JOIN, room_id + ROOM_MEMBERS.pack(len(members)))
+
+    def remove_from_room(self, peer, room_id):
+        members = self.rooms.get(room_id)
+        if members is not None:
+            members.discard(peer)
+            if not members:
+                del self.rooms[room_id]
+        peer.rooms.discard(room_id)
+
+    def leave_rooms(self, peer):
+        for room_id in list(peer.rooms):
+            self.remove_from_room(peer, room_id)
+
+    def relay_room_message(self, sender, payload):
+        """Forward a room message as it is, encoded once, to every other member of the room."""
+        room_id = bytes(payload[:ROOM_ID_SIZE])
+        if room_id not in sender.rooms:
+            raise ProtocolError("Message to a room the peer has not joined.")
+        frame = encode_frame(FRAME_ROOM_MESSAGE, payload, CHANNEL_CHAT)
+        METRICS.count("room_messages_relayed")
+        for peer in list(self.rooms[room_id]):
+            if peer is not sender:
+                peer.relay_frame(frame)
+
+    def join_room(self, name, passphrase=""):
+        """Join a room on the host and send typed chat to it. Safe to call from any thread."""
+        if not self.loop:
+            self.on_message("Not connected.")
+            return
+        self.loop.call_soon_threadsafe(self.spawn, self.join(name, passphrase), f"Joining {name} failed")
+
+    async def join(self, name, passphrase):
+        from src.cipher import room_keys
+
+        if self.host_mode or not self.ready_peers():
+            self.on_message("Rooms can only be joined on a host or relay you are connected to.")
+            return
+        # Deriving the keys is slow on purpose, so do it off the event loop
+        room_id, cipher = await self.transfers.run_in_pool(room_keys, name, passphrase)
+        self.joined[room_id] = (name, cipher)
+        self.room = room_id
+        for peer in self.ready_peers():
+            peer.send_frame(FRAME_ROOM_JOIN, room_id)
+
+    def room_joined(self, payload):
+        room = self.joined.get(payload[:ROOM_ID_SIZE])
+        if room:
+            (members,) = ROOM_MEMBERS.unpack_from(payload, ROOM_ID_SIZE)
+            self.on_message(f"Joined room {html.escape(room[0])} with {members} member(s), what you type goes there.")
+
+    def leave_room(self, name):
+        """Leave a room, typed chat goes to the last other room joined. Safe to call from any thread."""
+        if not self.loop:
+            self.on_message("Not connected.")
+            return
+        self.loop.call_soon_threadsafe(self.leave, name)
+
+    def leave(self, name):
+        for room_id, (room_name, _) in list(self.joined.items()):
+            if room_name == name:
+                del self.joined[room_id]
+                for peer in self.ready_peers():
+                    peer.send_frame(FRAME_ROOM_LEAVE, room_id)
+                if self.room == room_id:
+                    self.room = next(reversed(self.joined), None)
+                self.on_message(f"Left room {html.escape(name)}.")
+                return
+        self.on_message(f"Not in a room called {html.escape(name)}.")
+
+    def send_room_message(self, message):
+        from src.cipher import seal_room_message
+
+        _, cipher = self.joined[self.room]
+        # Counters only go up, even across sessions, so nobody can replay messages
+        self.room_counter = max(self.room_counter + 1, time.time_ns())
+        payload = seal_room_message(message, self.room, cipher, self.identity_key(), self.room_counter)
+        self.record("out", message)
+        for peer in self.ready_peers():
+            peer.send_frame(FRAME_ROOM_MESSAGE, payload, CHANNEL_CHAT)
+
+    def receive_room_message(self, payload):
+        from src.cipher import fingerprint, open_room_message
+
+        room_id = bytes(payload[:ROOM_ID_SIZE])
+        room = self.joined.get(room_id)
+        if room is None:
+            return  # left it meanwhile
+        name, cipher = room
+        identity_public, counter, message = open_room_message(payload, cipher)
+        if counter <= self.room_seen.get((room_id, identity_public), 0):
+            return  # replayed
+        self.room_seen[(room_id, identity_public)] = counter
+        METRICS.count("room_messages_received")
+        self.record("in", message, fingerprint=fingerprint(identity_public))
+        self.on_message(f"[{html.escape(name)}] {message}")
+
+    def spawn(self, coro, what):
+        """Run a background task, reporting its errors as messages."""
+        task = asyncio.create_task(self.report_errors(coro, what))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def report_errors(self, coro, what):
+        try:
+            await coro
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.on_message(f"{what}: {e}")
+
+    def send_chat(self, message):
+        if not self.ready_peers():
+            self.spool_offline("chat", message)
+            return
+        if self.room:
+            self.send_room_message(message)
+            return
+        self.record("out", message)
+        self.broadcast_message(message)
+
+    def offer_file(self, filepath):
+        if not self.ready_peers():
+            self.spool_offline("file", filepath)
+            return
+        self.transfers.send_file(filepath)
+
+    def spool_offline(self, kind, body):
+        """Keep a message or file offer for the next session. Safe to call from any thread."""
+        if self.room and kind == "chat":
+            self.on_message("Connection lost. Room messages are not kept, unable to send message.")
+            return
+        self.spool.add(kind, body)
+        if kind == "chat":
+            self.record("out", body)
+            self.on_message("Not connected, the message will be sent once a session starts.")
+        else:
+            self.on_message(f"Not connected, {html.escape(os.path.basename(body))} will be offered once a session starts.")
+
+    def send_message(self, message):
+        """Send a chat message to all peers, or spool it until there are some. Safe to call from any thread."""
+        self.call_soon(self.send_chat, "chat", message)
+
+    def send_file(self, filepath):
+        """Offer a file to all peers, or spool the offer until there are some. Safe to call from any thread."""
+        self.call_soon(self.offer_file, "file", filepath)
+
+    def call_soon(self, send, kind, body):
+        try:
+            self.loop.call_soon_threadsafe(send, body)
+        except (AttributeError, RuntimeError):  # the engine is not running, or just stopped
+            self.spool_offline(kind, body)
+
+    def transfer_command(self, action, tid=""):
+        """Accept, pause, resume, cancel or list transfers. Safe to call from any thread."""
+        if not self.loop:
+            self.on_message("Not connected.")
+            return
+        self.loop.call_soon_threadsafe(self.transfers.command, action, tid)
+
+    def report_queues(self):
+        lines = [f"{peer.addr}: {len(peer.mux)} frames, {format_size(peer.mux.queued)} queued"
+                 + (" (backed up)" if peer.mux.above_high_water() else "")
+                 + (f", round trip {peer.srtt * 1000:.1f} ± {peer.rttvar * 1000:.1f} ms" if peer.srtt is not None else "")
+                 for peer in self.peers]
+        if len(self.spool):
+            lines.append(f"{len(self.spool)} spooled message(s) and offer(s) not acknowledged yet")
+        self.on_message("Send queues:\n" + "\n".join(lines) if lines else "No peers connected.")
+
+    def queue_report(self):
+        """Report how much is queued for each peer. Safe to call from any thread."""
+        if not self.loop:
+            self.report_queues()  # only the spool is left
+            return
+        self.loop.call_soon_threadsafe(self.report_queues)
+
+    def stop(self):
+        """Stop the engine. Safe to call from any thread."""
+        if self.loop and self.main_task and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
@@ -0,0 +1,137 @@
+import gzip
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+JOURNAL_FOLDER = "logs"
+MAX_BYTES = 8 * 1024 * 1024  # rotate the journal file past this size...
+MAX_AGE = 24 * 3600  # ...or once it is this old, in seconds
+KEEP = 30  # compressed journal files kept, older ones are deleted
+FLUSH_INTERVAL = 1.0  # seconds between fsyncs while messages come in
+FLUSH_BYTES = 64 * 1024  # or sooner, once this much is waiting
+
+
+class ChatJournal:
+    """Append-only log of the chat, written to disk as messages arrive.
+
+    Lines are buffered and written with one fsync per batch by a background
+    thread, so appending never blocks on the disk. Files are rotated by size
+    or age by that thread too, and gzipped by another one.
+    """
+
+    def __init__(self, folder=JOURNAL_FOLDER, max_bytes=MAX_BYTES, max_age=MAX_AGE, keep=KEEP,
+                 flush_interval=FLUSH_INTERVAL):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.pending = []  # encoded lines not written yet
+        self.pending_bytes = 0
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()  # held while writing or rotating the file
+        self.closed = False
+        self.file = None
+        self.path = None
+        self.opened = 0.0
+        self.size = 0
+        self.compressor = ThreadPoolExecutor(1, thread_name_prefix="journal-gzip")
+        os.makedirs(folder, exist_ok=True)
+        self.open_file()
+        self.thread = threading.Thread(target=self.flush_loop, name="journal", daemon=True)
+        self.thread.start()
+
+    def open_file(self):
+        # One file per rotation, named after the time it was started; the
+        # pid keeps two instances in the same folder apart
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        name = f"chat-{timestamp}-{os.getpid()}"
+        self.path = os.path.join(self.folder, name + ".log")
+        count = 1
+        while os.path.exists(self.path) or os.path.exists(self.path + ".gz"):
+            count += 1
+            self.path = os.path.join(self.folder, f"{name}.{count}.log")
+        self.file = open(self.path, "ab")
+        self.opened = time.time()
+        self.size = self.file.tell()
+
+    def append(self, message):
+        """Queue a message for the journal. Safe to call from any thread."""
+        line = f"{datetime.now():%Y-%m-%d %H:%M:%S} {message}"
+        data = (line + "\n").encode("utf-8")
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes >= FLUSH_BYTES:
+                self.lock.notify()
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                if not self.closed and self.pending_bytes < FLUSH_BYTES:
+                    self.lock.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            with self.write_lock:
+                if not self.file.closed and self.rotation_due():
+                    self.rotate()
+            if closed:
+                break
+
+    def flush(self):
+        """Write queued lines with a single fsync."""
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending, self.pending_bytes = self.pending, [], 0
+            if self.file.closed:
+                return
+            if pending:
+                data = b"".join(pending)
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.size += len(data)
+
+    def rotation_due(self):
+        return self.size >= self.max_bytes or (self.size and time.time() - self.opened >= self.max_age)
+
+    def rotate(self):
+        """Close the current file and start a new one, compressing the old one in the background."""
+        self.file.close()
+        path = self.path
+        self.open_file()
+        self.compressor.submit(self.compress, path)
+
+    def compress(self, path):
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        self.prune()
+
+    def prune(self):
+        archives = [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                    if name.startswith("chat-") and name.endswith(".log.gz")]
+        archives.sort(key=os.path.getmtime)
+        for path in archives[:max(len(archives) - self.keep, 0)]:
+            os.remove(path)
+
+    def sync(self):
+        """Block until everything appended so far is on disk, returning the journal path."""
+        self.flush()
+        return self.path
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.lock.notify()
+        self.thread.join()
+        with self.write_lock:
+            self.file.close()
+        self.compressor.shutdown()
@@ -0,0 +1,259 @@
+import functools
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds of the latency histogram buckets (seconds), 10 µs to 10 s
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+PROMETHEUS_PREFIX = "sigmal_"
+PROFILE_INTERVAL = 0.005  # seconds between stack samples of the profiler
+# Where a thread's innermost Python frame is when it is only waiting: the
+# event loop's select, an idle worker pool thread or a queue. Threads waiting
+# in Qt's event loop or asyncio.run are at module level, and left out too
+IDLE_FRAMES = {
+    ("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait"), ("queue.py", "get"),
+}
+
+
+class Histogram:
+    """Latency counts per bucket, with their sum and maximum."""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is over the biggest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q quantile falls in, or the maximum if that is lower."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Counters and latency histograms, recorded from any thread.
+
+    Recording is a few list and dictionary updates without a lock, so it can
+    stay on in the hot paths: every chat message, socket read and file frame.
+    A thread switch in the middle of one can lose a count, which is rare and
+    does not matter for statistics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # name -> count
+        self.histograms = {}  # name -> Histogram
+        self.gauges = {}  # name -> latest estimate of a latency (seconds), such as the smoothed round trip time
+        self.since_time = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, seconds):
+        self.gauges[name] = seconds
+
+    def histogram(self, name):
+        """The histogram of a stage, created on first use. It stays the same one across resets."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            return histogram
+
+    def observe(self, name, seconds):
+        (self.histograms.get(name) or self.histogram(name)).observe(seconds)
+
+    def since(self, name, started):
+        """Observe the time since started, a time.perf_counter() reading."""
+        self.observe(name, time.perf_counter() - started)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            for histogram in self.histograms.values():
+                histogram.clear()
+            self.since_time = time.time()
+
+    def report(self):
+        """Live figures for /stats, one stage or counter per line."""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            gauges = sorted(self.gauges.items())
+            counters = sorted(self.counters.items())
+            elapsed = max(time.time() - self.since_time, 1e-6)
+        lines = [f"Stats of the last {elapsed:.0f} s (ms):"]
+        for name, h in histograms:
+            if not h.count:
+                continue
+            lines.append(
+                f"{name}: {h.count} in {h.total:.3f} s, mean {h.total / h.count * 1000:.3f}, "
+                f"p50 {h.quantile(0.5) * 1000:.3f}, p99 {h.quantile(0.99) * 1000:.3f}, max {h.max * 1000:.3f}"
+            )
+        for name, seconds in gauges:
+            lines.append(f"{name.replace('_', ' ')}: {seconds * 1000:.3f}")
+        for name, value in counters:
+            lines.append(f"{name.replace('_', ' ')}: {value} ({value / elapsed:.1f}/s)")
+        if len(lines) == 1:
+            lines.append("Nothing recorded yet.")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+            for name, seconds in sorted(self.gauges.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}_seconds"
+                lines += [f"# TYPE {metric} gauge", f"{metric} {seconds}"]
+            for name, h in sorted(self.histograms.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                seen = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    seen += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {seen}')
+                lines += [
+                    f'{metric}_bucket{{le="+Inf"}} {h.count}',
+                    f"{metric}_sum {h.total}",
+                    f"{metric}_count {h.count}",
+                ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the metrics to a file for a scraper to pick up, replacing it in one step."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+METRICS = Metrics()  # shared by the whole process: engine, worker pool and GUI
+
+
+def timed(name):
+    """Decorator recording how long every call of a function takes."""
+    histogram = METRICS.histogram(name)
+    perf_counter = time.perf_counter
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def dump_periodically(path, interval, on_error=print):
+    """Write the metrics to path every interval seconds on a background thread.
+
+    Returns an Event that stops it when set.
+    """
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                METRICS.write_prometheus(path)
+            except OSError as e:
+                on_error(f"Could not write metrics to {path}: {e}")
+                return
+
+    threading.Thread(target=run, name="metrics", daemon=True).start()
+    return stopped
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of every thread while it runs, to see where time goes without tracing each call.
+
+    Threads that are only waiting are left out. The samples can be written as
+    collapsed stacks, which flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()  # tuple of frames, outermost first -> samples
+        self.samples = 0  # sampling rounds
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if code.co_name == "<module>" or (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and return how long it ran for (seconds)."""
+        self.stopped.set()
+        self.thread.join()
+        return time.perf_counter() - self.started
+
+    def top(self, limit=15):
+        """The busiest functions as (function, samples in it, samples in it or what it called)."""
+        own = Counter()
+        total = Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            for function in set(stack):
+                total[function] += samples
+        return [(function, samples, total[function]) for function, samples in own.most_common(limit)]
+
+    def report(self, limit=15):
+        busy = sum(self.stacks.values())
+        if not busy:
+            return "Profiler: no busy threads were sampled."
+        lines = [f"Profiler: {busy} busy samples in {self.samples} rounds, busiest functions (own % / total %):"]
+        for function, samples, total in self.top(limit):
+            lines.append(f"{samples * 100 / busy:5.1f} {total * 100 / busy:5.1f}  {function}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {samples}\n")
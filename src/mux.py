@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+
+from src.protocol import CHANNEL_CONTROL, CHANNEL_CHAT
+
+# Bytes queued for one connection above which its producers should wait
+SEND_HIGH_WATER = 1024 * 1024
+
+
+def item_size(item):
+    """Bytes an item puts on the wire: a frame, or a (header, body, offset, count, done) file data tuple."""
+    if isinstance(item, bytes):
+        return len(item)
+    header, body, offset, count, done = item
+    return len(header) + count
+
+
+class Multiplexer:
+    """Schedules the outgoing frames of one connection over its logical channels.
+
+    Control frames always go first, then chat. Transfer channels share what is
+    left round-robin, one frame at a time, so a chat message never waits behind
+    more than the transfer frame currently on the wire.
+
+    Queued bytes are counted: `drained` is cleared when they pass the high-water
+    mark and set again once they fall to half of it.
+    """
+
+    def __init__(self, high_water=SEND_HIGH_WATER):
+        self.control = deque()
+        self.chat = deque()
+        self.transfers = {}  # channel -> deque of queued frames
+        self.rotation = deque()  # transfer channels with queued frames, in turn order
+        self.ready = asyncio.Event()
+        self.high_water = high_water
+        self.queued = 0  # bytes waiting to be sent
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def __len__(self):
+        return len(self.control) + len(self.chat) + sum(len(queue) for queue in self.transfers.values())
+
+    def account(self, nbytes):
+        self.queued += nbytes
+        if self.queued > self.high_water:
+            self.drained.clear()
+        elif self.queued <= self.high_water // 2:
+            self.drained.set()
+
+    def above_high_water(self):
+        return not self.drained.is_set()
+
+    def put(self, channel, item):
+        if channel == CHANNEL_CONTROL:
+            self.control.append(item)
+        elif channel == CHANNEL_CHAT:
+            self.chat.append(item)
+        else:
+            queue = self.transfers.get(channel)
+            if queue is None:
+                queue = self.transfers[channel] = deque()
+                self.rotation.append(channel)
+            queue.append(item)
+        self.account(item_size(item))
+        self.ready.set()
+
+    def pop(self, frames_only=False):
+        """Return the next item to send, or None if nothing is queued.
+
+        With frames_only, None is also returned when the next item is a file
+        region rather than a frame, so callers can batch frames up to it.
+        """
+        if self.control:
+            queue = self.control
+        elif self.chat:
+            queue = self.chat
+        elif self.rotation:
+            queue = self.transfers[self.rotation[0]]
+        else:
+            return None
+        if frames_only and not isinstance(queue[0], bytes):
+            return None
+        item = queue.popleft()
+        if queue is not self.control and queue is not self.chat:
+            channel = self.rotation.popleft()
+            if queue:
+                self.rotation.append(channel)
+            else:
+                del self.transfers[channel]
+        self.account(-item_size(item))
+        return item
+
+    async def get(self):
+        while True:
+            item = self.pop()
+            if item is not None:
+                return item
+            self.ready.clear()
+            await self.ready.wait()
+
+    def drop(self, channel):
+        """Drop and return the frames still queued on one transfer channel."""
+        queue = self.transfers.pop(channel, None)
+        if queue is None:
+            return []
+        self.rotation.remove(channel)
+        self.account(-sum(item_size(item) for item in queue))
+        return list(queue)
+
+    def clear(self):
+        """Drop and return everything still queued."""
+        items = list(self.control) + list(self.chat)
+        for queue in self.transfers.values():
+            items.extend(queue)
+        self.control.clear()
+        self.chat.clear()
+        self.transfers.clear()
+        self.rotation.clear()
+        self.account(-self.queued)
+        return items
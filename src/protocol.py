@@ -0,0 +1,135 @@
+import struct
+
+# Every frame on the wire is: version (1 byte), frame type (1 byte),
+# channel (2 bytes), payload length (4 bytes), all big endian, followed by
+# the binary payload.
+PROTOCOL_VERSION = 10
+HEADER = struct.Struct("!BBHI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Chat messages are numbered by their sender's outbound spool; the numbers
+# only go up, across sessions and restarts, so replayed messages are dropped
+SEQUENCE = struct.Struct("!Q")
+# An entry of a chat batch: sequence number, length of the packed message
+BATCH_ENTRY = struct.Struct("!QI")
+# Payload of pings and pongs: a monotonic clock reading of the pinging side
+PING = struct.Struct("!Q")
+# A host's answer to a client joining a room: the room id, then how many members it has
+ROOM_MEMBERS = struct.Struct("!I")
+
+# Logical channels multiplexed on one connection. Transfer data uses one
+# channel per transfer, numbered from FIRST_TRANSFER_CHANNEL up.
+CHANNEL_CONTROL = 0
+CHANNEL_CHAT = 1
+FIRST_TRANSFER_CHANNEL = 2
+
+# Frame types
+FRAME_HELLO = 1        # identity key, ephemeral X25519 key, signature; both sides send one
+FRAME_TICKET = 2       # host to client, encrypted: resumption secret, then the ticket
+FRAME_CHAT = 3         # sequence number, then the chat message (flag byte, maybe deflated text) encrypted with it as associated data
+FRAME_FILE_OFFER = 4   # JSON transfer manifest: id, name, size, chunk size, chunk hashes
+FRAME_FILE_DATA = 5    # sent on a transfer channel: byte offset, then raw file bytes
+FRAME_FILE_REQUEST = 6  # JSON {"id": ..., "channel": ..., "ranges": [[start, end], ...]} of chunks to send
+FRAME_FILE_DONE = 7    # JSON {"id": ..., "cached": bool}, every chunk arrived and verified, or the receiver already had the file
+FRAME_FILE_CANCEL = 8  # JSON {"id": ..., "reason": ...}
+FRAME_FILE_PAUSE = 9   # JSON {"id": ...}, stop sending until the next request
+FRAME_RESUME = 10      # client nonce, then a ticket
+FRAME_RESUMED = 11     # host nonce, the resumed session is ready
+FRAME_CODECS = 12      # JSON {"codecs": [...], "plain_files": bool}, compression codecs of the sender, best first, and whether it allows unencrypted file data; both sides send one
+FRAME_FILE_COMPRESSED = 13  # sent on a transfer channel: byte offset, codec, uncompressed length, then compressed file bytes
+FRAME_FILE_SEALED = 14  # sent on a transfer channel: sequence number, byte offset, codec or 0, length, then the (compressed) file bytes encrypted with all of that as associated data
+FRAME_FILE_DELTA_REQUEST = 15  # JSON {"id": ..., "channel": ..., "block_size": ..., "signatures": base64} of an older copy the receiver has
+FRAME_FILE_DELTA = 16  # sent on a transfer channel: sequence number, then delta ops, encrypted like sealed file data unless both sides allow plain file data
+FRAME_ROOM_JOIN = 17   # client to host: room id; the host answers with the room id and its member count
+FRAME_ROOM_LEAVE = 18  # client to host: room id
+FRAME_ROOM_MESSAGE = 19  # room id, then the chat message signed and encrypted end to end with the room key; the host forwards it untouched to the room's other members
+FRAME_CHAT_BATCH = 20  # chat messages replayed from the outbound spool, encrypted together: sequence number, length and packed message of each
+FRAME_CHAT_ACK = 21    # encrypted: highest sequence number received from the peer, so it can drop what it spooled up to there
+FRAME_PING = 22        # the sender's clock (nanoseconds), answered right away by a pong carrying it back
+FRAME_PONG = 23        # the clock of the ping it answers, which gives the round trip time
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends data that is not a valid frame."""
+
+
+def encode_header(frame_type, length, channel=CHANNEL_CONTROL):
+    """Encode a frame header for a payload of the given length."""
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, channel, length)
+
+
+def encode_frame(frame_type, payload=b"", channel=CHANNEL_CONTROL):
+    """Encode a complete frame."""
+    return encode_header(frame_type, len(payload), channel) + payload
+
+
+class FrameDecoder:
+    """Incremental frame parser working on a single reusable receive buffer.
+
+    Typical use:
+
+        nbytes = sock.recv_into(decoder.get_buffer())
+        for frame_type, channel, payload in decoder.feed(nbytes):
+            ...
+
+    Payloads are memoryviews into the receive buffer, so they are only valid
+    until the next call to get_buffer(). Copy them if they need to be kept.
+    """
+
+    def __init__(self, buffer_size=256 * 1024):
+        self.buffer = bytearray(buffer_size)
+        self.start = 0  # first byte not parsed yet
+        self.end = 0  # end of the received data
+        self.needed = HEADER.size  # size of the frame currently being received
+
+    def get_buffer(self):
+        """Return the free part of the receive buffer to recv_into."""
+        if self.start:
+            # Move the partial frame to the front of the buffer
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.needed > len(self.buffer):
+            # A single frame is larger than the buffer, grow it once
+            buffer = bytearray(self.needed)
+            buffer[:self.end] = self.buffer[:self.end]
+            self.buffer = buffer
+        return memoryview(self.buffer)[self.end:]
+
+    def feed(self, nbytes):
+        """Account for nbytes received into the buffer and return complete frames."""
+        self.end += nbytes
+        frames = []
+        view = memoryview(self.buffer)
+        while self.end - self.start >= HEADER.size:
+            version, frame_type, channel, length = HEADER.unpack_from(self.buffer, self.start)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}.")
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes exceeds the size limit.")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                self.needed = HEADER.size + length
+                break
+            frames.append((frame_type, channel, view[self.start + HEADER.size:frame_end]))
+            self.start = frame_end
+            self.needed = HEADER.size
+        return frames
+
+    def take_partial(self, frame_type):
+        """Hand over a partially received frame of the given type.
+
+        Returns (channel, payload length, buffered part of the payload) and
+        forgets the frame, so the caller can receive the rest of the payload
+        straight into its own buffer. Returns None if the buffered data does
+        not start with an incomplete frame of that type.
+        """
+        if self.end - self.start < HEADER.size:
+            return None
+        _, buffered_type, channel, length = HEADER.unpack_from(self.buffer, self.start)
+        payload_start = self.start + HEADER.size
+        if buffered_type != frame_type or payload_start + length <= self.end:
+            return None
+        buffered = memoryview(self.buffer)[payload_start:self.end]
+        self.start = self.end = 0
+        self.needed = HEADER.size
+        return channel, length, buffered
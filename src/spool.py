@@ -0,0 +1,254 @@
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+SPOOL_PATH = "logs/spool.db"
+SPOOL_MAX_AGE = 7 * 24 * 3600  # messages nobody acknowledged, and peers not seen, are forgotten after a week
+BATCH_SIZE = 1000  # changes written per transaction at most
+MEMORY_BODIES = 10000  # bodies kept in memory at most, older ones are read back from the database when replayed
+EXPIRY_INTERVAL = 60  # seconds between looking for peers not seen for max_age
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbound (
+    seq INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    body TEXT NOT NULL,
+    origin TEXT
+);
+CREATE TABLE IF NOT EXISTS peers (
+    fingerprint TEXT PRIMARY KEY,
+    acked INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    seen REAL NOT NULL
+);
+"""
+
+
+class OutboundSpool:
+    """Outgoing chat messages and file offers, numbered and kept until the peers acknowledge them.
+
+    Everything sent is spooled first, so what was sent while disconnected, or
+    was still on its way when a connection dropped, is replayed when the next
+    session starts. Sequence numbers only go up, even across restarts, and
+    the highest one received from each peer is kept too, so a message that is
+    replayed is never shown twice.
+
+    Each item is kind "chat" (acknowledged by the peer) or "file" (a path to
+    offer, done once offered); origin is the fingerprint of the peer a relayed
+    message came from, which does not get it back. Without a path the spool
+    only lives in memory. With one, changes are written by a background thread
+    like MessageStore's, so spooling never waits for the disk, and only the
+    newest MEMORY_BODIES bodies are kept in memory.
+    """
+
+    def __init__(self, path=None, max_age=SPOOL_MAX_AGE, memory=MEMORY_BODIES):
+        self.path = path
+        self.max_age = max_age
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.items = {}  # seq -> (time, kind, origin), in order
+        self.bodies = OrderedDict()  # seq -> body, of the newest items
+        self.peers = {}  # fingerprint -> [acked, received, seen]
+        self.recent = {}  # fingerprint -> acked, of the peers seen within max_age
+        self.delivered = 0  # lowest acked of the recent peers
+        self.expired = time.time()  # when recent was last checked for peers not seen for max_age
+        self.last_seq = 0
+        self.queue = None
+        self.thread = None
+        self.reader = None  # connection bodies no longer in memory are read back with
+        if path:
+            self.load()
+            self.expire()
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.write_loop, name="spool", daemon=True)
+            self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def load(self):
+        db = self.connect()
+        db.executescript(SCHEMA)
+        for seq, when, kind, origin in db.execute("SELECT seq, time, kind, origin FROM outbound ORDER BY seq"):
+            self.items[seq] = (when, kind, origin)
+        newest = db.execute("SELECT seq, body FROM outbound ORDER BY seq DESC LIMIT ?", (self.memory,)).fetchall()
+        self.bodies = OrderedDict(reversed(newest))
+        for fingerprint, acked, received, seen in db.execute("SELECT fingerprint, acked, received, seen FROM peers"):
+            self.peers[fingerprint] = [acked, received, seen]
+        self.last_seq = max([*self.items, *(peer[0] for peer in self.peers.values()), 0])
+        db.close()
+
+    def write(self, change):
+        if self.queue:
+            self.queue.put(change)
+
+    def write_loop(self):
+        db = self.connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                batch = [change for change in batch if change is not None]
+                running = False
+            peers = {}  # only the latest state of each peer is written
+            with db:
+                for change in batch:
+                    if change[0] == "add":
+                        db.execute("INSERT OR REPLACE INTO outbound (seq, time, kind, body, origin) VALUES (?, ?, ?, ?, ?)", change[1:])
+                    elif change[0] == "delete":
+                        db.executemany("DELETE FROM outbound WHERE seq = ?", [(seq,) for seq in change[1]])
+                    elif change[0] == "peer":
+                        peers[change[1]] = change[1:]
+                db.executemany("INSERT OR REPLACE INTO peers (fingerprint, acked, received, seen) VALUES (?, ?, ?, ?)", peers.values())
+            for change in batch:
+                if change[0] == "sync":
+                    change[1].set()
+        db.close()
+
+    def sync(self):
+        """Wait for the background thread to write every change queued so far."""
+        written = threading.Event()
+        self.queue.put(("sync", written))
+        written.wait()
+
+    def next_seq(self):
+        """A new sequence number, above every earlier one even if the clock went back."""
+        with self.lock:
+            self.last_seq = max(self.last_seq + 1, time.time_ns())
+            return self.last_seq
+
+    def add(self, kind, body, origin=None):
+        """Spool a chat message or a file path to offer, returning its sequence number. Safe to call from any thread."""
+        with self.lock:
+            now = time.time_ns()
+            seq = self.last_seq = max(self.last_seq + 1, now)
+            now /= 1e9
+            if now - self.expired >= EXPIRY_INTERVAL:
+                self.expire()
+            if origin and len(self.recent) <= (origin in self.recent):
+                return seq  # relayed, and no other peer needs it
+            self.items[seq] = (now, kind, origin)
+            self.bodies[seq] = body
+            self.write(("add", seq, now, kind, body, origin))
+            if len(self.bodies) > self.memory and self.queue:
+                self.bodies.popitem(last=False)  # still in the database
+        return seq
+
+    def __len__(self):
+        return len(self.items)
+
+    def peer(self, fingerprint):
+        """State of a peer; one seen for the first time is not sent what others already got."""
+        state = self.peers.get(fingerprint)
+        if state is None:
+            delivered = max((peer[0] for peer in self.peers.values()), default=0)
+            state = self.peers[fingerprint] = [delivered, 0, time.time()]
+            self.seen(fingerprint, state)
+        return state
+
+    def seen(self, fingerprint, state):
+        """Count a peer as recent, keeping delivered the lowest acked of the recent peers."""
+        previous = self.recent.get(fingerprint)
+        self.recent[fingerprint] = state[0]
+        if previous is None:
+            self.delivered = state[0] if len(self.recent) == 1 else min(self.delivered, state[0])
+        elif previous == self.delivered and state[0] > previous:
+            self.delivered = min(self.recent.values())  # only when the peer furthest behind catches up
+
+    def expire(self):
+        """Stop waiting for the peers not seen for max_age."""
+        self.expired = time.time()
+        self.recent = {fingerprint: state[0] for fingerprint, state in self.peers.items()
+                       if self.expired - state[2] < self.max_age}
+        self.delivered = min(self.recent.values(), default=0)
+
+    def pending(self, fingerprint):
+        """What a peer has not acknowledged yet, as (seq, kind, body) in order."""
+        with self.lock:
+            acked = self.peer(fingerprint)[0]
+            pending = [(seq, kind) for seq, (_, kind, origin) in self.items.items()
+                       if seq > acked and origin != fingerprint]
+            bodies = self.bodies
+            if pending and pending[0][0] not in bodies:
+                bodies = {**self.read_bodies(pending[0][0], next(iter(bodies), self.last_seq + 1)), **bodies}
+            return [(seq, kind, bodies[seq]) for seq, kind in pending]
+
+    def read_bodies(self, first, end):
+        """Bodies of the items from first up to end that are only in the database."""
+        self.sync()
+        if self.reader is None:
+            self.reader = self.connect()
+        return dict(self.reader.execute("SELECT seq, body FROM outbound WHERE seq >= ? AND seq < ?", (first, end)))
+
+    def acked(self, fingerprint, seq):
+        """A peer received everything up to seq: forget what every recent peer has now."""
+        with self.lock:
+            state = self.peer(fingerprint)
+            state[0] = max(state[0], seq)
+            state[2] = time.time()
+            self.write(("peer", fingerprint, *state))
+            if state[2] - self.expired >= EXPIRY_INTERVAL:
+                self.expire()
+            else:
+                self.seen(fingerprint, state)
+            self.prune(state[2])
+
+    def remove(self, seq):
+        with self.lock:
+            if self.items.pop(seq, None):
+                self.bodies.pop(seq, None)
+                self.write(("delete", [seq]))
+
+    def prune(self, now):
+        done = []
+        for seq, (when, kind, origin) in self.items.items():  # oldest first
+            if now - when > self.max_age:
+                done.append(seq)
+            elif seq <= self.delivered:
+                if kind == "chat":
+                    done.append(seq)
+            elif origin and all(acked >= seq for fingerprint, acked in self.recent.items() if fingerprint != origin):
+                done.append(seq)  # relayed, and every other peer has it
+            else:
+                break
+        for seq in done:
+            del self.items[seq]
+            self.bodies.pop(seq, None)
+        if done:
+            self.write(("delete", done))
+
+    def received(self, fingerprint):
+        """Highest sequence number received from a peer."""
+        with self.lock:
+            return self.peer(fingerprint)[1]
+
+    def receive(self, fingerprint, seq):
+        """Note a message received from a peer, returning False if it is a replay of one received before."""
+        with self.lock:
+            state = self.peers.get(fingerprint) or self.peer(fingerprint)
+            if seq <= state[1]:
+                return False
+            state[1] = seq
+            state[2] = time.time()
+            if fingerprint not in self.recent:
+                self.seen(fingerprint, state)
+            self.write(("peer", fingerprint, *state))
+            return True
+
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+        if self.reader:
+            self.reader.close()
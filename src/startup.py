@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class StartupProfile:
+    """Times the phases of startup for `main.py --profile-startup`.
+
+    Phases are marked as they end, from any thread, and the report lists the
+    time each took and when it ended, counted from the start of main.py.
+    """
+
+    def __init__(self, started, enabled=False):
+        self.started = started
+        self.enabled = enabled
+        self.phases = []  # (name, duration, end, thread name)
+        self.last = started
+        self.lock = threading.Lock()
+
+    def mark(self, name, since=None):
+        """End a phase that began at the previous mark, or at `since` for work on other threads."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            self.phases.append((name, now - (since or self.last), now - self.started, threading.current_thread().name))
+            if since is None:
+                self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        lines = ["Startup profile (ms):", f"  {'phase':<28}{'took':>8}{'at':>8}"]
+        with self.lock:
+            for name, took, at, thread in self.phases:
+                where = "" if thread == "MainThread" else f"  ({thread} thread)"
+                lines.append(f"  {name:<28}{took * 1000:>8.1f}{at * 1000:>8.1f}{where}")
+        print("\n".join(lines), flush=True)
@@ -0,0 +1,121 @@
+import html
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+STORE_PATH = "logs/messages.db"
+BATCH_SIZE = 1000  # messages written per transaction at most
+SEARCH_PAGE = 20  # hits per page of search results
+# Ranking every hit of a common word takes seconds over millions of messages,
+# so hits are ranked among the newest RANK_WINDOW messages that match
+RANK_WINDOW = 5000
+
+TAG_PATTERN = re.compile(r"<[^>]*>")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    peer TEXT,
+    direction TEXT NOT NULL,
+    body TEXT NOT NULL,
+    color TEXT,
+    transfer TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_transfer ON messages (transfer) WHERE transfer IS NOT NULL;
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2');
+"""
+
+
+def plain_text(body):
+    """Strip the HTML of a chat line down to the words worth indexing."""
+    return html.unescape(TAG_PATTERN.sub(" ", body))
+
+
+def match_query(query):
+    """Turn what the user typed into an FTS5 query: every word must match, word* matches a prefix."""
+    terms = []
+    for word in query.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class MessageStore:
+    """SQLite store of chat messages with a full text index.
+
+    Messages are queued by add() from any thread and written by a background
+    thread, many per transaction. Searches run on the caller's thread with
+    their own connection, which WAL mode lets read alongside the writer.
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.queue = queue.Queue()
+        self.reader = None  # connection of the thread that searches, opened on first search
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self.thread = threading.Thread(target=self.write_loop, name="store", daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def add(self, direction, message, peer=None, transfer=None):
+        """Queue a message: direction is "in" or "out", peer the sender's fingerprint."""
+        body, _, color = message.partition("|COLOR=")
+        self.queue.put((time.time(), peer, direction, body, color.strip() or None, transfer))
+
+    def write_loop(self):
+        db = self.connect()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                batch = [row for row in batch if row is not None]
+                running = False
+            with db:
+                for row in batch:
+                    cursor = db.execute(
+                        "INSERT INTO messages (time, peer, direction, body, color, transfer) VALUES (?, ?, ?, ?, ?, ?)",
+                        row,
+                    )
+                    db.execute("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, plain_text(row[3])))
+        db.close()
+
+    def search(self, query, page=0, page_size=SEARCH_PAGE):
+        """Return one page of the recent messages matching query, best match first.
+
+        Each hit is a (time, peer, direction, body, color) tuple. One more
+        hit than page_size is fetched, so callers can tell if a next page exists.
+        """
+        match = match_query(query)
+        if not match:
+            return []
+        if self.reader is None:
+            self.reader = self.connect()
+        return self.reader.execute(
+            "SELECT m.time, m.peer, m.direction, m.body, m.color FROM ("
+            "  SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT ?"
+            ") hits JOIN messages m ON m.id = hits.rowid ORDER BY hits.rank LIMIT ? OFFSET ?",
+            (match, RANK_WINDOW, page_size + 1, page * page_size),
+        ).fetchall()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.reader:
+            self.reader.close()
@@ -0,0 +1,444 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import time
+
+from src.metrics import METRICS
+from src.protocol import ProtocolError
+
+TRANSFER_FOLDER = "transfer"
+# Kept beside the transfer folder, so no received file can end up on top of it
+STATE_FOLDER = "transfer_state"
+PARTIAL_FOLDER = os.path.join(STATE_FOLDER, "partial")
+OUTGOING_INDEX = os.path.join(STATE_FOLDER, "outgoing.json")
+OUTGOING_MAX_AGE = 7 * 24 * 3600  # forget offered files after a week
+CONTENT_FOLDER = os.path.join(STATE_FOLDER, "content")
+
+CHUNK_SIZE = 1024 * 1024
+CHUNK_SIZE_MAX = 8 * 1024 * 1024
+MAX_CHUNKS = 65536  # bigger files use bigger chunks to keep the manifest small
+
+# File data frames start with the byte offset of their data in the file
+DATA_PREFIX = struct.Struct("!Q")
+# Compressed ones add the codec and the length of the data once decompressed
+COMPRESSED_PREFIX = struct.Struct("!QBI")
+# Encrypted ones start with their sequence number on the channel, and codec 0 means uncompressed
+SEALED_PREFIX = struct.Struct("!QQBI")
+# Delta frames start with their sequence number on the channel
+DELTA_PREFIX = struct.Struct("!Q")
+
+
+def chunk_size_for(filesize):
+    """Pick the chunk size for a file: 1 MB, doubled up to 8 MB until MAX_CHUNKS chunks cover it."""
+    chunk_size = CHUNK_SIZE
+    while chunk_size * MAX_CHUNKS < filesize and chunk_size < CHUNK_SIZE_MAX:
+        chunk_size *= 2
+    return chunk_size
+
+
+def write_at(f, data, offset):
+    """Write data at offset of a raw file, returning the number of bytes written."""
+    if hasattr(os, "pwrite"):
+        return os.pwrite(f.fileno(), data, offset)
+    f.seek(offset)
+    return f.write(data)
+
+
+def read_at(f, count, offset):
+    """Read up to count bytes at offset of a raw file."""
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), count, offset)
+    f.seek(offset)
+    return f.read(count)
+
+
+def chunk_count(filesize, chunk_size):
+    return (filesize + chunk_size - 1) // chunk_size
+
+
+def build_manifest(filepath):
+    """Hash a file chunk by chunk and describe it as a transfer manifest.
+
+    This reads the whole file, so run it off the event loop.
+    """
+    filesize = os.path.getsize(filepath)
+    chunk_size = chunk_size_for(filesize)
+    hashes = []
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    manifest = {
+        "name": os.path.basename(filepath),
+        "size": filesize,
+        "chunk_size": chunk_size,
+        "hashes": hashes,
+    }
+    manifest["id"] = transfer_id(manifest)
+    return manifest
+
+
+def transfer_id(manifest):
+    """Derive a stable transfer id from the manifest, so re-offers resume."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([manifest["name"], manifest["size"], manifest["chunk_size"]]).encode("utf-8"))
+    for chunk_hash in manifest["hashes"]:
+        digest.update(chunk_hash.encode("ascii"))
+    return digest.hexdigest()[:32]
+
+
+def validate_manifest(manifest):
+    """Check an offered manifest before anything is preallocated for it. Raises ProtocolError."""
+    if not isinstance(manifest, dict):
+        raise ProtocolError("File offer without a manifest.")
+    name, size, chunk_size, hashes = (manifest.get(key) for key in ("name", "size", "chunk_size", "hashes"))
+    if not isinstance(name, str) or os.path.basename(name) in ("", ".", ".."):
+        raise ProtocolError(f"File offer with an invalid name {name!r}.")
+    if type(size) is not int or size < 0:
+        raise ProtocolError(f"File offer with an invalid size {size!r}.")
+    if type(chunk_size) is not int or not CHUNK_SIZE <= chunk_size <= CHUNK_SIZE_MAX:
+        raise ProtocolError(f"File offer with an invalid chunk size {chunk_size!r}.")
+    if not isinstance(hashes, list) or len(hashes) != chunk_count(size, chunk_size):
+        raise ProtocolError("File offer whose chunk hashes do not cover its size.")
+    for chunk_hash in hashes:
+        if not isinstance(chunk_hash, str) or len(chunk_hash) != 64 or chunk_hash.strip("0123456789abcdef"):
+            raise ProtocolError("File offer with an invalid chunk hash.")
+    if transfer_id(manifest) != manifest.get("id"):
+        raise ProtocolError("File offer with a mismatching transfer id.")
+
+
+def content_hash(manifest):
+    """Name of a file's content, whatever the file is called: a hash of its size and chunk hashes."""
+    digest = hashlib.sha256(str(manifest["size"]).encode("ascii"))
+    for chunk_hash in manifest["hashes"]:
+        digest.update(chunk_hash.encode("ascii"))
+    return digest.hexdigest()
+
+
+def unique_path(folder, name):
+    """Path for a new file in folder, numbered like "name (2).txt" if the name is taken."""
+    stem, extension = os.path.splitext(name)
+    path = os.path.join(folder, name)
+    number = 1
+    while os.path.lexists(path):
+        number += 1
+        path = os.path.join(folder, f"{stem} ({number}){extension}")
+    return path
+
+
+def format_size(nbytes):
+    """Format a byte count for humans, e.g. 1.5 MB."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            break
+        nbytes /= 1024
+    return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+
+
+def to_ranges(indexes):
+    """Collapse sorted chunk indexes into [start, end) ranges."""
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+class OutgoingIndex:
+    """Files this side has offered, kept on disk so requests can be served after /reconnect."""
+
+    def __init__(self, path=OUTGOING_INDEX):
+        self.path = path
+        self.entries = None  # loaded lazily
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.path, "r") as f:
+                    entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                entries = {}
+            cutoff = time.time() - OUTGOING_MAX_AGE
+            self.entries = {tid: entry for tid, entry in entries.items() if entry["offered"] > cutoff}
+        return self.entries
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def add(self, filepath, manifest):
+        stat = os.stat(filepath)
+        self.load()[manifest["id"]] = {
+            "path": os.path.abspath(filepath),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "offered": time.time(),
+            "manifest": manifest,
+        }
+        self.save()
+
+    def get(self, tid):
+        return self.load().get(tid)
+
+    def is_unchanged(self, entry):
+        """Check that an offered file is still the one described by its manifest."""
+        try:
+            stat = os.stat(entry["path"])
+        except OSError:
+            return False
+        return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]
+
+
+class ContentStore:
+    """Received files by the hash of their content, so the same content is only downloaded once.
+
+    Blobs are hard links to the files in the transfer folder, so keeping them
+    costs no disk space. Files can be changed after they are received, so a
+    blob is checked against its chunk hashes before it is used.
+    """
+
+    def __init__(self, folder=CONTENT_FOLDER):
+        self.folder = folder
+
+    def blob_path(self, manifest):
+        key = content_hash(manifest)
+        return os.path.join(self.folder, key[:2], key)
+
+    def has(self, manifest):
+        return os.path.exists(self.blob_path(manifest))
+
+    def add(self, file_path, manifest):
+        """Keep a received file under its content hash."""
+        blob = self.blob_path(manifest)
+        if os.path.exists(blob):
+            return
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(file_path, blob)
+        except OSError:
+            tmp_path = blob + ".tmp"
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, blob)
+
+    def verify(self, manifest):
+        """Check that the blob still holds the content, forgetting it if it changed.
+
+        This reads the whole blob, so run it off the event loop.
+        """
+        blob = self.blob_path(manifest)
+        try:
+            if os.path.getsize(blob) != manifest["size"]:
+                raise ValueError
+            with open(blob, "rb") as f:
+                for chunk_hash in manifest["hashes"]:
+                    if hashlib.sha256(f.read(manifest["chunk_size"])).hexdigest() != chunk_hash:
+                        raise ValueError
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            os.remove(blob)
+            return False
+        return True
+
+    def fetch(self, manifest, folder=TRANSFER_FOLDER):
+        """Put stored content into the transfer folder under the file's name.
+
+        Returns the file path, or None if the content is not stored. Run it
+        off the event loop, it verifies the blob first.
+        """
+        if not self.verify(manifest):
+            return None
+        blob = self.blob_path(manifest)
+        file_path = os.path.join(folder, os.path.basename(manifest["name"]))
+        if os.path.exists(file_path) and os.path.samefile(file_path, blob):
+            return file_path
+        os.makedirs(folder, exist_ok=True)
+        file_path = unique_path(folder, os.path.basename(manifest["name"]))
+        tmp_path = file_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob, tmp_path)
+        except OSError:
+            shutil.copyfile(blob, tmp_path)
+        os.replace(tmp_path, file_path)
+        return file_path
+
+
+class PartialTransfer:
+    """Receiving side of a transfer.
+
+    Data goes into a preallocated .part file, and a bitmap of verified chunks is
+    kept next to it, so an interrupted transfer only requests what is missing.
+    """
+
+    def __init__(self, manifest, folder=PARTIAL_FOLDER):
+        self.manifest = manifest
+        self.id = manifest["id"]
+        self.name = os.path.basename(manifest["name"])
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.hashes = manifest["hashes"]
+        self.chunks = len(self.hashes)
+        self.outstanding = 0  # requested chunks not received yet
+        self.retries = 0
+        self.source = None  # peer the missing chunks were last requested from
+        self.patch = None  # Patcher rebuilding the file from an older copy, while a delta arrives
+
+        os.makedirs(folder, exist_ok=True)
+        base = os.path.join(folder, self.id)
+        self.part_path = base + ".part"
+        self.bitmap_path = base + ".bitmap"
+        self.manifest_path = base + ".manifest"
+
+        if not os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "w") as f:
+                json.dump(manifest, f)
+        bitmap_size = (self.chunks + 7) // 8
+        try:
+            with open(self.bitmap_path, "rb") as f:
+                self.bitmap = bytearray(f.read().ljust(bitmap_size, b"\0")[:bitmap_size])
+        except FileNotFoundError:
+            self.bitmap = bytearray(bitmap_size)
+            with open(self.bitmap_path, "wb") as f:
+                f.write(self.bitmap)
+        self.bitmap_file = open(self.bitmap_path, "r+b", buffering=0)
+
+        new_file = not os.path.exists(self.part_path)
+        self.file = open(self.part_path, "r+b" if not new_file else "w+b", buffering=0)
+        if new_file and self.size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self.file.fileno(), 0, self.size)
+
+    @classmethod
+    def load_all(cls, folder=PARTIAL_FOLDER):
+        """Load every interrupted transfer found on disk."""
+        transfers = []
+        if not os.path.isdir(folder):
+            return transfers
+        for entry in os.listdir(folder):
+            if entry.endswith(".manifest"):
+                try:
+                    with open(os.path.join(folder, entry), "r") as f:
+                        transfers.append(cls(json.load(f), folder))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return transfers
+
+    def has_chunk(self, index):
+        return self.bitmap[index >> 3] & (1 << (index & 7))
+
+    def missing_chunks(self):
+        return [index for index in range(self.chunks) if not self.has_chunk(index)]
+
+    def is_complete(self):
+        return all(self.has_chunk(index) for index in range(self.chunks))
+
+    def received_bytes(self):
+        return sum(self.chunk_length(index) for index in range(self.chunks) if self.has_chunk(index))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def mark_verified(self, index):
+        byte = index >> 3
+        self.bitmap[byte] |= 1 << (index & 7)
+        write_at(self.bitmap_file, self.bitmap[byte:byte + 1], byte)
+
+    def writer(self, first_index):
+        return ChunkWriter(self, first_index)
+
+    def verify_chunks(self):
+        """Mark the chunks a delta rebuilt correctly as verified.
+
+        This reads every chunk not verified yet, so run it off the event loop.
+        """
+        for index in range(self.chunks):
+            if not self.has_chunk(index):
+                data = read_at(self.file, self.chunk_length(index), index * self.chunk_size)
+                if hashlib.sha256(data).hexdigest() == self.hashes[index]:
+                    self.mark_verified(index)
+
+    def end_patch(self):
+        if self.patch:
+            self.patch.close()
+            self.patch = None
+
+    def close(self):
+        self.end_patch()
+        self.file.close()
+        self.bitmap_file.close()
+
+    def finish(self, folder=TRANSFER_FOLDER):
+        """Move the completed file into the transfer folder and drop its state.
+
+        A file of the same name already there is kept, the new one gets a
+        numbered name instead.
+        """
+        self.close()
+        os.makedirs(folder, exist_ok=True)
+        file_path = unique_path(folder, self.name)
+        os.replace(self.part_path, file_path)
+        os.remove(self.bitmap_path)
+        os.remove(self.manifest_path)
+        return file_path
+
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.bitmap_path, self.manifest_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ChunkWriter:
+    """Writes consecutive chunks as they arrive, possibly over several frames, and verifies each one."""
+
+    def __init__(self, transfer, first_index):
+        if first_index >= transfer.chunks:
+            raise ProtocolError(f"Chunk {first_index} is out of range.")
+        self.transfer = transfer
+        self.index = first_index
+        self.offset = first_index * transfer.chunk_size
+        self.filled = 0  # bytes of the current chunk received so far
+        self.hasher = hashlib.sha256()
+        self.corrupt = []  # indexes of chunks that failed verification
+
+    def write(self, data):
+        started = time.perf_counter()
+        transfer = self.transfer
+        data = memoryview(data)
+        while data:
+            if self.index >= transfer.chunks:
+                raise ProtocolError("File data runs past the end of the file.")
+            length = transfer.chunk_length(self.index)
+            piece = data[:length - self.filled]
+            data = data[len(piece):]
+            while piece:
+                written = write_at(transfer.file, piece, self.offset)
+                self.hasher.update(piece[:written])
+                piece = piece[written:]
+                self.filled += written
+                self.offset += written
+            if self.filled == length:
+                self.chunk_done()
+        METRICS.since("chunk_write", started)
+
+    def chunk_done(self):
+        transfer = self.transfer
+        if self.hasher.hexdigest() == transfer.hashes[self.index]:
+            transfer.mark_verified(self.index)
+            METRICS.count("chunks_verified")
+        else:
+            self.corrupt.append(self.index)
+            METRICS.count("chunks_corrupt")
+        transfer.outstanding = max(transfer.outstanding - 1, 0)
+        self.index += 1
+        self.filled = 0
+        self.hasher = hashlib.sha256()
@@ -0,0 +1,800 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from src.compression import CODEC_IDS, MIN_SAVING, SKIP_FRAMES, compress_chunk, decompress_chunk
+from src.delta import DELTA_BLOCK_MIN, DELTA_MIN_SIZE, DELTA_SPAN_MAX, DeltaEncoder, Patcher, block_size_for, file_signatures
+from src.metrics import METRICS
+from src.protocol import (
+    ProtocolError, FIRST_TRANSFER_CHANNEL, FRAME_FILE_COMPRESSED, FRAME_FILE_DATA, FRAME_FILE_SEALED,
+    FRAME_FILE_OFFER, FRAME_FILE_REQUEST, FRAME_FILE_DONE, FRAME_FILE_CANCEL, FRAME_FILE_PAUSE,
+    FRAME_FILE_DELTA, FRAME_FILE_DELTA_REQUEST,
+)
+from src.transfer import (
+    COMPRESSED_PREFIX, DATA_PREFIX, DELTA_PREFIX, SEALED_PREFIX, TRANSFER_FOLDER, ContentStore, OutgoingIndex, PartialTransfer,
+    build_manifest, format_size, to_ranges, validate_manifest,
+)
+
+# File data frames grow or shrink between these sizes so that sending one
+# frame takes about FILE_CHUNK_TARGET_TIME seconds. Chat waits for at most
+# one such frame.
+FILE_CHUNK_MIN = 64 * 1024
+FILE_CHUNK_MAX = 8 * 1024 * 1024
+FILE_CHUNK_TARGET_TIME = 0.02
+# How many times corrupt or missing chunks are requested again
+TRANSFER_RETRIES = 3
+# Threads doing blocking file work: hashing, preallocating .part files,
+# compressing and encrypting file data
+TRANSFER_WORKERS = 4
+# Progress of all transfers is reported together at most this often (seconds)
+PROGRESS_INTERVAL = 0.25
+# Progress states after which a transfer is gone
+FINAL_STATES = ("done", "cancelled", "failed", "interrupted")
+
+
+def adapt_chunk_size(chunk_size, elapsed):
+    """Return the next file chunk size given how long the last chunk took to send."""
+    if elapsed < FILE_CHUNK_TARGET_TIME / 2:
+        return min(chunk_size * 2, FILE_CHUNK_MAX)
+    if elapsed > FILE_CHUNK_TARGET_TIME * 2:
+        return max(chunk_size // 2, FILE_CHUNK_MIN)
+    return chunk_size
+
+
+def encode_json(data):
+    return json.dumps(data).encode("utf-8")
+
+
+def read_region(path, offset, count, codec=None):
+    """Read a region of a file, compressed with codec if that saves at least MIN_SAVING.
+
+    Returns the data, the codec id or 0 if it is not compressed, and the time
+    compression took. Runs in the worker pool, on its own file handle.
+    """
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(count)
+    METRICS.since("chunk_read", started)
+    if not codec:
+        return data, 0, 0.0
+    started = time.perf_counter()
+    packed = compress_chunk(codec, data)
+    elapsed = time.perf_counter() - started
+    METRICS.observe("chunk_compress", elapsed)
+    if len(packed) > len(data) * (1 - MIN_SAVING):
+        return data, 0, elapsed
+    return packed, CODEC_IDS[codec], elapsed
+
+
+def read_sealed(path, offset, count, codec, cipher, channel, seq):
+    """Read a region of a file like read_region and encrypt it, returning the sealed frame's prefix and body."""
+    from src.cipher import seal_chunk
+
+    data, codec_id, elapsed = read_region(path, offset, count, codec)
+    prefix = SEALED_PREFIX.pack(seq, offset, codec_id, count)
+    return prefix, seal_chunk(data, cipher, channel, seq, prefix), codec_id, elapsed
+
+
+def open_sealed(payload, cipher, channel):
+    """Decrypt, and decompress, a sealed frame payload into (offset, file data). Runs in the worker pool."""
+    from src.cipher import unseal_chunk
+
+    seq, offset, codec_id, size = SEALED_PREFIX.unpack_from(payload)
+    payload = memoryview(payload)
+    try:
+        data = unseal_chunk(payload[SEALED_PREFIX.size:], cipher, channel, seq, payload[:SEALED_PREFIX.size])
+    except ValueError as e:
+        raise ProtocolError(f"Sealed {e}")
+    if codec_id:
+        data = decompress_chunk(codec_id, data, size)
+    elif len(data) != size:
+        raise ProtocolError("Sealed file data does not match its size.")
+    return offset, data
+
+
+def read_delta(encoder, cipher, channel, seq):
+    """Encode the next delta frame, sealed if cipher is given. Runs in the worker pool.
+
+    Returns the frame's prefix and body, how much of the file it covers and
+    whether it is the last one.
+    """
+    from src.cipher import seal_chunk
+
+    ops, covered, last = encoder.next_ops()
+    prefix = DELTA_PREFIX.pack(seq)
+    if cipher:
+        ops = seal_chunk(ops, cipher, channel, seq, prefix)
+    return prefix, ops, covered, last
+
+
+def open_delta(payload, cipher, channel):
+    """Decrypt the ops of a sealed delta frame. Runs in the worker pool."""
+    from src.cipher import unseal_chunk
+
+    (seq,) = DELTA_PREFIX.unpack_from(payload)
+    payload = memoryview(payload)
+    try:
+        return unseal_chunk(payload[DELTA_PREFIX.size:], cipher, channel, seq, payload[:DELTA_PREFIX.size])
+    except ValueError as e:
+        raise ProtocolError(f"Sealed {e}")
+
+
+def requested_bytes(manifest, ranges):
+    chunk_size = manifest["chunk_size"]
+    return sum(max(min(end * chunk_size, manifest["size"]) - start * chunk_size, 0) for start, end in ranges)
+
+
+class Progress:
+    """Bytes moved by one download or upload, with a smoothed rate and an ETA."""
+
+    def __init__(self, key, tid, name, direction, total, done=0, peer=None):
+        self.key = key
+        self.id = tid
+        self.name = name
+        self.direction = direction  # "down" or "up"
+        self.total = total
+        self.done = done
+        self.peer = peer  # the peer an upload goes to
+        self.state = "active"
+        self.rate = 0.0  # bytes per second
+        self.reported_done = done
+        self.reported_state = None
+        self.reported_at = time.monotonic()
+
+    def changed(self):
+        return self.done != self.reported_done or self.state != self.reported_state
+
+    def snapshot(self, now=None):
+        """Describe the transfer for the UI and restart the rate measurement."""
+        now = now or time.monotonic()
+        elapsed = now - self.reported_at
+        if elapsed > 0:
+            rate = (self.done - self.reported_done) / elapsed
+            self.rate = rate if not self.rate else 0.7 * self.rate + 0.3 * rate
+        self.reported_done, self.reported_state, self.reported_at = self.done, self.state, now
+        remaining = max(self.total - self.done, 0)
+        return {
+            "key": self.key,
+            "id": self.id,
+            "name": self.name,
+            "direction": self.direction,
+            "state": self.state,
+            "done": self.done,
+            "total": self.total,
+            "rate": self.rate,
+            "eta": remaining / self.rate if self.rate > 0 and self.state == "active" else None,
+        }
+
+
+class Upload:
+    """Requested chunk ranges being sent to one peer on one channel."""
+
+    def __init__(self, peer, entry, channel, ranges, progress):
+        self.peer = peer
+        self.entry = entry
+        self.id = entry["manifest"]["id"]
+        self.channel = channel
+        self.ranges = ranges
+        self.progress = progress
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.task = None
+        self.skip = 0  # frames left to send uncompressed before trying compression again
+        self.link_rate = 0.0  # bytes per second the last frame went out at
+        self.compress_rate = 0.0  # bytes per second the last frame was compressed at
+
+    def next_codec(self):
+        """The codec to try on the next frame, or None while compression is skipped.
+
+        Data that does not compress, like archives or videos, is sent as it is,
+        and so is everything while the link is faster than compression; the
+        next SKIP_FRAMES frames then do not try again.
+        """
+        codec = self.peer.codec
+        if not codec:
+            return None
+        if self.skip:
+            self.skip -= 1
+            return None
+        if self.link_rate > self.compress_rate > 0:
+            self.skip = SKIP_FRAMES
+            return None
+        return codec
+
+    def compressed(self, count, codec_id, elapsed):
+        """Account for a frame of count bytes that compression was tried on."""
+        self.compress_rate = count / max(elapsed, 1e-6)
+        if not codec_id:
+            self.skip = SKIP_FRAMES
+
+
+class TransferManager:
+    """Offers, downloads and uploads of one ChatEngine.
+
+    Transfers run side by side on the engine's event loop; blocking file work
+    goes to a small worker pool. Offers wait until accepted, and progress of
+    every transfer is reported in one batch per PROGRESS_INTERVAL, so the UI
+    load does not grow with the number or speed of transfers.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.outgoing = OutgoingIndex()
+        self.content = ContentStore()
+        self.incoming = None  # transfer id -> PartialTransfer, loaded lazily
+        self.offers = {}  # transfer id -> (peer, manifest) not accepted yet
+        self.uploads = {}  # (peer, transfer id) -> Upload
+        self.progress = {}  # key -> Progress
+        self.reporter = None
+        self.pool = None
+
+    def run_in_pool(self, func, *args):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(TRANSFER_WORKERS, thread_name_prefix="transfer")
+        return asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    def close(self):
+        for transfer in (self.incoming or {}).values():
+            transfer.close()
+        if self.pool:
+            self.pool.shutdown(wait=False)
+
+    # Progress reporting
+
+    def track(self, progress):
+        self.progress[progress.key] = progress
+        if self.reporter is None or self.reporter.done():
+            self.reporter = self.engine.spawn(self.report_progress(), "Error reporting progress")
+        return progress
+
+    def finish_progress(self, key, state):
+        progress = self.progress.pop(key, None)
+        if progress:
+            progress.state = state
+            if state == "done":
+                progress.done = progress.total
+            self.engine.on_progress([progress.snapshot()])
+
+    async def report_progress(self):
+        while self.progress:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            now = time.monotonic()
+            snapshots = [progress.snapshot(now) for progress in self.progress.values()
+                         if progress.state == "active" or progress.changed()]
+            if snapshots:
+                self.engine.on_progress(snapshots)
+
+    def download_progress(self, transfer):
+        progress = self.progress.get(f"down:{transfer.id}")
+        if progress is None:
+            progress = self.track(Progress(
+                f"down:{transfer.id}", transfer.id, transfer.name, "down", transfer.size, transfer.received_bytes(),
+            ))
+        return progress
+
+    # Sending files: offer a manifest, then serve the chunks the receiver asks for
+
+    def send_file(self, filepath):
+        self.engine.spawn(self.offer_file(filepath), "Error sending file")
+
+    async def offer_file(self, filepath):
+        """Hash a file in the worker pool and offer its manifest to every peer."""
+        manifest = await self.run_in_pool(build_manifest, filepath)
+        self.outgoing.add(filepath, manifest)
+        peers = self.engine.ready_peers()
+        if not peers:
+            self.engine.spool_offline("file", filepath)
+            return
+        offer = encode_json(manifest)
+        for peer in peers:
+            peer.send_frame(FRAME_FILE_OFFER, offer)
+        message = f"Offered {manifest['name']} ({format_size(manifest['size'])})."
+        self.engine.record("out", message, transfer=manifest["id"])
+        self.engine.on_message(message)
+
+    def serve_request(self, peer, request, delta=False):
+        """Start sending the chunks a peer asked for, or with delta, what changed since its older copy."""
+        entry = self.outgoing.get(request["id"])
+        if entry is None:
+            return  # offered by someone else
+        if not self.outgoing.is_unchanged(entry):
+            peer.send_frame(FRAME_FILE_CANCEL, encode_json({
+                "id": request["id"], "reason": "the file changed on the sender's side",
+            }))
+            return
+        channel = request["channel"]
+        if not FIRST_TRANSFER_CHANNEL <= channel <= 0xFFFF:
+            raise ProtocolError(f"Invalid transfer channel {channel}.")
+        if delta:
+            block_size = request.get("block_size")
+            # A block of 0 bytes would never move the encoder forward
+            if type(block_size) is not int or not DELTA_BLOCK_MIN <= block_size <= DELTA_SPAN_MAX:
+                raise ProtocolError(f"Invalid delta block size {block_size!r}.")
+        previous = self.uploads.get((peer, request["id"]))
+        if previous:
+            self.stop_upload(previous)
+        manifest = entry["manifest"]
+        ranges = [[0, len(manifest["hashes"])]] if delta else request["ranges"]
+        key = f"up:{manifest['id']}:{peer.addr}"
+        progress = self.track(Progress(
+            key, manifest["id"], manifest["name"], "up", manifest["size"],
+            manifest["size"] - requested_bytes(manifest, ranges), peer,
+        ))
+        upload = self.uploads[(peer, manifest["id"])] = Upload(peer, entry, channel, ranges, progress)
+        if delta:
+            upload.task = self.engine.spawn(self.send_delta(upload, request), "Error sending file")
+        else:
+            upload.task = self.engine.spawn(self.send_chunks(upload), "Error sending file")
+
+    async def send_chunks(self, upload):
+        """Stream the requested chunk ranges on the transfer's channel, one frame from send_region at a time.
+
+        Two frames are kept queued so the link stays busy while the next one is
+        prepared, and the frame size adapts to how long each one takes to send.
+        """
+        peer = upload.peer
+        manifest = upload.entry["manifest"]
+        chunk_size = manifest["chunk_size"]
+        chunks = len(manifest["hashes"])
+        frame_size = FILE_CHUNK_MIN
+        pending = deque()
+        try:
+            with open(upload.entry["path"], "rb") as f:
+                for start, end in upload.ranges:
+                    offset = max(start, 0) * chunk_size
+                    end_offset = min(min(end, chunks) * chunk_size, manifest["size"])
+                    while offset < end_offset:
+                        await upload.resumed.wait()
+                        count = min(frame_size, end_offset - offset)
+                        pending.append((count, *await self.send_region(upload, f, offset, count)))
+                        offset += count
+                        if len(pending) > 1:
+                            count, done, size = pending.popleft()
+                            elapsed = await done
+                            upload.link_rate = size / max(elapsed, 1e-6)
+                            frame_size = adapt_chunk_size(frame_size, elapsed)
+                            upload.progress.done += count
+                while pending:
+                    count, done, size = pending.popleft()
+                    await done
+                    upload.progress.done += count
+        finally:
+            if self.uploads.get((peer, upload.id)) is upload:
+                del self.uploads[(peer, upload.id)]
+
+    async def send_delta(self, upload, request):
+        """Stream the file as delta ops against the signatures of the receiver's older copy.
+
+        Like send_chunks, two frames are kept queued while the next one is
+        encoded in the worker pool.
+        """
+        peer = upload.peer
+        signatures = base64.b64decode(request["signatures"])
+        encoder = await self.run_in_pool(DeltaEncoder, upload.entry["path"], request["block_size"], signatures)
+        pending = deque()
+        try:
+            last = False
+            while not last:
+                await upload.resumed.wait()
+                seq = peer.next_file_seq(upload.channel)
+                prefix, ops, covered, last = await self.run_in_pool(
+                    read_delta, encoder, peer.file_sender, upload.channel, seq,
+                )
+                pending.append((covered, peer.send_file_frame(upload.channel, FRAME_FILE_DELTA, prefix, ops)))
+                if len(pending) > 1:
+                    covered, done = pending.popleft()
+                    await done
+                    upload.progress.done += covered
+            while pending:
+                covered, done = pending.popleft()
+                await done
+                upload.progress.done += covered
+            if encoder.copied:
+                self.engine.on_message(
+                    f"Sent {upload.progress.name} to {peer.addr} as a delta, "
+                    f"{format_size(encoder.copied)} of it was already there."
+                )
+        finally:
+            if self.uploads.get((peer, upload.id)) is upload:
+                del self.uploads[(peer, upload.id)]
+        # Closed only once done: when cancelled, a worker may still be encoding
+        encoder.close()
+
+    async def send_region(self, upload, f, offset, count):
+        """Queue one frame of file data, returning its future and its size on the wire.
+
+        Unless both sides allow plain file data, the frame is encrypted in the
+        worker pool while the previous one is on the wire, and so is compression
+        when the peer agreed on a codec. Only plain, uncompressed frames are
+        sent straight from the file with sendfile.
+        """
+        peer = upload.peer
+        path = upload.entry["path"]
+        codec = upload.next_codec()
+        if peer.file_sender:
+            seq = peer.next_file_seq(upload.channel)
+            prefix, data, codec_id, elapsed = await self.run_in_pool(
+                read_sealed, path, offset, count, codec, peer.file_sender, upload.channel, seq,
+            )
+            if codec:
+                upload.compressed(count, codec_id, elapsed)
+            return peer.send_file_frame(upload.channel, FRAME_FILE_SEALED, prefix, data), len(prefix) + len(data)
+        if codec:
+            data, codec_id, elapsed = await self.run_in_pool(read_region, path, offset, count, codec)
+            upload.compressed(count, codec_id, elapsed)
+            if codec_id:
+                prefix = COMPRESSED_PREFIX.pack(offset, codec_id, count)
+                return peer.send_file_frame(upload.channel, FRAME_FILE_COMPRESSED, prefix, data), len(prefix) + len(data)
+            # Already read, so no need for sendfile
+            return peer.send_file_frame(upload.channel, FRAME_FILE_DATA, DATA_PREFIX.pack(offset), data), count
+        return peer.send_file_region(upload.channel, DATA_PREFIX.pack(offset), f, offset, count), count
+
+    def stop_upload(self, upload):
+        """Stop sending an upload, including the frames already queued for it."""
+        if self.uploads.get((upload.peer, upload.id)) is upload:
+            del self.uploads[(upload.peer, upload.id)]
+        if upload.task:
+            upload.task.cancel()
+        for item in upload.peer.mux.drop(upload.channel):
+            item[-1].cancel()
+
+    def uploads_of(self, tid):
+        return [upload for (_, upload_id), upload in self.uploads.items() if upload_id == tid]
+
+    def transfer_delivered(self, peer, done):
+        entry = self.outgoing.get(done["id"])
+        if entry:
+            self.finish_progress(f"up:{done['id']}:{peer.addr}", "done")
+            if done.get("cached"):
+                self.engine.on_message(f"{peer.addr} already had {entry['manifest']['name']}, nothing was sent.")
+            else:
+                self.engine.on_message(f"{entry['manifest']['name']} delivered to {peer.addr}.")
+
+    def upload_paused(self, peer, pause):
+        upload = self.uploads.get((peer, pause["id"]))
+        if upload:
+            self.stop_upload(upload)
+            upload.progress.state = "paused"
+
+    # Receiving files: keep a bitmap of verified chunks and request what is missing
+
+    def incoming_transfers(self):
+        if self.incoming is None:
+            self.incoming = {}
+            for transfer in PartialTransfer.load_all():
+                self.incoming[transfer.id] = transfer
+                self.download_progress(transfer).state = "waiting"
+        return self.incoming
+
+    def receive_offer(self, peer, manifest):
+        validate_manifest(manifest)
+        transfer = self.incoming_transfers().get(manifest["id"])
+        if transfer:
+            # Accepted before: carry on unless the user paused it
+            if self.download_progress(transfer).state != "paused":
+                self.request_chunks(peer, transfer)
+            return
+        self.offers[manifest["id"]] = (peer, manifest)
+        self.engine.record("in", f"File offered: {manifest['name']} ({format_size(manifest['size'])})", peer, manifest["id"])
+        self.engine.on_offer(manifest["id"], manifest["name"], manifest["size"])
+
+    def accept(self, tid):
+        offer = self.offers.pop(tid, None)
+        if offer is None:
+            self.engine.on_message("That file is not on offer anymore.")
+            return
+        self.engine.spawn(self.start_download(*offer), "Error receiving file")
+
+    async def start_download(self, peer, manifest):
+        """Copy the file from the content store if it is there, or preallocate the .part file and request every chunk."""
+        incoming = self.incoming_transfers()
+        transfer = incoming.get(manifest["id"])
+        if transfer is None and self.content.has(manifest):
+            file_path = await self.run_in_pool(self.content.fetch, manifest)
+            if file_path:
+                self.fetched(peer, manifest, file_path)
+                return
+        if transfer is None:
+            transfer = await self.run_in_pool(PartialTransfer, manifest)
+            incoming[transfer.id] = transfer
+        if transfer.is_complete():
+            self.complete_transfer(peer, transfer)
+            return
+        received = transfer.received_bytes()
+        if received:
+            self.engine.on_message(
+                f"Resuming {transfer.name} ({format_size(received)} of {format_size(transfer.size)} already here)..."
+            )
+        else:
+            self.engine.on_message(f"Receiving {transfer.name} ({format_size(transfer.size)})...")
+        if peer not in self.engine.peers:
+            peer = next(iter(self.engine.ready_peers()), None)
+        old_path = os.path.join(TRANSFER_FOLDER, transfer.name)
+        if not peer:
+            self.download_progress(transfer).state = "waiting"
+        elif not received and transfer.size >= DELTA_MIN_SIZE and os.path.isfile(old_path) \
+                and os.path.getsize(old_path) >= DELTA_MIN_SIZE:
+            await self.request_delta(peer, transfer, old_path)
+        else:
+            self.request_chunks(peer, transfer)
+
+    async def request_delta(self, peer, transfer, old_path):
+        """Ask for the file as a delta against an older copy, by sending the copy's block signatures."""
+        block_size = block_size_for(os.path.getsize(old_path))
+        signatures = await self.run_in_pool(file_signatures, old_path, block_size)
+        if peer not in self.engine.peers or transfer.id not in self.incoming:
+            return
+        transfer.patch = Patcher(old_path, transfer.file, transfer.size)
+        transfer.source = peer
+        progress = self.download_progress(transfer)
+        progress.state = "active"
+        peer.send_frame(FRAME_FILE_DELTA_REQUEST, encode_json({
+            "id": transfer.id,
+            "channel": peer.transfer_channel(transfer),
+            "block_size": block_size,
+            "signatures": base64.b64encode(signatures).decode("ascii"),
+        }))
+
+    def apply_delta(self, peer, channel, ops):
+        """Rebuild the next part of a file from delta ops, once its frame is in order and decrypted."""
+        transfer = peer.channels.get(channel)
+        if transfer is None or transfer.patch is None or transfer.id not in self.incoming_transfers():
+            return  # cancelled, paused or gone back to plain requests
+        self.download_progress(transfer).done += transfer.patch.apply(ops)
+        if transfer.patch.finished:
+            copied = transfer.patch.copied
+            transfer.end_patch()
+            self.engine.spawn(self.finish_delta(peer, transfer, copied), "Error receiving file")
+
+    async def finish_delta(self, peer, transfer, copied):
+        """Check the chunks the delta rebuilt and request the ones it did not get right."""
+        await self.run_in_pool(transfer.verify_chunks)
+        if transfer.id not in self.incoming:
+            return
+        if copied:
+            self.engine.on_message(
+                f"Rebuilt {transfer.name} from your older copy, {format_size(copied)} of it did not have to be sent."
+            )
+        if transfer.is_complete():
+            self.complete_transfer(peer, transfer)
+        elif peer in self.engine.peers:
+            self.request_chunks(peer, transfer)
+        else:
+            self.download_progress(transfer).state = "waiting"
+
+    def request_chunks(self, peer, transfer):
+        transfer.end_patch()  # a delta being applied is abandoned, what it verified is kept
+        missing = transfer.missing_chunks()
+        transfer.outstanding = len(missing)
+        transfer.source = peer
+        progress = self.download_progress(transfer)
+        progress.state = "active"
+        progress.done = transfer.received_bytes()
+        peer.send_frame(FRAME_FILE_REQUEST, encode_json({
+            "id": transfer.id,
+            "channel": peer.transfer_channel(transfer),
+            "ranges": to_ranges(missing),
+        }))
+
+    def session_ready(self, peer):
+        """Resume interrupted downloads that have nobody to get them from."""
+        for transfer in self.incoming_transfers().values():
+            if transfer.source in self.engine.peers:
+                continue
+            if self.download_progress(transfer).state != "paused":
+                self.request_chunks(peer, transfer)
+
+    def file_data_writer(self, peer, channel, offset):
+        """Return the ChunkWriter for a file data frame, or None if its transfer is unknown."""
+        transfer = peer.channels.get(channel)
+        if transfer is None or transfer.id not in self.incoming_transfers():
+            return None
+        writer = peer.writers.get(channel)
+        if writer and writer.offset == offset:
+            return writer  # continues the chunk the previous frame started
+        if offset % transfer.chunk_size:
+            raise ProtocolError("File data does not start at a chunk boundary.")
+        writer = peer.writers[channel] = transfer.writer(offset // transfer.chunk_size)
+        return writer
+
+    def write_file_data(self, peer, channel, offset, data):
+        """Write a whole frame of file data that is already in memory."""
+        writer = self.file_data_writer(peer, channel, offset)
+        if writer:
+            writer.write(data)
+            self.file_data_done(peer, writer, len(data))
+
+    def check_sequence(self, peer, channel, seq):
+        """Sequence numbers only go up on a channel, so frames cannot be replayed or reordered."""
+        if seq <= peer.file_recv_seq.get(channel, 0):
+            raise ProtocolError("File data replayed or out of order.")
+        peer.file_recv_seq[channel] = seq
+
+    def open_file_data(self, peer, frame_type, channel, payload):
+        """Check where a sealed file data or delta frame belongs in its channel and decrypt it in the worker pool.
+
+        Returns a future of the decrypted frame and the function to hand it
+        to once the frames before it are done.
+        """
+        if not peer.file_receiver:
+            raise ProtocolError("Encrypted file data on a session without file encryption.")
+        transfer = peer.channels.get(channel)
+        if transfer is None or transfer.id not in self.incoming_transfers():
+            dropped = asyncio.get_running_loop().create_future()
+            dropped.set_result(None)  # nothing to decrypt it for
+            return dropped, lambda frame: None
+        if frame_type == FRAME_FILE_DELTA:
+            (seq,) = DELTA_PREFIX.unpack_from(payload)
+            self.check_sequence(peer, channel, seq)
+            opened = self.run_in_pool(open_delta, bytes(payload), peer.file_receiver, channel)
+            return opened, lambda ops: self.apply_delta(peer, channel, ops)
+        seq, offset, _, size = SEALED_PREFIX.unpack_from(payload)
+        if not 0 < size <= min(FILE_CHUNK_MAX, transfer.size - offset):
+            raise ProtocolError(f"Sealed file data of {size} bytes does not fit its transfer.")
+        self.check_sequence(peer, channel, seq)
+        opened = self.run_in_pool(open_sealed, bytes(payload), peer.file_receiver, channel)
+        return opened, lambda data: self.write_file_data(peer, channel, *data)
+
+    def file_data_done(self, peer, writer, nbytes):
+        transfer = writer.transfer
+        progress = self.download_progress(transfer)
+        progress.done += nbytes
+        if writer.corrupt:
+            self.engine.on_message(f"{len(writer.corrupt)} corrupt chunk(s) of {transfer.name}, requesting them again.")
+            writer.corrupt.clear()
+        if transfer.outstanding:
+            return
+        if transfer.is_complete():
+            self.complete_transfer(peer, transfer)
+        elif progress.state != "active":
+            return  # paused, the rest is requested on resume
+        elif transfer.retries < TRANSFER_RETRIES:
+            transfer.retries += 1
+            self.request_chunks(peer, transfer)
+        else:
+            self.drop_download(transfer, "failed")
+            self.engine.on_message(f"Transfer of {transfer.name} failed: chunks keep failing verification.")
+
+    def complete_transfer(self, peer, transfer):
+        del self.incoming[transfer.id]
+        for known_peer in self.engine.peers:
+            known_peer.forget_transfer(transfer)
+        file_path = transfer.finish()
+        try:
+            self.content.add(file_path, transfer.manifest)
+        except OSError as e:
+            self.engine.on_message(f"Could not keep {transfer.name} in the content store: {e}")
+        peer.send_frame(FRAME_FILE_DONE, encode_json({"id": transfer.id}))
+        self.finish_progress(f"down:{transfer.id}", "done")
+        message = f"Downloaded {transfer.name} ({format_size(transfer.size)}) to {TRANSFER_FOLDER}"
+        self.engine.record("in", message, peer, transfer.id)
+        self.engine.on_file(file_path, os.path.basename(file_path))
+        self.engine.on_message(message)
+
+    def fetched(self, peer, manifest, file_path):
+        """Finish a download whose content was already in the content store."""
+        if peer in self.engine.peers:
+            peer.send_frame(FRAME_FILE_DONE, encode_json({"id": manifest["id"], "cached": True}))
+        name = os.path.basename(manifest["name"])
+        message = f"Already had {name} ({format_size(manifest['size'])}), copied it to {TRANSFER_FOLDER} without downloading"
+        self.engine.record("in", message, peer, manifest["id"])
+        self.engine.on_file(file_path, os.path.basename(file_path))
+        self.engine.on_message(message)
+
+    def drop_download(self, transfer, state):
+        """Forget a download and delete what was received of it."""
+        self.incoming.pop(transfer.id, None)
+        for peer in self.engine.peers:
+            peer.forget_transfer(transfer)
+        transfer.discard()
+        self.finish_progress(f"down:{transfer.id}", state)
+
+    def transfer_cancelled(self, peer, cancel):
+        transfer = self.incoming_transfers().get(cancel["id"])
+        if transfer and transfer.source in (peer, None):
+            self.drop_download(transfer, "cancelled")
+            self.engine.on_message(f"Transfer of {transfer.name} cancelled: {cancel['reason']}.")
+        upload = self.uploads.get((peer, cancel["id"]))
+        if upload:
+            self.stop_upload(upload)
+            self.finish_progress(upload.progress.key, "cancelled")
+            self.engine.on_message(f"{peer.addr} cancelled {upload.progress.name}: {cancel['reason']}.")
+
+    def peer_lost(self, peer):
+        """Stop uploads to a disconnected peer; its downloads wait for a new session."""
+        for upload in [upload for upload in self.uploads.values() if upload.peer is peer]:
+            self.stop_upload(upload)
+        for progress in [progress for progress in self.progress.values() if progress.peer is peer]:
+            self.finish_progress(progress.key, "interrupted")
+        for transfer in (self.incoming or {}).values():
+            if transfer.source is peer:
+                transfer.source = None
+                progress = self.download_progress(transfer)
+                if progress.state == "active":
+                    progress.state = "waiting"
+
+    # User commands, called on the event loop
+
+    def command(self, action, prefix):
+        if action == "list":
+            self.list_transfers()
+            return
+        actions = {"accept": self.accept, "pause": self.pause, "resume": self.resume, "cancel": self.cancel}
+        tid = self.find(prefix)
+        if tid:
+            actions[action](tid)
+
+    def find(self, prefix):
+        """Resolve a transfer id from its first few characters."""
+        ids = set(self.offers) | set(self.incoming or {}) | {progress.id for progress in self.progress.values()}
+        matches = [tid for tid in ids if prefix and tid.startswith(prefix)]
+        if len(matches) == 1:
+            return matches[0]
+        if matches:
+            self.engine.on_message(f"Transfer id {prefix} is ambiguous.")
+        else:
+            self.engine.on_message(f"No transfer matches {prefix}.")
+        return None
+
+    def list_transfers(self):
+        lines = []
+        for tid, (peer, manifest) in self.offers.items():
+            lines.append(f"{tid[:8]} offer {manifest['name']} ({format_size(manifest['size'])}) from {peer.addr}")
+        for progress in self.progress.values():
+            percent = progress.done * 100 // progress.total if progress.total else 100
+            lines.append(f"{progress.id[:8]} {progress.direction} {progress.name} {progress.state} {percent}%")
+        if lines:
+            self.engine.on_message("Transfers:\n" + "\n".join(lines))
+        else:
+            self.engine.on_message("No transfers.")
+
+    def pause(self, tid):
+        progress = self.progress.get(f"down:{tid}")
+        if progress and progress.state in ("active", "waiting"):
+            progress.state = "paused"
+            source = self.incoming[tid].source
+            if source in self.engine.peers:
+                source.send_frame(FRAME_FILE_PAUSE, encode_json({"id": tid}))
+        for upload in self.uploads_of(tid):
+            upload.resumed.clear()
+            upload.progress.state = "paused"
+        self.engine.on_message(f"Paused {tid[:8]}.")
+
+    def resume(self, tid):
+        progress = self.progress.get(f"down:{tid}")
+        if progress and progress.state == "paused":
+            transfer = self.incoming[tid]
+            peer = transfer.source
+            if peer not in self.engine.peers:
+                peer = next(iter(self.engine.ready_peers()), None)
+            if peer:
+                self.request_chunks(peer, transfer)
+            else:
+                progress.state = "waiting"
+        for upload in self.uploads_of(tid):
+            upload.resumed.set()
+            upload.progress.state = "active"
+        self.engine.on_message(f"Resumed {tid[:8]}.")
+
+    def cancel(self, tid):
+        offer = self.offers.pop(tid, None)
+        if offer:
+            self.engine.on_message(f"Declined {offer[1]['name']}.")
+        transfer = (self.incoming or {}).get(tid)
+        if transfer:
+            if transfer.source in self.engine.peers:
+                transfer.source.send_frame(FRAME_FILE_CANCEL, encode_json({
+                    "id": tid, "reason": "cancelled by the receiver",
+                }))
+            self.drop_download(transfer, "cancelled")
+            self.engine.on_message(f"Cancelled {transfer.name}.")
+        for upload in self.uploads_of(tid):
+            self.stop_upload(upload)
+            upload.peer.send_frame(FRAME_FILE_CANCEL, encode_json({"id": tid, "reason": "cancelled by the sender"}))
+            self.finish_progress(upload.progress.key, "cancelled")
+            self.engine.on_message(f"Cancelled sending {upload.progress.name} to {upload.peer.addr}.")
@@ -0,0 +1,55 @@
+import asyncio
+import socket
+import time
+
+from src.engine import ChatEngine
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def until(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_relay_only_forwards_rooms(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    port = free_port()
+    shown = {"relay": [], "a": [], "b": []}
+
+    async def main():
+        relay = ChatEngine(relay=True, port=port, on_message=shown["relay"].append)
+        relay_task = asyncio.create_task(relay.run())
+        await until(lambda: any("Listening" in m for m in shown["relay"]))
+        a = ChatEngine(ip="127.0.0.1", port=port, on_message=shown["a"].append, reconnect_max_delay=0)
+        b = ChatEngine(ip="127.0.0.1", port=port, on_message=shown["b"].append, reconnect_max_delay=0)
+        tasks = [asyncio.create_task(a.run()), asyncio.create_task(b.run())]
+        await until(lambda: a.ready_peers() and b.ready_peers() and len(relay.ready_peers()) == 2)
+
+        a.send_chat("plain secret")
+        a.send_chat("another plain secret")
+        await until(lambda: any("/join" in m for m in shown["a"]))
+        await until(lambda: not len(a.spool))  # the relay acknowledged them
+        await asyncio.sleep(0.2)
+        assert not any("secret" in m for m in shown["b"] + shown["relay"])
+        assert sum("/join" in m for m in shown["a"]) == 1
+        assert not len(relay.spool)
+
+        for engine in (a, b):
+            await engine.join("lobby", "")
+        await until(lambda: all(any("Joined room" in m for m in shown[name]) for name in "ab"))
+        a.send_chat("room message")
+        await until(lambda: any("room message" in m for m in shown["b"]))
+        assert not any("room message" in m for m in shown["relay"])
+
+        for engine in (a, b, relay):
+            engine.stop()
+        await asyncio.gather(*tasks, relay_task, return_exceptions=True)
+
+    asyncio.run(main())
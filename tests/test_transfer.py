@@ -0,0 +1,54 @@
+import pytest
+
+from src.protocol import ProtocolError
+from src.transfer import CHUNK_SIZE, build_manifest, transfer_id, validate_manifest
+
+
+def offer(**fields):
+    """A manifest with the given fields and an id that matches them, as a peer could send."""
+    manifest = {"name": "evil.bin", "size": 3 * CHUNK_SIZE, "chunk_size": CHUNK_SIZE, "hashes": ["0" * 64] * 3}
+    manifest.update(fields)
+    manifest["id"] = transfer_id(manifest)
+    return manifest
+
+
+def test_built_manifests_are_valid(tmp_path):
+    for size in (0, 1, CHUNK_SIZE, CHUNK_SIZE + 1):
+        path = tmp_path / f"{size}.bin"
+        path.write_bytes(b"x" * size)
+        validate_manifest(build_manifest(str(path)))
+
+
+@pytest.mark.parametrize("fields", [
+    {"chunk_size": 0, "hashes": []},
+    {"chunk_size": CHUNK_SIZE // 2},
+    {"chunk_size": 16 * CHUNK_SIZE},
+    {"chunk_size": float(CHUNK_SIZE)},
+    {"size": -1},
+    {"size": "3"},
+    {"size": 50 * CHUNK_SIZE, "hashes": []},
+    {"hashes": ["0" * 64] * 4},
+    {"hashes": ["0" * 64] * 2},
+    {"hashes": ["0" * 63] * 3},
+    {"hashes": ["g" * 64] * 3},
+    {"hashes": "0" * 192},
+    {"name": ""},
+    {"name": "."},
+    {"name": "dir/.."},
+    {"name": None},
+])
+def test_bad_manifests_are_refused(fields):
+    with pytest.raises(ProtocolError):
+        validate_manifest(offer(**fields))
+
+
+def test_mismatching_id_is_refused():
+    manifest = offer()
+    manifest["size"] -= 1
+    with pytest.raises(ProtocolError):
+        validate_manifest(manifest)
+
+
+def test_non_object_is_refused():
+    with pytest.raises(ProtocolError):
+        validate_manifest(["evil.bin"])